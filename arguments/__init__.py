@@ -54,6 +54,15 @@ class ModelParams(ParamGroup):
         self._white_background = False
         self.data_device = "cuda"
         self.eval = False
+        self.depth_cache_dir = os.path.join("cache", "depth")
+        self.no_depth_cache = False
+        self.depth_batch_size = 8
+        self.view_selection = "all"
+        self.num_views = 0
+        self.geo_fit_patience = 0
+        self.geo_fit_rel_tol = 1e-3
+        self.geo_fit_check_interval = 50
+        self.save_compact = False
         super().__init__(parser, "Loading Parameters", sentinel)
 
     def extract(self, args):
@@ -66,6 +75,7 @@ class PipelineParams(ParamGroup):
         self.convert_SHs_python = False
         self.compute_cov3D_python = False
         self.debug = False
+        self.rasterizer = "cuda"
         super().__init__(parser, "Pipeline Parameters")
 
 class OptimizationParams(ParamGroup):
@@ -86,6 +96,19 @@ class OptimizationParams(ParamGroup):
         self.densify_from_iter = 500
         self.densify_until_iter = 15_000
         self.densify_grad_threshold = 0.0002
+        self.reorder_interval = 0 # 0 disables the Morton reordering of the Gaussians
+        self.capacity_buffers = False
+        self.capacity_growth = 1.5
+        self.dino_resolution = 504
+        self.dino_precision = "fp32"
+        self.depth_precision = "fp32"
+        self.aux_channels_last = False
+        self.perturbation_schedule = "5400:6600:1,6600:7800:2,7800:9000:4" # start:end:scale per curriculum stage
+        self.perturbation_magnitude = 0.05
+        self.perturbation_depth_target = "main"
+        self.perturbation_depth_interval = 1
+        self.perturbation_depth_weight = 0.05
+        self.feature_loss_weight = 0.05
         self.random_background = False
         super().__init__(parser, "Optimization Parameters")
 
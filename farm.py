@@ -0,0 +1,271 @@
+#
+# Scene farm: trains a queue of scenes on a pool of worker processes.
+#
+# Every worker is pinned to one device through CUDA_VISIBLE_DEVICES and trains
+# the scenes it is handed one after the other in the same process, so the depth,
+# DINOv2 and diffusion networks held by utils.model_registry are loaded once
+# per worker. The state of every scene is kept in <model_path>/farm_status.json
+# and only written by the launcher; a later launch skips finished scenes and
+# retries the others, including those of a worker that crashed.
+#
+
+import os
+import sys
+import glob
+import json
+import time
+import queue
+import traceback
+import multiprocessing
+from collections import deque
+from contextlib import redirect_stdout, redirect_stderr
+from argparse import ArgumentParser
+
+STATUS_FILE = "farm_status.json"
+
+def read_manifest(path):
+    """
+    Scenes of a manifest file, one per line as "source_path [model_path]".
+    Empty lines and lines starting with # are ignored.
+    """
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split()
+            entries.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return entries
+
+def make_scenes(entries, output_root):
+    scenes = []
+    names = set()
+    sources = set()
+    for source_path, model_path in entries:
+        if os.path.abspath(source_path) in sources:
+            continue
+        sources.add(os.path.abspath(source_path))
+        name = os.path.basename(os.path.normpath(source_path))
+        # Scenes from different folders may share a name
+        unique, idx = name, 1
+        while unique in names:
+            unique, idx = "{}_{}".format(name, idx), idx + 1
+        names.add(unique)
+        scenes.append({
+            "name": unique,
+            "source_path": source_path,
+            "model_path": model_path or os.path.join(output_root, unique),
+        })
+    return scenes
+
+def read_status(scene):
+    try:
+        with open(os.path.join(scene["model_path"], STATUS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"state": "pending", "attempts": 0}
+
+def write_status(scene, status):
+    os.makedirs(scene["model_path"], exist_ok=True)
+    path = os.path.join(scene["model_path"], STATUS_FILE)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(status, source_path=scene["source_path"]), f, indent=2)
+    os.replace(tmp_path, path)
+
+def latest_checkpoint(model_path):
+    checkpoints = glob.glob(os.path.join(model_path, "chkpnt*.pth"))
+    if not checkpoints:
+        return None
+    return max(checkpoints, key=lambda path: int(os.path.basename(path)[len("chkpnt"):-len(".pth")]))
+
+class TrainRunner:
+    """Trains scenes with train.py's command line options in the current process."""
+    def __init__(self, train_args):
+        import torch
+        import train
+        self.torch = torch
+        self.train = train
+        self.train_args = train_args
+        # The GUI listener is never bound, try_connect() then always fails silently
+
+    def __call__(self, scene):
+        from utils.general_utils import set_seed
+
+        parser, lp, op, pp = self.train.build_parser()
+        args = parser.parse_args(self.train_args + ["-s", scene["source_path"], "-m", scene["model_path"]])
+        args.save_iterations.append(args.iterations)
+        if args.start_checkpoint is None:
+            # Pick up a crashed run where it left off, if it wrote checkpoints
+            args.start_checkpoint = latest_checkpoint(scene["model_path"])
+
+        set_seed(0)
+        self.torch.autograd.set_detect_anomaly(args.detect_anomaly)
+        try:
+            self.train.training(lp.extract(args), op.extract(args), pp.extract(args), args.test_iterations, args.save_iterations,
+                                args.checkpoint_iterations, args.start_checkpoint, args.debug_from, args.api_key, args.self_refinement,
+                                args.num_prompt, args.max_rounds, args.sync_save, args.max_pending_saves, args.log_interval, args.count_syncs,
+                                args.profile, args.profile_interval)
+        finally:
+            # Release the scene, the registry models stay loaded for the next one
+            if self.torch.cuda.is_available():
+                self.torch.cuda.empty_cache()
+
+class DryRunner:
+    """Stands in for training in CPU mode: checks the scene and sleeps."""
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, scene):
+        if not os.path.exists(scene["source_path"]):
+            raise FileNotFoundError("Source path {} does not exist".format(scene["source_path"]))
+        time.sleep(self.seconds)
+        os.makedirs(scene["model_path"], exist_ok=True)
+        with open(os.path.join(scene["model_path"], "dry_run.txt"), 'w') as f:
+            f.write("{} {}\n".format(os.getpid(), os.environ.get("CUDA_VISIBLE_DEVICES", "")))
+
+def worker_main(worker_id, device, tasks, results, options):
+    # Pin the worker before anything initialises CUDA
+    os.environ["CUDA_VISIBLE_DEVICES"] = "" if device == "cpu" else device
+    runner = DryRunner(options["dry_run_seconds"]) if options["cpu"] else TrainRunner(options["train_args"])
+    while True:
+        scene = tasks.get()
+        if scene is None:
+            break
+        results.put(("started", worker_id, scene["name"], None))
+        try:
+            os.makedirs(scene["model_path"], exist_ok=True)
+            with open(os.path.join(scene["model_path"], "farm.log"), 'a') as log, redirect_stdout(log), redirect_stderr(log):
+                runner(scene)
+            results.put(("done", worker_id, scene["name"], None))
+        except Exception:
+            results.put(("failed", worker_id, scene["name"], traceback.format_exc()))
+
+class Farm:
+    def __init__(self, scenes, devices, workers_per_device=1, max_attempts=2, options=None):
+        self.scenes = {scene["name"]: scene for scene in scenes}
+        self.slots = [device for device in devices for _ in range(workers_per_device)]
+        self.max_attempts = max_attempts
+        self.options = options
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue()
+        self.workers = {}
+        self.status = {}
+
+    def _spawn(self, worker_id):
+        tasks = self.context.Queue()
+        process = self.context.Process(target=worker_main, args=(worker_id, self.slots[worker_id], tasks, self.results, self.options), daemon=True)
+        process.start()
+        self.workers[worker_id] = {"process": process, "tasks": tasks, "scene": None}
+
+    def _update(self, name, **fields):
+        self.status[name].update(fields)
+        write_status(self.scenes[name], self.status[name])
+
+    def _finish(self, name, ok, error=None):
+        attempts = self.status[name]["attempts"] + 1
+        if ok:
+            self._update(name, state="done", attempts=attempts, finished=time.time(), error=None)
+            print("[farm] {} done".format(name))
+            return
+        state = "failed" if attempts >= self.max_attempts else "pending"
+        self._update(name, state=state, attempts=attempts, finished=time.time(), error=error)
+        print("[farm] {} failed (attempt {}/{})".format(name, attempts, self.max_attempts))
+        if state == "pending":
+            self.pending.append(name)
+
+    def run(self, rerun=False, retry_failed=False):
+        self.pending = deque()
+        for name, scene in self.scenes.items():
+            status = read_status(scene)
+            if rerun or (retry_failed and status["state"] == "failed"):
+                status = {"state": "pending", "attempts": 0}
+            self.status[name] = status
+            # "running" means the previous launch died while training it
+            if status["state"] != "done" and status["attempts"] < self.max_attempts:
+                self.pending.append(name)
+        print("[farm] {} scenes, {} to train on {} workers".format(len(self.scenes), len(self.pending), len(self.slots)))
+
+        for worker_id in range(len(self.slots)):
+            self._spawn(worker_id)
+        try:
+            while self.pending or any(worker["scene"] for worker in self.workers.values()):
+                for worker_id, worker in self.workers.items():
+                    if worker["scene"] is None and self.pending:
+                        worker["scene"] = self.pending.popleft()
+                        worker["tasks"].put(self.scenes[worker["scene"]])
+                try:
+                    event, worker_id, name, error = self.results.get(timeout=1.0)
+                except queue.Empty:
+                    self._reap()
+                    continue
+                self._reap()
+                if event == "started":
+                    self._update(name, state="running", worker=worker_id, device=self.slots[worker_id], started=time.time())
+                else:
+                    self.workers[worker_id]["scene"] = None
+                    self._finish(name, event == "done", error)
+        finally:
+            for worker in self.workers.values():
+                worker["tasks"].put(None)
+            for worker in self.workers.values():
+                worker["process"].join(timeout=10)
+        return self.status
+
+    def _reap(self):
+        # A worker killed by the OS (out of memory, driver error) never reports
+        for worker_id, worker in list(self.workers.items()):
+            if worker["process"].is_alive():
+                continue
+            name = worker["scene"]
+            print("[farm] worker {} exited with code {}".format(worker_id, worker["process"].exitcode))
+            self._spawn(worker_id)
+            if name is not None:
+                self._finish(name, False, "worker exited with code {}".format(worker["process"].exitcode))
+
+def default_devices():
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        return [device for device in visible.split(",") if device.strip()]
+    import torch
+    return [str(idx) for idx in range(torch.cuda.device_count())]
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Trains a queue of scenes on a pool of workers; "
+                                        "arguments after -- are passed to train.py for every scene")
+    parser.add_argument("--manifest", type=str, default=None)
+    parser.add_argument("--scenes", nargs="+", default=[], help="glob patterns of source paths, e.g. 'data/*_text'")
+    parser.add_argument("--output_root", type=str, default="output/farm")
+    parser.add_argument("--devices", nargs="+", default=None, help="GPU indices, all visible GPUs by default")
+    parser.add_argument("--workers_per_device", type=int, default=1)
+    parser.add_argument("--max_attempts", type=int, default=2)
+    parser.add_argument("--rerun", action="store_true", help="train finished scenes again")
+    parser.add_argument("--retry_failed", action="store_true", help="give failed scenes max_attempts more attempts")
+    parser.add_argument("--cpu", action="store_true", help="CPU-only dry run that exercises the scheduling without training")
+    parser.add_argument("--dry_run_seconds", type=float, default=1.0)
+    argv = sys.argv[1:]
+    train_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+
+    entries = read_manifest(args.manifest) if args.manifest else []
+    for pattern in args.scenes:
+        entries.extend((path, None) for path in sorted(glob.glob(pattern)))
+    if not entries:
+        parser.error("no scenes given, use --manifest or --scenes")
+
+    if args.cpu:
+        devices = ["cpu"]
+    else:
+        devices = args.devices or default_devices()
+        if not devices:
+            parser.error("no GPU found, use --cpu for a dry run")
+
+    farm = Farm(make_scenes(entries, args.output_root), devices, args.workers_per_device, args.max_attempts,
+                {"cpu": args.cpu, "dry_run_seconds": args.dry_run_seconds, "train_args": train_args})
+    status = farm.run(args.rerun, args.retry_failed)
+
+    states = [s["state"] for s in status.values()]
+    print("[farm] {} done, {} failed, {} not run".format(states.count("done"), states.count("failed"),
+                                                         len(states) - states.count("done") - states.count("failed")))
+    sys.exit(0 if states.count("done") == len(states) else 1)
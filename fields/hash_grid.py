@@ -0,0 +1,191 @@
+#
+# Pure PyTorch multiresolution hash grid encoding, a drop-in replacement for
+# tcnn.Encoding with an "otype": "HashGrid" config on machines without CUDA or
+# tiny-cuda-nn. It follows tiny-cuda-nn's grid encoding: the same per-level
+# resolutions, parameter offsets, dense indexing of coarse levels, spatial
+# hash of fine levels and interpolation, and the same flat parameter layout,
+# so the parameters of one can be loaded into the other.
+#
+
+import math
+import torch
+import torch.nn as nn
+try:
+    import tinycudann as tcnn
+except ImportError:
+    tcnn = None
+
+# Primes of tiny-cuda-nn's coherent prime hash, the first dimension is not scrambled
+PRIMES = (1, 2654435761, 805459861, 3674653429, 2097192037, 1434869437, 2165219737)
+
+INTERPOLATIONS = ("Linear", "Smoothstep")
+
+def _next_multiple(value, multiple):
+    return (value + multiple - 1) // multiple * multiple
+
+class HashGridEncoding(nn.Module):
+    """
+    Multiresolution hash grid encoding of points in [0, 1]^n_input_dims.
+    encoding_config takes the tcnn keys n_levels, n_features_per_level,
+    log2_hashmap_size, base_resolution, per_level_scale and interpolation
+    ("Linear" or "Smoothstep"). The output is [..., n_levels * n_features_per_level],
+    level by level.
+    """
+    def __init__(self, n_input_dims, encoding_config):
+        super().__init__()
+        assert encoding_config.get("otype", "HashGrid") == "HashGrid", "Only HashGrid encodings are supported"
+        self.n_input_dims = n_input_dims
+        self.n_levels = encoding_config.get("n_levels", 16)
+        self.n_features_per_level = encoding_config.get("n_features_per_level", 2)
+        self.log2_hashmap_size = encoding_config.get("log2_hashmap_size", 19)
+        self.base_resolution = encoding_config.get("base_resolution", 16)
+        self.per_level_scale = encoding_config.get("per_level_scale", 2.0)
+        self.interpolation = encoding_config.get("interpolation", "Linear")
+        assert self.interpolation in INTERPOLATIONS, "Unknown interpolation '{}'".format(self.interpolation)
+        assert n_input_dims <= len(PRIMES), "At most {} input dimensions are supported".format(len(PRIMES))
+        self.n_output_dims = self.n_levels * self.n_features_per_level
+
+        # Per level: scale of the positions, vertices per side, table size and offset
+        self.scales, self.resolutions, self.sizes, self.offsets = [], [], [], []
+        offset = 0
+        # In float32 like tiny-cuda-nn, which decides where the resolutions round up
+        log2_per_level_scale = torch.tensor(math.log2(self.per_level_scale), dtype=torch.float32)
+        for level in range(self.n_levels):
+            scale = (torch.exp2(level * log2_per_level_scale) * self.base_resolution - 1.).item()
+            resolution = math.ceil(scale) + 1
+            size = _next_multiple(min(resolution ** n_input_dims, 2 ** 31 - 1), 8)
+            size = min(size, 2 ** self.log2_hashmap_size)
+            self.scales.append(scale)
+            self.resolutions.append(resolution)
+            self.sizes.append(size)
+            self.offsets.append(offset)
+            offset += size
+
+        self.params = nn.Parameter(torch.empty(offset * self.n_features_per_level).uniform_(-1e-4, 1e-4))
+        # Corner offsets of a grid cell, [2^n_input_dims, n_input_dims]
+        corners = torch.tensor([[(corner >> dim) & 1 for dim in range(n_input_dims)] for corner in range(2 ** n_input_dims)])
+        self.register_buffer("corners", corners, persistent=False)
+        self.register_buffer("primes", torch.tensor(PRIMES[:n_input_dims], dtype=torch.int64), persistent=False)
+
+    def _index(self, level, pos_grid):
+        # pos_grid [N, corners, dims] int64 -> table indices [N, corners]
+        size, resolution = self.sizes[level], self.resolutions[level]
+        stride, index = 1, torch.zeros_like(pos_grid[..., 0])
+        for dim in range(self.n_input_dims):
+            if stride > size:
+                break
+            index = index + pos_grid[..., dim] * stride
+            stride *= resolution
+        if size < stride:
+            hashed = pos_grid * self.primes
+            index = hashed[..., 0]
+            for dim in range(1, self.n_input_dims):
+                index = index ^ hashed[..., dim]
+        return (index & 0xFFFFFFFF) % size
+
+    def forward(self, x):
+        shape = x.shape[:-1]
+        x = x.reshape(-1, self.n_input_dims).float()
+        params = self.params.view(-1, self.n_features_per_level)
+        features = []
+        for level in range(self.n_levels):
+            pos = x * self.scales[level] + 0.5
+            pos_floor = torch.floor(pos)
+            frac = pos - pos_floor
+            if self.interpolation == "Smoothstep":
+                frac = frac * frac * (3. - 2. * frac)
+            # Negative cells wrap around like the unsigned integers of tiny-cuda-nn
+            pos_grid = (pos_floor.long() & 0xFFFFFFFF)[:, None, :] + self.corners       # [N, corners, dims]
+            weights = torch.where(self.corners.bool(), frac[:, None, :], 1. - frac[:, None, :]).prod(-1)  # [N, corners]
+            index = self._index(level, pos_grid) + self.offsets[level]
+            features.append((params[index] * weights[..., None]).sum(1))
+        return torch.cat(features, -1).reshape(*shape, self.n_output_dims)
+
+def make_hash_grid(n_input_dims, encoding_config, backend=None):
+    """
+    A hash grid encoding from backend "tcnn" or "torch"; None picks tiny-cuda-nn
+    when it is installed and CUDA is available, and the PyTorch one otherwise.
+    """
+    if backend is None:
+        backend = "tcnn" if tcnn is not None and torch.cuda.is_available() else "torch"
+    if backend == "tcnn":
+        assert tcnn is not None, "tiny-cuda-nn is not installed"
+        return tcnn.Encoding(n_input_dims=n_input_dims, encoding_config=encoding_config)
+    assert backend == "torch", "Unknown hash grid backend '{}'".format(backend)
+    return HashGridEncoding(n_input_dims, encoding_config)
+
+if __name__ == '__main__':
+    # Parity of the PyTorch encoding with tiny-cuda-nn (outputs and parameter
+    # gradients for the same parameters) and the speed of both, with the
+    # config of GeometricField.
+    import sys
+    import time
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Parity and speed of the PyTorch hash grid against tiny-cuda-nn")
+    parser.add_argument("--num_points", type=int, default=20 * 256)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args(sys.argv[1:])
+
+    n_levels, base_res, fine_res = 16, 16, 2048
+    config = {
+        "otype": "HashGrid",
+        "n_levels": n_levels,
+        "n_features_per_level": 2,
+        "log2_hashmap_size": 19,
+        "base_resolution": base_res,
+        "per_level_scale": math.exp(math.log(fine_res / base_res) / (n_levels - 1)),
+        "interpolation": "Smoothstep",
+    }
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    # Points like the ones GeometricField encodes: unit directions mapped into the grid
+    dirs = torch.nn.functional.normalize(torch.randn(args.num_points, 3), dim=-1)
+    x = (dirs * 0.49 + 0.49).to(device)
+
+    def synchronize():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    def benchmark(name, encoding):
+        encoding(x).float().sum().backward()
+        synchronize()
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            encoding.zero_grad()
+            encoding(x).float().sum().backward()
+        synchronize()
+        print("{:6s} forward + backward of {} points: {:.2f} ms".format(name, args.num_points, (time.perf_counter() - start) * 1000 / args.repeats))
+
+    encoding = HashGridEncoding(3, config).to(device)
+    # Larger than the initialisation, so that differences are not lost in it
+    with torch.no_grad():
+        encoding.params.uniform_(-1., 1.)
+    print("{} parameters, level resolutions {}".format(encoding.params.numel(), encoding.resolutions))
+    benchmark("torch", encoding)
+
+    if tcnn is None or device.type != "cuda":
+        print("tiny-cuda-nn not available, skipping the comparison")
+    else:
+        reference = tcnn.Encoding(n_input_dims=3, encoding_config=config, dtype=torch.float32)
+        assert reference.params.numel() == encoding.params.numel(), \
+            "parameter count differs: tcnn {} torch {}".format(reference.params.numel(), encoding.params.numel())
+        with torch.no_grad():
+            reference.params.copy_(encoding.params)
+        benchmark("tcnn", reference)
+
+        encoding.zero_grad()
+        reference.zero_grad()
+        weights = torch.randn(args.num_points, encoding.n_output_dims, device=device)
+        out = encoding(x)
+        out_ref = reference(x).float()
+        (out * weights).sum().backward()
+        (out_ref * weights).sum().backward()
+        print("output max |diff| {:.2e} (max |output| {:.2e})".format((out - out_ref).abs().max().item(), out_ref.abs().max().item()))
+        print("params gradient max |diff| {:.2e} (max |gradient| {:.2e})".format(
+            (encoding.params.grad - reference.params.grad.float()).abs().max().item(), reference.params.grad.abs().max().item()))
+        for level in range(n_levels):
+            level_diff = (out - out_ref)[:, 2 * level:2 * level + 2].abs().max().item()
+            if level_diff > 1e-3:
+                print("  level {} (resolution {}) differs by {:.2e}".format(level, encoding.resolutions[level], level_diff))
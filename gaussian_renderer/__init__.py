@@ -11,9 +11,13 @@
 
 import torch
 import math
-from diff_gaussian_rasterization import GaussianRasterizationSettings, GaussianRasterizer
+try:
+    from diff_gaussian_rasterization import GaussianRasterizationSettings, GaussianRasterizer
+except ImportError:
+    GaussianRasterizationSettings, GaussianRasterizer = None, None
 from scene.gaussian_model import GaussianModel
 from utils.sh_utils import eval_sh
+from gaussian_renderer import torch_rasterizer
 
 def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor, scaling_modifier = 1.0, override_color = None):
     """
@@ -21,6 +25,10 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
     
     Background tensor (bg_color) must be on GPU!
     """
+
+    if use_reference_rasterizer(pc, pipe):
+        render_pkg = render_batch([viewpoint_camera], pc, pipe, bg_color, scaling_modifier, override_color)
+        return {key: value[0] for key, value in render_pkg.items()}
  
     # Create zero tensor. We will use it to make pytorch return gradients of the 2D (screen-space) means
     screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device="cuda") + 0
@@ -100,3 +108,132 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
             "visibility_filter" : radii > 0,
             "radii": radii,
             "depth": rendered_depth}
+
+
+def use_reference_rasterizer(pc : GaussianModel, pipe):
+    """
+    The PyTorch reference rasterizer is used when selected with --rasterizer torch,
+    and whenever the CUDA extension cannot be: it is not installed or the
+    Gaussians do not live on the GPU.
+    """
+    return getattr(pipe, "rasterizer", "cuda") == "torch" or GaussianRasterizer is None or not pc.get_xyz.is_cuda
+
+def render_batch(viewpoint_cameras, pc : GaussianModel, pipe, bg_color : torch.Tensor, scaling_modifier = 1.0, override_color = None):
+    """
+    Render several cameras of the same resolution. The per-Gaussian activations
+    (scaling, rotation, opacity, SH features) are computed once for the whole batch.
+
+    Returns the stacked "render" [B, 3, H, W] and "depth" maps, "radii" and
+    "visibility_filter" [B, N], and the list of per-camera "viewspace_points".
+    """
+    width = int(viewpoint_cameras[0].image_width)
+    height = int(viewpoint_cameras[0].image_height)
+    assert all(int(c.image_width) == width and int(c.image_height) == height for c in viewpoint_cameras), \
+        "render_batch expects cameras with the same resolution"
+
+    means3D = pc.get_xyz
+    opacity = pc.get_opacity
+
+    scales = None
+    rotations = None
+    cov3D_precomp = None
+    if pipe.compute_cov3D_python:
+        cov3D_precomp = pc.get_covariance(scaling_modifier)
+    else:
+        scales = pc.get_scaling
+        rotations = pc.get_rotation
+
+    features = pc.get_features
+
+    if use_reference_rasterizer(pc, pipe):
+        all_screenspace_points = []
+        for _ in viewpoint_cameras:
+            screenspace_points = torch.zeros_like(means3D, dtype=means3D.dtype, requires_grad=True, device=means3D.device) + 0
+            try:
+                screenspace_points.retain_grad()
+            except:
+                pass
+            all_screenspace_points.append(screenspace_points)
+
+        # The reference rasterizer evaluates the SHs in PyTorch anyway
+        rendered_image, radii, rendered_depth, rendered_alpha = torch_rasterizer.rasterize_cameras(
+            viewpoint_cameras,
+            bg=bg_color.to(means3D.device),
+            scale_modifier=scaling_modifier,
+            means3D=means3D,
+            means2D=torch.stack(all_screenspace_points),
+            opacities=opacity,
+            shs=features if override_color is None else None,
+            sh_degree=pc.active_sh_degree,
+            colors_precomp=override_color,
+            scales=scales,
+            rotations=rotations,
+            cov3D_precomp=cov3D_precomp)
+
+        return {"render": rendered_image,
+                "viewspace_points": all_screenspace_points,
+                "visibility_filter" : radii > 0,
+                "radii": radii,
+                "depth": rendered_depth}
+
+    if override_color is None and pipe.convert_SHs_python:
+        shs_view = features.transpose(1, 2).view(-1, 3, (pc.max_sh_degree+1)**2)
+
+    images, depths, all_radii, all_screenspace_points = [], [], [], []
+    for viewpoint_camera in viewpoint_cameras:
+        screenspace_points = torch.zeros_like(means3D, dtype=means3D.dtype, requires_grad=True, device="cuda") + 0
+        try:
+            screenspace_points.retain_grad()
+        except:
+            pass
+
+        raster_settings = GaussianRasterizationSettings(
+            image_height=height,
+            image_width=width,
+            tanfovx=math.tan(viewpoint_camera.FoVx * 0.5),
+            tanfovy=math.tan(viewpoint_camera.FoVy * 0.5),
+            bg=bg_color,
+            scale_modifier=scaling_modifier,
+            viewmatrix=viewpoint_camera.world_view_transform,
+            projmatrix=viewpoint_camera.full_proj_transform,
+            sh_degree=pc.active_sh_degree,
+            campos=viewpoint_camera.camera_center,
+            prefiltered=False,
+            debug=pipe.debug
+        )
+        rasterizer = GaussianRasterizer(raster_settings=raster_settings)
+
+        shs = None
+        colors_precomp = None
+        if override_color is None:
+            if pipe.convert_SHs_python:
+                dir_pp = (means3D - viewpoint_camera.camera_center.repeat(features.shape[0], 1))
+                dir_pp_normalized = dir_pp/dir_pp.norm(dim=1, keepdim=True)
+                sh2rgb = eval_sh(pc.active_sh_degree, shs_view, dir_pp_normalized)
+                colors_precomp = torch.clamp_min(sh2rgb + 0.5, 0.0)
+            else:
+                shs = features
+        else:
+            colors_precomp = override_color
+
+        rendered_image, radii, rendered_depth, rendered_alpha = rasterizer(
+            means3D=means3D,
+            means2D=screenspace_points,
+            shs=shs,
+            colors_precomp=colors_precomp,
+            opacities=opacity,
+            scales=scales,
+            rotations=rotations,
+            cov3D_precomp=cov3D_precomp,
+        )
+        images.append(rendered_image)
+        depths.append(rendered_depth)
+        all_radii.append(radii)
+        all_screenspace_points.append(screenspace_points)
+
+    radii = torch.stack(all_radii)
+    return {"render": torch.stack(images),
+            "viewspace_points": all_screenspace_points,
+            "visibility_filter" : radii > 0,
+            "radii": radii,
+            "depth": torch.stack(depths)}
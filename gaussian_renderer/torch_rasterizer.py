@@ -0,0 +1,343 @@
+#
+# Pure PyTorch reference implementation of the forward pass of
+# diff_gaussian_rasterization. It follows the math of the CUDA kernels
+# (preprocess + render) so that it can be used on machines without CUDA and
+# as a ground truth for the CUDA path. Everything is differentiable through
+# autograd, including the gradient of the screen-space means used for
+# densification.
+#
+
+import math
+import torch
+from utils.general_utils import build_scaling_rotation
+from utils.sh_utils import eval_sh
+
+BLOCK_X = 16
+BLOCK_Y = 16
+
+def unstrip_symmetric(cov):
+    """ [N, 6] upper triangle (as produced by strip_symmetric) to [N, 3, 3] """
+    return torch.stack([cov[:, 0], cov[:, 1], cov[:, 2],
+                        cov[:, 1], cov[:, 3], cov[:, 4],
+                        cov[:, 2], cov[:, 4], cov[:, 5]], dim=-1).view(-1, 3, 3)
+
+def compute_cov3D(scales, scale_modifier, rotations):
+    L = build_scaling_rotation(scale_modifier * scales, rotations)
+    return L @ L.transpose(1, 2)
+
+def project_gaussians(means3D, cov3D, viewmatrix, projmatrix, tanfovx, tanfovy, width, height, means2D=None):
+    """
+    Projects N Gaussians into B cameras at once.
+
+    :param means3D: [N, 3]
+    :param cov3D: [N, 3, 3]
+    :param viewmatrix: [B, 4, 4] world_view_transform (row-vector convention)
+    :param projmatrix: [B, 4, 4] full_proj_transform (row-vector convention)
+    :param tanfovx, tanfovy: [B]
+    :param means2D: optional [B, N, 3] zero tensor receiving screen-space gradients
+    :return: pixel coordinates [B, N, 2], view depth [B, N], conic [B, N, 3], radii [B, N]
+    """
+    p_hom = torch.cat([means3D, torch.ones_like(means3D[:, :1])], dim=-1)
+    p_view = torch.einsum('nk,bkj->bnj', p_hom, viewmatrix)[..., :3]
+    p_clip = torch.einsum('nk,bkj->bnj', p_hom, projmatrix)
+
+    in_frustum = p_view[..., 2] > 0.2
+
+    # Culled Gaussians get harmless values so that they cannot produce NaN gradients
+    ones = torch.ones_like(p_view[..., 2])
+    p_w = torch.where(in_frustum, p_clip[..., 3], ones)
+    p_ndc = p_clip[..., :2] / (p_w[..., None] + 0.0000001)
+    if means2D is not None:
+        p_ndc = p_ndc + means2D[..., :2]
+
+    # EWA splatting: Jacobian of the perspective projection, with the same
+    # clamping of the view frustum as the CUDA rasterizer
+    focal_x = width / (2.0 * tanfovx)[:, None]
+    focal_y = height / (2.0 * tanfovy)[:, None]
+    tz = torch.where(in_frustum, p_view[..., 2], ones)
+    limx = 1.3 * tanfovx[:, None]
+    limy = 1.3 * tanfovy[:, None]
+    tx = torch.max(torch.min(p_view[..., 0] / tz, limx), -limx) * tz
+    ty = torch.max(torch.min(p_view[..., 1] / tz, limy), -limy) * tz
+
+    zeros = torch.zeros_like(tz)
+    J = torch.stack([focal_x / tz, zeros, -(focal_x * tx) / (tz * tz),
+                     zeros, focal_y / tz, -(focal_y * ty) / (tz * tz)], dim=-1).view(*tz.shape, 2, 3)
+    W = viewmatrix[:, :3, :3].transpose(1, 2)
+    T = J @ W[:, None]
+    cov2D = T @ cov3D[None] @ T.transpose(-1, -2)
+
+    # Low-pass filter, every Gaussian should be at least one pixel wide
+    a = cov2D[..., 0, 0] + 0.3
+    b = cov2D[..., 0, 1]
+    c = cov2D[..., 1, 1] + 0.3
+
+    det = a * c - b * b
+    valid = in_frustum & (det != 0)
+    det_inv = 1.0 / torch.where(valid, det, torch.ones_like(det))
+    conic = torch.stack([c * det_inv, -b * det_inv, a * det_inv], dim=-1)
+
+    mid = 0.5 * (a + c)
+    lambda1 = mid + torch.sqrt(torch.clamp(mid * mid - det, min=0.1))
+    radius = torch.ceil(3.0 * torch.sqrt(lambda1)).detach()
+
+    xy = torch.stack([((p_ndc[..., 0] + 1.0) * width - 1.0) * 0.5,
+                      ((p_ndc[..., 1] + 1.0) * height - 1.0) * 0.5], dim=-1)
+
+    # Gaussians that do not touch any tile are discarded, as in getRect
+    grid_x = (width + BLOCK_X - 1) // BLOCK_X
+    grid_y = (height + BLOCK_Y - 1) // BLOCK_Y
+    px, py = xy[..., 0].detach(), xy[..., 1].detach()
+    rect_min_x = torch.trunc((px - radius) / BLOCK_X).clamp(0, grid_x)
+    rect_max_x = torch.trunc((px + radius + BLOCK_X - 1) / BLOCK_X).clamp(0, grid_x)
+    rect_min_y = torch.trunc((py - radius) / BLOCK_Y).clamp(0, grid_y)
+    rect_max_y = torch.trunc((py + radius + BLOCK_Y - 1) / BLOCK_Y).clamp(0, grid_y)
+    valid = valid & ((rect_max_x - rect_min_x) * (rect_max_y - rect_min_y) > 0)
+
+    radii = torch.where(valid, radius, torch.zeros_like(radius)).int()
+    return xy, tz, conic, radii
+
+def bin_gaussians(xy, depth, radii, width, height):
+    """
+    Duplicates every visible Gaussian once per 16x16 tile it overlaps and sorts
+    the duplicates by (tile, depth), like the CUDA duplicateWithKeys + radix sort.
+
+    :return: Gaussian index per duplicate, start offset and count per tile
+    """
+    device = xy.device
+    grid_x = (width + BLOCK_X - 1) // BLOCK_X
+    grid_y = (height + BLOCK_Y - 1) // BLOCK_Y
+
+    visible = torch.nonzero(radii > 0).squeeze(-1)
+    px, py = xy[visible, 0].detach(), xy[visible, 1].detach()
+    r = radii[visible].float()
+    rect_min_x = torch.trunc((px - r) / BLOCK_X).clamp(0, grid_x).long()
+    rect_max_x = torch.trunc((px + r + BLOCK_X - 1) / BLOCK_X).clamp(0, grid_x).long()
+    rect_min_y = torch.trunc((py - r) / BLOCK_Y).clamp(0, grid_y).long()
+    rect_max_y = torch.trunc((py + r + BLOCK_Y - 1) / BLOCK_Y).clamp(0, grid_y).long()
+    rect_w = rect_max_x - rect_min_x
+    counts = rect_w * (rect_max_y - rect_min_y)
+
+    gauss = torch.repeat_interleave(visible, counts)
+    local = torch.arange(gauss.shape[0], device=device) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+    rect_w = torch.repeat_interleave(rect_w, counts)
+    tile_x = torch.repeat_interleave(rect_min_x, counts) + local % rect_w
+    tile_y = torch.repeat_interleave(rect_min_y, counts) + torch.div(local, rect_w, rounding_mode='floor')
+    tile = tile_y * grid_x + tile_x
+
+    # Depth sort, then a stable sort on the tile keeps the depth order within each tile
+    order = torch.argsort(depth[gauss].detach())
+    gauss, tile = gauss[order], tile[order]
+    order = torch.sort(tile, stable=True).indices
+    gauss, tile = gauss[order], tile[order]
+
+    tile_counts = torch.bincount(tile, minlength=grid_x * grid_y)
+    tile_starts = torch.cumsum(tile_counts, 0) - tile_counts
+    return gauss, tile_starts, tile_counts
+
+def composite(xy, depth, conic, opacity, colors, radii, bg_color, width, height, max_elements=1 << 22, gaussians_per_chunk=256):
+    """
+    Tile-based front-to-back alpha compositing of the Gaussians of one camera.
+    Tiles are processed in groups of similar length, each group as one
+    [tiles, Gaussians, pixels] tensor, walking the depth-sorted lists in chunks
+    while carrying the transmittance of every pixel.
+
+    :param xy: [N, 2] pixel coordinates
+    :param depth: [N] view depth
+    :param conic: [N, 3] inverse 2D covariance
+    :param opacity: [N, 1]
+    :param colors: [N, C]
+    :param radii: [N]
+    :return: color [C, H, W], depth [1, H, W], alpha [1, H, W]
+    """
+    device = xy.device
+    dtype = xy.dtype
+    n_channels = colors.shape[-1]
+    grid_x = (width + BLOCK_X - 1) // BLOCK_X
+    grid_y = (height + BLOCK_Y - 1) // BLOCK_Y
+    n_pix = BLOCK_X * BLOCK_Y
+
+    gauss, tile_starts, tile_counts = bin_gaussians(xy, depth, radii, width, height)
+
+    # Pixel coordinates of every pixel of every tile, [n_tiles, n_pix, 2]
+    pix_local = torch.arange(n_pix, device=device)
+    tiles = torch.arange(grid_x * grid_y, device=device)
+    pix = torch.stack([(tiles % grid_x)[:, None] * BLOCK_X + (pix_local % BLOCK_X)[None],
+                       torch.div(tiles, grid_x, rounding_mode='floor')[:, None] * BLOCK_Y + torch.div(pix_local, BLOCK_X, rounding_mode='floor')[None]],
+                      dim=-1).to(dtype)
+
+    # Longest lists first, so that every group pads to a similar length
+    active = torch.nonzero(tile_counts > 0).squeeze(-1)
+    active = active[torch.argsort(tile_counts[active], descending=True)]
+    lengths = tile_counts[active].tolist()
+
+    done_tiles, done_color, done_depth, done_alpha = [], [], [], []
+    start = 0
+    while start < len(lengths):
+        chunk = min(lengths[start], gaussians_per_chunk)
+        group_size = max(1, max_elements // (chunk * n_pix))
+        tg = active[start:start + group_size]
+        max_len = lengths[start]
+        start += group_size
+
+        T = torch.ones(tg.shape[0], n_pix, device=device, dtype=dtype)
+        acc_color = torch.zeros(tg.shape[0], n_pix, n_channels, device=device, dtype=dtype)
+        acc_depth = torch.zeros(tg.shape[0], n_pix, device=device, dtype=dtype)
+        acc_alpha = torch.zeros(tg.shape[0], n_pix, device=device, dtype=dtype)
+        for l0 in range(0, max_len, chunk):
+            offsets = l0 + torch.arange(chunk, device=device)
+            in_list = offsets[None] < tile_counts[tg][:, None]
+            slot = torch.clamp(tile_starts[tg][:, None] + offsets[None], max=gauss.shape[0] - 1)
+            gid = gauss[slot]
+
+            d = xy[gid][:, :, None, :] - pix[tg][:, None, :, :]
+            co = conic[gid][..., None]
+            power = -0.5 * (co[:, :, 0] * d[..., 0] * d[..., 0] + co[:, :, 2] * d[..., 1] * d[..., 1]) - co[:, :, 1] * d[..., 0] * d[..., 1]
+            alpha = torch.clamp(opacity[gid, 0][..., None] * torch.exp(torch.clamp(power, max=0.0)), max=0.99)
+            alpha = torch.where((power > 0) | (alpha < 1.0 / 255.0) | ~in_list[..., None], torch.zeros_like(alpha), alpha)
+
+            # Transmittance in front of each Gaussian, a pixel is done as soon as
+            # it would drop below 1e-4
+            trans = torch.cumprod(1 - alpha, dim=1)
+            T_before = T[:, None] * torch.cat([torch.ones_like(trans[:, :1]), trans[:, :-1]], dim=1)
+            keep = (T_before * (1 - alpha)) >= 0.0001
+            weights = alpha * T_before * keep
+
+            acc_color = acc_color + torch.einsum('tgp,tgc->tpc', weights, colors[gid])
+            acc_depth = acc_depth + (weights * depth[gid][..., None]).sum(1)
+            acc_alpha = acc_alpha + weights.sum(1)
+            T = T * trans[:, -1]
+
+        done_tiles.append(tg)
+        done_color.append(acc_color)
+        done_depth.append(acc_depth)
+        done_alpha.append(acc_alpha)
+
+    n_tiles = grid_x * grid_y
+    tile_color = torch.zeros(n_tiles, n_pix, n_channels, device=device, dtype=dtype)
+    tile_depth = torch.zeros(n_tiles, n_pix, device=device, dtype=dtype)
+    tile_alpha = torch.zeros(n_tiles, n_pix, device=device, dtype=dtype)
+    if done_tiles:
+        done_tiles = torch.cat(done_tiles)
+        tile_color = tile_color.index_copy(0, done_tiles, torch.cat(done_color))
+        tile_depth = tile_depth.index_copy(0, done_tiles, torch.cat(done_depth))
+        tile_alpha = tile_alpha.index_copy(0, done_tiles, torch.cat(done_alpha))
+    tile_color = tile_color + (1 - tile_alpha)[..., None] * bg_color
+
+    def untile(t):
+        # [n_tiles, n_pix, C] -> [C, H, W]
+        t = t.view(grid_y, grid_x, BLOCK_Y, BLOCK_X, -1).permute(4, 0, 2, 1, 3)
+        return t.reshape(-1, grid_y * BLOCK_Y, grid_x * BLOCK_X)[:, :height, :width]
+
+    return untile(tile_color), untile(tile_depth[..., None]), untile(tile_alpha[..., None])
+
+def rasterize_gaussians(means3D, opacities, viewmatrix, projmatrix, campos, tanfovx, tanfovy, width, height, bg,
+                        shs=None, sh_degree=0, colors_precomp=None, scales=None, rotations=None, cov3D_precomp=None,
+                        scale_modifier=1.0, means2D=None):
+    """
+    Batched counterpart of GaussianRasterizer.forward for B cameras sharing the
+    same resolution. Matrices are stacked along the first dimension.
+
+    :return: images [B, 3, H, W], radii [B, N], depths [B, 1, H, W], alphas [B, 1, H, W]
+    """
+    if cov3D_precomp is not None:
+        cov3D = unstrip_symmetric(cov3D_precomp)
+    else:
+        cov3D = compute_cov3D(scales, scale_modifier, rotations)
+
+    xy, depth, conic, radii = project_gaussians(means3D, cov3D, viewmatrix, projmatrix, tanfovx, tanfovy, width, height, means2D)
+
+    if colors_precomp is None:
+        # [N, K, 3] -> [N, 3, K], evaluated per camera with the camera's view directions
+        shs_view = shs.transpose(1, 2)
+        dirs = means3D[None] - campos[:, None]
+        dirs = dirs / dirs.norm(dim=-1, keepdim=True)
+        colors = torch.clamp_min(eval_sh(sh_degree, shs_view[None], dirs) + 0.5, 0.0)
+        colors = colors.expand(viewmatrix.shape[0], -1, -1)
+    else:
+        colors = colors_precomp[None].expand(viewmatrix.shape[0], -1, -1)
+
+    images, depths, alphas = [], [], []
+    for b in range(viewmatrix.shape[0]):
+        image, rendered_depth, alpha = composite(xy[b], depth[b], conic[b], opacities, colors[b], radii[b], bg, width, height)
+        images.append(image)
+        depths.append(rendered_depth)
+        alphas.append(alpha)
+    return torch.stack(images), radii, torch.stack(depths), torch.stack(alphas)
+
+def rasterize_cameras(cameras, bg, scale_modifier=1.0, **kwargs):
+    """ Convenience wrapper stacking the matrices of a list of cameras """
+    device = kwargs["means3D"].device
+    viewmatrix = torch.stack([c.world_view_transform for c in cameras]).to(device)
+    projmatrix = torch.stack([c.full_proj_transform for c in cameras]).to(device)
+    campos = torch.stack([c.camera_center for c in cameras]).to(device)
+    tanfovx = torch.tensor([math.tan(c.FoVx * 0.5) for c in cameras], device=device)
+    tanfovy = torch.tensor([math.tan(c.FoVy * 0.5) for c in cameras], device=device)
+    return rasterize_gaussians(viewmatrix=viewmatrix, projmatrix=projmatrix, campos=campos, tanfovx=tanfovx, tanfovy=tanfovy,
+                               width=int(cameras[0].image_width), height=int(cameras[0].image_height), bg=bg,
+                               scale_modifier=scale_modifier, **kwargs)
+
+if __name__ == "__main__":
+    # Renders random Gaussians with the reference rasterizer and, when the CUDA
+    # extension is available, compares outputs and timings against it.
+    import time
+    from argparse import ArgumentParser
+    from scene.cameras import MiniCam
+    from utils.graphics_utils import getProjectionMatrix
+
+    parser = ArgumentParser(description="Reference rasterizer benchmark")
+    parser.add_argument("--num_points", type=int, default=20000)
+    parser.add_argument("--resolution", type=int, default=128)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    n = args.num_points
+    means3D = ((torch.rand(n, 3) * 2 - 1) * 2 + torch.tensor([0.0, 0.0, 4.0])).to(device)
+    scales = (torch.rand(n, 3) * 0.05 + 0.005).to(device)
+    rotations = torch.nn.functional.normalize(torch.randn(n, 4), dim=-1).to(device)
+    opacities = (torch.rand(n, 1) * 0.9 + 0.05).to(device)
+    colors = torch.rand(n, 3).to(device)
+    bg = torch.zeros(3, device=device)
+
+    fov = math.radians(60.0)
+    world_view_transform = torch.eye(4, device=device)
+    projection_matrix = getProjectionMatrix(znear=0.01, zfar=100.0, fovX=fov, fovY=fov).transpose(0, 1).to(device)
+    full_proj_transform = world_view_transform.unsqueeze(0).bmm(projection_matrix.unsqueeze(0)).squeeze(0)
+    camera = MiniCam(args.resolution, args.resolution, fov, fov, 0.01, 100.0, world_view_transform, full_proj_transform)
+
+    def synchronize():
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    with torch.no_grad():
+        synchronize()
+        start = time.perf_counter()
+        image, radii, depth, alpha = rasterize_cameras([camera], bg, means3D=means3D, opacities=opacities,
+                                                       colors_precomp=colors, scales=scales, rotations=rotations)
+        synchronize()
+        print("Reference rasterizer: {:.1f} ms, {} visible Gaussians".format((time.perf_counter() - start) * 1000, int((radii > 0).sum())))
+
+        try:
+            from diff_gaussian_rasterization import GaussianRasterizationSettings, GaussianRasterizer
+        except ImportError:
+            GaussianRasterizer = None
+
+        if GaussianRasterizer is None or device.type != "cuda":
+            print("CUDA rasterizer not available, skipping the comparison")
+        else:
+            rasterizer = GaussianRasterizer(raster_settings=GaussianRasterizationSettings(
+                image_height=args.resolution, image_width=args.resolution, tanfovx=math.tan(fov * 0.5), tanfovy=math.tan(fov * 0.5),
+                bg=bg, scale_modifier=1.0, viewmatrix=world_view_transform, projmatrix=full_proj_transform, sh_degree=0,
+                campos=camera.camera_center, prefiltered=False, debug=False))
+            means2D = torch.zeros_like(means3D)
+            synchronize()
+            start = time.perf_counter()
+            cuda_image, cuda_radii, cuda_depth, cuda_alpha = rasterizer(means3D=means3D, means2D=means2D, shs=None, colors_precomp=colors,
+                                                                        opacities=opacities, scales=scales, rotations=rotations, cov3D_precomp=None)
+            synchronize()
+            print("CUDA rasterizer: {:.1f} ms".format((time.perf_counter() - start) * 1000))
+            print("Max abs image difference: {:.2e}".format((image[0] - cuda_image).abs().max().item()))
+            print("Max abs depth difference: {:.2e}".format((depth[0] - cuda_depth.reshape(depth[0].shape)).abs().max().item()))
+            print("Matching radii: {:.4f}".format((radii[0] == cuda_radii).float().mean().item()))
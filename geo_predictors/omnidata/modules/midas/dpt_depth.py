@@ -32,6 +32,7 @@ class DPT(BaseModel):
         readout="project",
         channels_last=False,
         use_bn=False,
+        use_pretrained=True,
     ):
 
         super(DPT, self).__init__()
@@ -48,7 +49,7 @@ class DPT(BaseModel):
         self.pretrained, self.scratch = _make_encoder(
             backbone,
             features,
-            True, # Set to true of you want to train from scratch, uses ImageNet weights
+            use_pretrained, # Set to true of you want to train from scratch, uses ImageNet weights
             groups=1,
             expand=False,
             exportable=False,
@@ -66,7 +67,7 @@ class DPT(BaseModel):
 
     def forward(self, x):
         if self.channels_last == True:
-            x.contiguous(memory_format=torch.channels_last)
+            x = x.contiguous(memory_format=torch.channels_last)
 
         layer_1, layer_2, layer_3, layer_4 = forward_vit(self.pretrained, x)
 
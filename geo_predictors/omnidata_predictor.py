@@ -6,32 +6,35 @@ import PIL
 from PIL import Image
 
 from .geo_predictor import GeoPredictor
-from .omnidata.modules.midas.dpt_depth import DPTDepthModel
+from utils.model_registry import get_model
+from utils.precision_utils import run_inference
 
 class OmnidataPredictor(GeoPredictor):
     def __init__(self):
         super().__init__()
         self.img_size = 512 ### 384 sz: try 512
-        ckpt_path = 'pre_checkpoints/omnidata_dpt_depth_v2.ckpt'
-        self.model = DPTDepthModel(backbone='vitb_rn50_384', num_channels=1)
-        self.model.to(torch.device('cpu'))
-        checkpoint = torch.load(ckpt_path, map_location=torch.device('cpu'))
-        if 'state_dict' in checkpoint:
-            state_dict = {}
-            for k, v in checkpoint['state_dict'].items():
-                state_dict[k[6:]] = v
-        else:
-            state_dict = checkpoint
-
-        self.model.load_state_dict(state_dict)
         self.trans_totensor = transforms.Compose([transforms.Resize(self.img_size, interpolation=Image.BILINEAR),
                                                   transforms.CenterCrop(self.img_size),
                                                   transforms.Normalize(mean=0.5, std=0.5)])
 
+    @property
+    def model(self):
+        # Shared with utils/depth_utils.py, loaded on first use
+        return get_model('omnidata_depth')
+
     def predict_depth(self, img, **kwargs):
-        self.model.to(torch.device('cuda'))
-        img_tensor = self.trans_totensor(img)
-        output = self.model(img_tensor).clip(0., 1.)
-        self.model.to(torch.device('cpu'))
-        output = output.clip(0., 1.)
-        return output[:, None]
\ No newline at end of file
+        return self.predict_depth_batched(img)
+
+    def predict_depth_batched(self, imgs, batch_size=0):
+        '''
+        :param imgs: [N, 3, H, W] views, all run on imgs' device
+        :param batch_size: views per forward pass, 0 for all of them in one pass
+        :return: depth [N, 1, img_size, img_size] in [0, 1]
+        '''
+        # The model stays on the device for all micro-batches (and afterwards,
+        # for the depth targets of training) instead of a round trip per view
+        model = self.model.to(imgs.device)
+        batch_size = batch_size if batch_size > 0 else imgs.shape[0]
+        outputs = [run_inference(model, self.trans_totensor(imgs[start:start + batch_size]))
+                   for start in range(0, imgs.shape[0], batch_size)]
+        return torch.cat(outputs, dim=0).clip(0., 1.)[:, None]
\ No newline at end of file
@@ -9,9 +9,11 @@ from .geo_predictor import GeoPredictor
 from .omnidata_predictor import OmnidataPredictor
 
 from fields.networks import VanillaMLP
-import tinycudann as tcnn
+from fields.hash_grid import make_hash_grid
 
-from utils.geo_utils import panorama_to_pers_directions
+from utils.geo_utils import random_yaw_angles
+from utils.convergence_utils import ConvergenceMonitor
+from .view_planner import ViewPlanner, candidate_vectors, sample_views
 from utils.camera_utils import *
 
 
@@ -24,10 +26,12 @@ class GeometricField(nn.Module):
                  n_levels=16,
                  log2_hashmap_size=19,
                  base_res=16,
-                 fine_res=2048):
+                 fine_res=2048,
+                 hash_grid_backend=None):
         super().__init__()
         per_level_scale = np.exp(np.log(fine_res / base_res) / (n_levels - 1))
-        self.hash_grid = tcnn.Encoding(
+        # tiny-cuda-nn when it is available, the PyTorch hash grid otherwise
+        self.hash_grid = make_hash_grid(
             n_input_dims=3,
             encoding_config={
                 "otype": "HashGrid",
@@ -37,7 +41,8 @@ class GeometricField(nn.Module):
                 "base_resolution": base_res,
                 "per_level_scale": per_level_scale,
                 "interpolation": "Smoothstep",
-            }
+            },
+            backend=hash_grid_backend
         )
 
         self.geo_mlp = VanillaMLP(dim_in=n_levels * 2 + 3,
@@ -71,11 +76,22 @@ class GeometricField(nn.Module):
 
 
 class PanoGeoPredictor(GeoPredictor):
-    def __init__(self):
+    def __init__(self, depth_batch_size=8, view_selection="all", num_views=0, fit_patience=0, fit_rel_tol=1e-3, fit_check_interval=50):
         super().__init__()
         self.depth_predictor = OmnidataPredictor()
+        # Perspective views per depth network forward pass, 0 for all at once
+        self.depth_batch_size = depth_batch_size
+        # Which of the 12 x 20 perspective views are returned for training
+        self.view_planner = ViewPlanner(12, view_selection, num_views)
+        # Early stopping of the two phases of the distance field fit, see
+        # ConvergenceMonitor; fit_stats records how many steps each one took
+        self.fit_patience = fit_patience
+        self.fit_rel_tol = fit_rel_tol
+        self.fit_check_interval = fit_check_interval
+        self.fit_stats = {}
 
     def grads_to_normal(self, grads):
+        device = grads.device
         grads = grads.cpu()
         height, width, _ = grads.shape
         pano_dirs = img_coord_to_pano_direction(img_coord_from_hw(height, width))
@@ -94,7 +110,7 @@ class PanoGeoPredictor(GeoPredictor):
         normals = normals / torch.linalg.norm(normals, 2, -1, True)
         is_inside = ((normals * pano_dirs).sum(-1, True) < 0.).float()
         normals = normals * is_inside + -normals * (1. - is_inside)
-        return normals.cuda()
+        return normals.to(device)
 
     def __call__(self, img, gen_res=512, reg_loss_weight=1e-1,):
         '''
@@ -108,33 +124,23 @@ class PanoGeoPredictor(GeoPredictor):
         device = img.device
         img = img.clone().squeeze().permute(2, 0, 1)    
 
-        pers_dirs, pers_ratios, to_vecs, down_vecs, right_vecs = [], [], [], [], []
-        for i in range(12):
-            ratio = 1.1
-            cur_pers_dirs, cur_pers_ratios, cur_to_vecs, cur_down_vecs, cur_right_vecs = panorama_to_pers_directions(gen_res=gen_res, ratio=ratio, ex_rot='rand')
-            pers_dirs.append(cur_pers_dirs)
-            pers_ratios.append(cur_pers_ratios)
-            to_vecs.append(cur_to_vecs)
-            down_vecs.append(cur_down_vecs)
-            right_vecs.append(cur_right_vecs)
-
-        pers_dirs = torch.cat(pers_dirs, 0)
-        pers_ratios = torch.cat(pers_ratios, 0)
-        to_vecs = torch.cat(to_vecs, 0)
-        down_vecs = torch.cat(down_vecs, 0)
-        right_vecs = torch.cat(right_vecs, 0)
+        # 12 random yaw rotations of the 20 icosahedron views; only the camera
+        # vectors of all of them are built, the images and direction grids
+        # only for the planned views
+        angles = random_yaw_angles(self.view_planner.n_rot)
+        to_vecs, down_vecs, right_vecs = candidate_vectors(angles, ratio=1.1, device=device)
+        plan = self.view_planner.plan(to_vecs)
+        sampled_imgs, fit_dirs = sample_views(img, angles, plan.sample_views, gen_res=gen_res, ratio=1.1, keep_dirs=plan.fit_views)
+        position = {view: idx for idx, view in enumerate(plan.sample_views)}
+
+        train_views = torch.tensor(plan.train_views, dtype=torch.long, device=to_vecs.device)
+        to_vecs, down_vecs, right_vecs = to_vecs[train_views], down_vecs[train_views], right_vecs[train_views]
 
         fx = torch.linalg.norm(to_vecs, 2, -1, True) / torch.linalg.norm(right_vecs, 2, -1, True) * gen_res * .5
         fy = torch.linalg.norm(to_vecs, 2, -1, True) / torch.linalg.norm(down_vecs, 2, -1, True) * gen_res * .5
         cx = torch.ones_like(fx) * gen_res * .5
         cy = torch.ones_like(fy) * gen_res * .5
 
-        pers_dirs = pers_dirs.to(device)
-        pers_ratios = pers_ratios.to(device)
-        to_vecs = to_vecs.to(device)
-        down_vecs = down_vecs.to(device)
-        right_vecs = right_vecs.to(device)
-
         rot_w2c = torch.stack([right_vecs / torch.linalg.norm(right_vecs, 2, -1, True),
                                down_vecs / torch.linalg.norm(down_vecs, 2, -1, True),
                                to_vecs / torch.linalg.norm(to_vecs, 2, -1, True)],
@@ -142,37 +148,25 @@ class PanoGeoPredictor(GeoPredictor):
 
         rot_c2w = torch.linalg.inv(rot_w2c)
 
-        n_pers = len(pers_dirs)
-        img_coords = direction_to_img_coord(pers_dirs)
-        sample_coords = img_coord_to_sample_coord(img_coords)
-
-        pers_imgs = F.grid_sample(img[None].expand(n_pers, -1, -1, -1), sample_coords, padding_mode='border') # [n_pers, 3, gen_res, gen_res]
+        if plan.train_views == plan.sample_views:
+            pers_imgs = sampled_imgs # [n_pers, 3, gen_res, gen_res]
+        else:
+            pers_imgs = sampled_imgs[[position[view] for view in plan.train_views]]
 
 
 
         ####################################### Start Optimization #####################################################
 
-        pers_imgs_pc = pers_imgs[:20]
-        pers_dirs_pc = pers_dirs[:20]
+        pers_imgs_pc = sampled_imgs[[position[view] for view in plan.fit_views]]
+        pers_dirs_pc = torch.stack([fit_dirs[view][0] for view in plan.fit_views])
+        pers_ratios = torch.stack([fit_dirs[view][1] for view in plan.fit_views])
         n_pers_pc = len(pers_dirs_pc)
 
-        pred_distances_raw = []
-
-        for i in range(n_pers_pc):
-            with torch.no_grad():
-                intri = {
-                    'fx': fx[i].item(),
-                    'fy': fy[i].item(),
-                    'cx': cx[i].item(),
-                    'cy': cy[i].item()
-                }
-
-                pred_depth = self.depth_predictor.predict_depth(pers_imgs_pc[i: i+1], intri=intri).cuda().clip(0., None)  # [1, 1, res, res]
-                pred_depth = pred_depth / (pred_depth.mean() + 1e-5)
-                pred_depth_ratio = pred_depth * pers_ratios[i].permute(2, 0, 1)[None]
-                pred_distances_raw.append(pred_depth_ratio)
-
-        pred_distances_raw = torch.cat(pred_distances_raw, dim=0)  # [n_pers, 1, res, res]
+        with torch.no_grad():
+            pred_depth = self.depth_predictor.predict_depth_batched(pers_imgs_pc, self.depth_batch_size).to(device).clip(0., None)  # [n_pers, 1, res, res]
+            # Every view is normalised by its own mean depth
+            pred_depth = pred_depth / (pred_depth.mean(dim=(1, 2, 3), keepdim=True) + 1e-5)
+            pred_distances_raw = pred_depth * pers_ratios[:n_pers_pc].permute(0, 3, 1, 2)  # [n_pers, 1, res, res]
         pers_dirs_pc = pers_dirs_pc.permute(0, 3, 1, 2)
 
         sup_infos = torch.cat([pers_dirs_pc, pred_distances_raw], dim=1)
@@ -180,7 +174,7 @@ class PanoGeoPredictor(GeoPredictor):
         scale_params = torch.zeros([n_pers_pc], requires_grad=True)
         bias_params_local_distance  = torch.zeros([n_pers_pc, 1, gen_res, gen_res], requires_grad=True)
 
-        geo_field = GeometricField(fine_res = 2048).cuda()
+        geo_field = GeometricField(fine_res = 2048, hash_grid_backend=None if device.type == "cuda" else "torch").to(device)
 
         # Stage 1: Optimize global parameters
         all_iter_steps = 1500
@@ -194,12 +188,10 @@ class PanoGeoPredictor(GeoPredictor):
         optimizer_global = torch.optim.Adam([scale_params], lr=init_lr)
         optimizer_local = torch.optim.Adam([bias_params_local_distance], lr=init_lr_local)
 
+        self.fit_stats = {}
         for phase in ['global', 'hybrid']:
-            ###
-            ema_loss_for_log = 0.0
+            monitor = ConvergenceMonitor(self.fit_patience, self.fit_rel_tol, self.fit_check_interval)
             progress_bar = tqdm(range(1, all_iter_steps + 1), desc="Training progress")
-            loss_vis = []
-            ###
             #for iter_step in tqdm(range(all_iter_steps)):
             for iter_step in range(1, all_iter_steps + 1):
                 progress = iter_step / all_iter_steps
@@ -217,16 +209,16 @@ class PanoGeoPredictor(GeoPredictor):
                     g['lr'] = init_lr_sp * lr_ratio
 
                 #idx = np.random.randint(low=0, high=n_pers)
-                sample_coords = torch.rand(n_pers_pc, local_batch_size, 1, 2).cuda() * 2. - 1           # [n_pers, local_batch_size, 1, 2] range (-1, +1)
+                sample_coords = torch.rand(n_pers_pc, local_batch_size, 1, 2).to(device) * 2. - 1           # [n_pers, local_batch_size, 1, 2] range (-1, +1)
                 cur_sup_info = F.grid_sample(sup_infos, sample_coords, padding_mode='border')        # [n_pers, 7, local_batch_size, 1]
-                distance_bias = F.grid_sample(bias_params_local_distance.cuda(), sample_coords, padding_mode='border')  # [n_pers, 1, local_batch_size, 1]
+                distance_bias = F.grid_sample(bias_params_local_distance.to(device), sample_coords, padding_mode='border')  # [n_pers, 1, local_batch_size, 1]
                 distance_bias = distance_bias[:, :, :, 0].permute(0, 2, 1)                              # [n_pers, local_batch_size, 1]
 
                 dirs = cur_sup_info[:, :3, :, 0].permute(0, 2, 1)                                    # [n_pers, local_batch_size, 3]
                 dirs = dirs / torch.linalg.norm(dirs, 2, -1, True)
 
                 ref_pred_distances = cur_sup_info[:, 3: 4, :, 0].permute(0, 2, 1)                         # [n_pers, local_batch_size, 1]
-                ref_pred_distances = ref_pred_distances * F.softplus(scale_params[:, None, None].cuda())  # [n_pers, local_batch_size, 1]
+                ref_pred_distances = ref_pred_distances * F.softplus(scale_params[:, None, None].to(device))  # [n_pers, local_batch_size, 1]
                 ref_pred_distances = ref_pred_distances + distance_bias
 
                 pred_distances = geo_field(dirs.reshape(-1, 3), requires_grad=False)
@@ -259,17 +251,22 @@ class PanoGeoPredictor(GeoPredictor):
                     optimizer_local.step()
 
                 with torch.no_grad():
-                    # Progress bar
-                    ema_loss_for_log = 0.4 * loss.item() + 0.6 * ema_loss_for_log
-                    loss_vis.append(ema_loss_for_log) ###
-                    if iter_step % 1 == 0:
-                        progress_bar.set_postfix({"Loss": f"{ema_loss_for_log:.{7}f}"})
-                        progress_bar.update(1)
-                    if iter_step == all_iter_steps:
-                        progress_bar.close()
-
-
-        pano_dirs = img_coord_to_pano_direction(img_coord_from_hw(height, width)).cuda()
+                    # The loss is only read back every check interval
+                    converged = monitor.update(iter_step, loss)
+                    if iter_step % monitor.check_interval == 0:
+                        progress_bar.set_postfix({"Loss": f"{monitor.ema_loss:.{7}f}"})
+                        progress_bar.update(iter_step - progress_bar.n)
+                if converged:
+                    break
+
+            progress_bar.update(monitor.last_step - progress_bar.n)
+            progress_bar.close()
+            self.fit_stats[phase] = monitor.summary(all_iter_steps)
+            if monitor.stopped_at is not None:
+                print("[geo fit] {} phase converged after {} of {} steps".format(phase, monitor.stopped_at, all_iter_steps))
+
+
+        pano_dirs = img_coord_to_pano_direction(img_coord_from_hw(height, width)).to(device)
         new_distances = geo_field(pano_dirs.reshape(-1, 3), requires_grad=False)
         new_distances = new_distances.detach().reshape(height, width, 1)
 
@@ -0,0 +1,168 @@
+import torch
+import torch.nn.functional as F
+
+from utils.geo_utils import yaw_pers_directions
+from utils.camera_utils import direction_to_img_coord, img_coord_to_sample_coord
+
+VIEW_SELECTIONS = ("all", "first", "coverage")
+
+N_FACES = 20
+
+class ViewPlan:
+    """
+    Indices into the n_rot * 20 candidate views: fit_views are the views the
+    depth field is fitted to, train_views the ones returned as training
+    images, sample_views (sorted) the union of both, the only views whose
+    images are sampled from the panorama.
+    """
+    def __init__(self, fit_views, train_views):
+        self.fit_views = list(fit_views)
+        self.train_views = list(train_views)
+        self.sample_views = sorted(set(self.fit_views) | set(self.train_views))
+
+def candidate_vectors(angles, ratio=1., device=None):
+    """to_vecs, down_vecs, right_vecs [len(angles) * 20, 3] of all candidate views, without their direction grids."""
+    # The camera vectors do not depend on the resolution of the grids
+    _, _, to_vecs, down_vecs, right_vecs = yaw_pers_directions(angles, gen_res=1, ratio=ratio, device=device)
+    return to_vecs, down_vecs, right_vecs
+
+def farthest_views(to_vecs, n):
+    """
+    Greedy farthest point selection of n views by viewing direction, starting
+    from view 0: every next view is the one whose direction is furthest from
+    all views picked so far. Returns the picked indices, sorted.
+    """
+    dirs = F.normalize(to_vecs, dim=-1)
+    picked = [0]
+    # Cosine to the closest picked view, picked views are at 1
+    closest = dirs @ dirs[0]
+    for _ in range(min(n, len(dirs)) - 1):
+        idx = int(torch.argmin(closest))
+        picked.append(idx)
+        closest = torch.maximum(closest, dirs @ dirs[idx])
+    return sorted(picked)
+
+class ViewPlanner:
+    """
+    Decides up front which of the perspective views of the panorama are
+    needed, so that only those are built and sampled.
+
+    The candidates are the 20 icosahedron views under n_rot yaw rotations. The
+    depth field is always fitted to the 20 views of the first rotation, which
+    tile the sphere once. The training views are selected by selection:
+      "all"       every candidate (num_views is ignored), as training always did;
+      "first"     the first num_views candidates;
+      "coverage"  num_views candidates spread evenly over the sphere by
+                  farthest point selection of their viewing directions.
+    num_views <= 0 keeps all candidates.
+    """
+    def __init__(self, n_rot=12, selection="all", num_views=0):
+        assert selection in VIEW_SELECTIONS, "Unknown view selection '{}'".format(selection)
+        self.n_rot = n_rot
+        self.selection = selection
+        self.num_views = num_views
+
+    @property
+    def num_candidates(self):
+        return self.n_rot * N_FACES
+
+    def plan(self, to_vecs):
+        """Plans the views for the candidates' viewing directions to_vecs [n_rot * 20, 3]."""
+        n = self.num_candidates
+        if self.selection == "all" or self.num_views <= 0 or self.num_views >= n:
+            train_views = range(n)
+        elif self.selection == "first":
+            train_views = range(self.num_views)
+        else:
+            train_views = farthest_views(to_vecs, self.num_views)
+        return ViewPlan(range(N_FACES), train_views)
+
+def sample_views(img, angles, views, gen_res=512, ratio=1., chunk_size=N_FACES, keep_dirs=()):
+    """
+    Samples the perspective images of views from the panorama img [3, H, W],
+    chunk_size views at a time so that only one chunk of direction grids and
+    sample coordinates exists at once.
+    :param keep_dirs: views whose directions and ratios are returned as well
+    :return: images [len(views), 3, gen_res, gen_res], {view: (dirs [gen_res, gen_res, 3], ratios [gen_res, gen_res, 1])}
+    """
+    views = list(views)
+    keep_dirs = set(keep_dirs)
+    images = torch.empty([len(views), img.shape[0], gen_res, gen_res], dtype=img.dtype, device=img.device)
+    kept = {}
+    for start in range(0, len(views), chunk_size):
+        chunk = views[start:start + chunk_size]
+        dirs, ratios, _, _, _ = yaw_pers_directions(angles, gen_res=gen_res, ratio=ratio, device=img.device, views=chunk)
+        sample_coords = img_coord_to_sample_coord(direction_to_img_coord(dirs))
+        images[start:start + len(chunk)] = F.grid_sample(img[None].expand(len(chunk), -1, -1, -1), sample_coords, padding_mode='border')
+        for idx, view in enumerate(chunk):
+            if view in keep_dirs:
+                kept[view] = (dirs[idx], ratios[idx])
+    return images, kept
+
+if __name__ == '__main__':
+    # Memory and time of building the perspective views of a panorama: all
+    # 240 views materialised and sliced, as PanoGeoPredictor used to do,
+    # against the planned views sampled in chunks.
+    import sys
+    import time
+    from argparse import ArgumentParser
+    from utils.geo_utils import random_yaw_angles
+    from utils.general_utils import default_device
+
+    parser = ArgumentParser(description="Benchmark of planned perspective view sampling")
+    parser.add_argument("--gen_res", type=int, default=512)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--selection", type=str, default="all", choices=VIEW_SELECTIONS)
+    parser.add_argument("--num_views", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args(sys.argv[1:])
+
+    device = default_device()
+    img = torch.rand(3, args.height, args.height * 2, device=device)
+    angles = random_yaw_angles(12)
+
+    def sync():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    def sliced():
+        dirs, ratios, to_vecs, _, _ = yaw_pers_directions(angles, gen_res=args.gen_res, ratio=1.1, device=device)
+        sample_coords = img_coord_to_sample_coord(direction_to_img_coord(dirs))
+        images = F.grid_sample(img[None].expand(len(dirs), -1, -1, -1), sample_coords, padding_mode='border')
+        return images[:N_FACES], dirs[:N_FACES], images
+
+    def planned():
+        to_vecs, _, _ = candidate_vectors(angles, ratio=1.1, device=device)
+        plan = ViewPlanner(12, args.selection, args.num_views).plan(to_vecs)
+        images, kept = sample_views(img, angles, plan.sample_views, gen_res=args.gen_res, ratio=1.1, keep_dirs=plan.fit_views)
+        position = {view: idx for idx, view in enumerate(plan.sample_views)}
+        fit_images = images[[position[view] for view in plan.fit_views]]
+        fit_dirs = torch.stack([kept[view][0] for view in plan.fit_views])
+        if plan.train_views != plan.sample_views:
+            images = images[[position[view] for view in plan.train_views]]
+        return fit_images, fit_dirs, images
+
+    results = {}
+    for name, fn in [("sliced", sliced), ("planned", planned)]:
+        fn()
+        sync()
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            out = fn()
+            sync()
+            times.append(time.perf_counter() - start)
+        peak = (torch.cuda.max_memory_allocated(device) - base) / 2 ** 20 if device.type == "cuda" else float("nan")
+        results[name] = out
+        print("{:8s} {:7.1f} ms  peak {:8.1f} MiB  {} training views".format(name, 1000 * min(times), peak, len(out[2])))
+        del out
+
+    ref, new = results["sliced"], results["planned"]
+    print("fit images max |diff| {:.2e}, fit directions max |diff| {:.2e}".format(
+        (ref[0] - new[0]).abs().max().item(), (ref[1] - new[1]).abs().max().item()))
+    if args.selection == "all" or args.num_views <= 0:
+        print("training images max |diff| {:.2e}".format((ref[2] - new[2]).abs().max().item()))
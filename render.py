@@ -14,7 +14,7 @@ from scene import Scene
 import os
 from tqdm import tqdm
 from os import makedirs
-from gaussian_renderer import render
+from gaussian_renderer import render_batch
 import torchvision
 from utils.general_utils import safe_state
 from argparse import ArgumentParser
@@ -26,32 +26,26 @@ from PIL import Image
 import numpy as np
 ###
 
-def render_set(model_path, name, iteration, views, p_views_1, p_views_2, p_views_3, gaussians, pipeline, background):
+def render_views(views, gaussians, pipeline, background, batch_size):
+    # Renders the views batch_size at a time, yielding (idx, view, image, depth) per view
+    with tqdm(total=len(views), desc="Rendering progress") as progress_bar:
+        for start in range(0, len(views), batch_size):
+            batch = views[start:start + batch_size]
+            render_pkg = render_batch(batch, gaussians, pipeline, background)
+            for offset, view in enumerate(batch):
+                yield start + offset, view, render_pkg["render"][offset], render_pkg["depth"][offset]
+            progress_bar.update(len(batch))
+
+def render_set(model_path, name, iteration, views, perturbation_views, gaussians, pipeline, background, batch_size):
     render_path = os.path.join(model_path, name, "ours_{}".format(iteration), "renders")
     gts_path = os.path.join(model_path, name, "ours_{}".format(iteration), "gt")
     depth_path = os.path.join(model_path, name, "ours_{}".format(iteration), "depth")
-    pr_path_1 = os.path.join(model_path, name, "ours_{}".format(iteration), "perturbation_render_1")
-    pr_path_2 = os.path.join(model_path, name, "ours_{}".format(iteration), "perturbation_render_2")
-    pr_path_3 = os.path.join(model_path, name, "ours_{}".format(iteration), "perturbation_render_3")
-    p_path_1 = os.path.join(model_path, name, "ours_{}".format(iteration), "perturbation_depth_1")
-    p_path_2 = os.path.join(model_path, name, "ours_{}".format(iteration), "perturbation_depth_2")
-    p_path_3 = os.path.join(model_path, name, "ours_{}".format(iteration), "perturbation_depth_3")
-
 
     makedirs(render_path, exist_ok=True)
     makedirs(gts_path, exist_ok=True)
     makedirs(depth_path, exist_ok=True)
-    makedirs(pr_path_1, exist_ok=True)
-    makedirs(pr_path_2, exist_ok=True)
-    makedirs(pr_path_3, exist_ok=True)
-    makedirs(p_path_1, exist_ok=True)
-    makedirs(p_path_2, exist_ok=True)
-    makedirs(p_path_3, exist_ok=True)
 
-    for idx, view in enumerate(tqdm(views, desc="Rendering progress")):
-        render_pkg = render(view, gaussians, pipeline, background)
-        rendering = render_pkg["render"]
-        depth = render_pkg["depth"]
+    for idx, view, rendering, depth in render_views(views, gaussians, pipeline, background, batch_size):
         gt = view.original_image[0:3, :, :]
         ##########
         scale_nor = depth.max().item()
@@ -67,41 +61,32 @@ def render_set(model_path, name, iteration, views, p_views_1, p_views_2, p_views
         torchvision.utils.save_image(rendering, os.path.join(render_path, '{0:05d}'.format(idx) + ".png"))
         torchvision.utils.save_image(gt, os.path.join(gts_path, '{0:05d}'.format(idx) + ".png"))
 
-    if name == 'train':
-        for idx, view in enumerate(tqdm(p_views_1, desc="Rendering progress")):
-            render_pkg = render(view, gaussians, pipeline, background)
-            p_render_1 = render_pkg["render"]
-            p_depth_1 = render_pkg["depth"]
-            torchvision.utils.save_image(p_depth_1, os.path.join(p_path_1, '{0:05d}'.format(idx) + ".png"))
-            torchvision.utils.save_image(p_render_1, os.path.join(pr_path_1, '{0:05d}'.format(idx) + ".png"))
-        for idx, view in enumerate(tqdm(p_views_2, desc="Rendering progress")):
-            render_pkg = render(view, gaussians, pipeline, background)
-            p_render_2 = render_pkg["render"]
-            p_depth_2 = render_pkg["depth"]
-            torchvision.utils.save_image(p_depth_2, os.path.join(p_path_2, '{0:05d}'.format(idx) + ".png"))
-            torchvision.utils.save_image(p_render_2, os.path.join(pr_path_2, '{0:05d}'.format(idx) + ".png"))
-        for idx, view in enumerate(tqdm(p_views_3, desc="Rendering progress")):
-            render_pkg = render(view, gaussians, pipeline, background)
-            p_render_3 = render_pkg["render"]
-            p_depth_3 = render_pkg["depth"]
-            torchvision.utils.save_image(p_depth_3, os.path.join(p_path_3, '{0:05d}'.format(idx) + ".png"))
-            torchvision.utils.save_image(p_render_3, os.path.join(pr_path_3, '{0:05d}'.format(idx) + ".png"))
+    # One set of perturbation renders per curriculum stage
+    for stage, p_views in enumerate(perturbation_views, start=1):
+        pr_path = os.path.join(model_path, name, "ours_{}".format(iteration), "perturbation_render_{}".format(stage))
+        p_path = os.path.join(model_path, name, "ours_{}".format(iteration), "perturbation_depth_{}".format(stage))
+        makedirs(pr_path, exist_ok=True)
+        makedirs(p_path, exist_ok=True)
+        for idx, view, p_render, p_depth in render_views(p_views, gaussians, pipeline, background, batch_size):
+            torchvision.utils.save_image(p_depth, os.path.join(p_path, '{0:05d}'.format(idx) + ".png"))
+            torchvision.utils.save_image(p_render, os.path.join(pr_path, '{0:05d}'.format(idx) + ".png"))
 
-def render_sets(dataset : ModelParams, iteration : int, pipeline : PipelineParams, skip_train : bool, skip_test : bool):
+def render_sets(dataset : ModelParams, iteration : int, pipeline : PipelineParams, skip_train : bool, skip_test : bool, batch_size : int = 8):
     with torch.no_grad():
         gaussians = GaussianModel(dataset.sh_degree)
         scene = Scene(dataset, gaussians, load_iteration=iteration, shuffle=False, api_key=None, self_refinement=None, num_prompt=None, max_rounds=None)
 
         bg_color = [1,1,1] if dataset.white_background else [0, 0, 0]
-        background = torch.tensor(bg_color, dtype=torch.float32, device="cuda")
+        background = torch.tensor(bg_color, dtype=torch.float32, device=gaussians.device)
+        curriculum = scene.getPerturbationCurriculum()
 
         if not skip_train:
              render_set(dataset.model_path, "train", scene.loaded_iter, scene.getTrainCameras(),
-             scene.getPerturbationCameras(stage=1), scene.getPerturbationCameras(stage=2), scene.getPerturbationCameras(stage=3), gaussians, pipeline, background)
+             [curriculum.cameras(stage) for stage in range(curriculum.num_stages)], gaussians, pipeline, background, batch_size)
 
         if not skip_test:
              render_set(dataset.model_path, "train", scene.loaded_iter, scene.getTrainCameras(),
-             scene.getPerturbationCameras(stage=1), scene.getPerturbationCameras(stage=2), scene.getPerturbationCameras(stage=3), gaussians, pipeline, background)
+             [curriculum.cameras(stage) for stage in range(curriculum.num_stages)], gaussians, pipeline, background, batch_size)
 
 if __name__ == "__main__":
     # Set up command line argument parser
@@ -112,10 +97,11 @@ if __name__ == "__main__":
     parser.add_argument("--skip_train", action="store_true")
     parser.add_argument("--skip_test", action="store_true")
     parser.add_argument("--quiet", action="store_true")
+    parser.add_argument("--batch_size", default=8, type=int)
     args = get_combined_args(parser)
     print("Rendering " + args.model_path)
 
     # Initialize system state (RNG)
     safe_state(args.quiet)
 
-    render_sets(model.extract(args), args.iteration, pipeline.extract(args), args.skip_train, args.skip_test)
\ No newline at end of file
+    render_sets(model.extract(args), args.iteration, pipeline.extract(args), args.skip_train, args.skip_test, args.batch_size)
\ No newline at end of file
@@ -15,6 +15,7 @@ import json
 from utils.system_utils import searchForMaxIteration
 from scene.dataset_readers import sceneLoadTypeCallbacks, CameraInfo, SceneInfo ###
 from scene.gaussian_model import GaussianModel, BasicPointCloud ###
+from scene.perturbation_curriculum import PerturbationCurriculum, DEFAULT_PERTURBATION_SCHEDULE
 from arguments import ModelParams
 from utils.camera_utils import cameraList_from_camInfos, camera_to_JSON, img_coord_to_pano_direction ###
 ###
@@ -26,6 +27,7 @@ from PIL import Image
 import trimesh
 import cv2 as cv
 from utils.save_data import save_data
+from utils.model_registry import get_model
 import sys
 import importlib
 sys.path.append('stitch_diffusion/kohya_trainer')
@@ -81,9 +83,6 @@ def get_info_from_params(source_path, pano_img, distances, rot_w2c, fx, fy, cx,
         H, W, _ = pano_img.shape
         n_pers, _, h, w = pers_imgs.shape
         cam_infos_unsorted = []
-        cam_perturbation_infos_unsorted = [] ###
-        cam_perturbation_infos_unsorted_stage2 = [] ###
-        cam_perturbation_infos_unsorted_stage3 = [] ###
         for i in range(n_pers):
             with torch.no_grad():
                 img = pers_imgs[i].cpu().numpy()
@@ -100,7 +99,6 @@ def get_info_from_params(source_path, pano_img, distances, rot_w2c, fx, fy, cx,
                 fovy = focal2fov(intri['fy'], h)
                 R = np.transpose(np.asarray(rot_w2c[i].cpu()))
                 T = np.transpose(np.array( [0, 0, 0]))
-                T_perturbation = T + np.random.uniform(-0.05, 0.05, size=(1, 3)) ###
                 uid = i
                 image_name = 'image' + str(i)
                 try:
@@ -112,36 +110,15 @@ def get_info_from_params(source_path, pano_img, distances, rot_w2c, fx, fy, cx,
                 cam_info = CameraInfo(uid=uid, R=R, T=T, FovY=fovy, FovX=fovx, image=img,
                               image_path=image_path, image_name=image_name, width=w, height=h)      
                 cam_infos_unsorted.append(cam_info)
-                ### stage 1 perturbation
-                cam_perturbation_info = CameraInfo(uid=uid, R=R, T=T_perturbation, FovY=fovy, FovX=fovx, image=img,
-                              image_path=image_path, image_name=image_name, width=w, height=h)
-                cam_perturbation_infos_unsorted.append(cam_perturbation_info)
-                ### stage 2 perturbation
-                T_perturbation_stage2 = T + np.random.uniform(-0.05 * 2, 0.05 * 2, size=(1, 3))
-                cam_perturbation_info_stage2  = CameraInfo(uid=uid, R=R, T=T_perturbation_stage2, FovY=fovy, FovX=fovx, image=img,
-                              image_path=image_path, image_name=image_name, width=w, height=h)
-                cam_perturbation_infos_unsorted_stage2 .append(cam_perturbation_info_stage2)
-                ### stage 3 perturbation
-                T_perturbation_stage3 = T + np.random.uniform(-0.05 * 4, 0.05 * 4, size=(1, 3))
-                cam_perturbation_info_stage3  = CameraInfo(uid=uid, R=R, T=T_perturbation_stage3, FovY=fovy, FovX=fovx, image=img,
-                              image_path=image_path, image_name=image_name, width=w, height=h)
-                cam_perturbation_infos_unsorted_stage3 .append(cam_perturbation_info_stage3)
-
-
 
         cam_infos = sorted(cam_infos_unsorted.copy(), key = lambda x : x.image_name)
-        cam_perturbation_infos = sorted(cam_perturbation_infos_unsorted.copy(), key = lambda x : x.image_name) ###
-        cam_perturbation_infos_stage2 = sorted(cam_perturbation_infos_unsorted_stage2.copy(), key = lambda x : x.image_name) ###
-        cam_perturbation_infos_stage3 = sorted(cam_perturbation_infos_unsorted_stage3.copy(), key = lambda x : x.image_name) ###
         llffhold = 8
         if eval:
             train_cam_infos = [c for idx, c in enumerate(cam_infos) if idx % llffhold != 0]
             test_cam_infos = [c for idx, c in enumerate(cam_infos) if idx % llffhold == 0]
-            perturbation_cam_infos = cam_perturbation_infos ###
         else:
             train_cam_infos = cam_infos
             test_cam_infos = []
-            perturbation_cam_infos = cam_perturbation_infos ###
         nerf_normalization = getNerfppNorm(train_cam_infos)
         # #random initialization (comment for using the input pcd)
         # num_pts = 100000
@@ -155,9 +132,6 @@ def get_info_from_params(source_path, pano_img, distances, rot_w2c, fx, fy, cx,
         scene_info = SceneInfo(point_cloud=pcd,
                            train_cameras=train_cam_infos,
                            test_cameras=test_cam_infos,
-                           perturbation_cameras_stage1=perturbation_cam_infos, ###
-                           perturbation_cameras_stage2=cam_perturbation_infos_stage2, ###
-                           perturbation_cameras_stage3=cam_perturbation_infos_stage3, ###
                            nerf_normalization=nerf_normalization,
                            ply_path=ply_path)
 
@@ -173,6 +147,7 @@ class Scene:
         :param path: Path to colmap scene main folder.
         """
         self.model_path = args.model_path
+        self.save_compact = getattr(args, "save_compact", False)
         self.loaded_iter = None
         self.gaussians = gaussians
 
@@ -185,9 +160,6 @@ class Scene:
 
         self.train_cameras = {}
         self.test_cameras = {}
-        self.perturbation_cameras_stage1 = {} ###
-        self.perturbation_cameras_stage2 = {} ###
-        self.perturbation_cameras_stage3 = {} ###
 
         ## Change loading multi views data to pano ###
         if os.path.exists(os.path.join(args.source_path, "sparse")):
@@ -203,7 +175,6 @@ class Scene:
                 img_path = os.path.join(args.source_path, files[0]) ### only 1 pano image in the folder
                 img = read_image(img_path, to_torch=True, squeeze=True).cuda()
             elif (any(filename.endswith('.txt') for filename in os.listdir(args.source_path))):
-                sdk = importlib.import_module('stitch_diffusion.kohya_trainer.StitchDiffusionPipeline')
                 imgrun = importlib.import_module('Text2PanoRunner')
                 if (self_refinement):
                     assert api_key, "You must enter an api key to access prompt engineered diffusion output"
@@ -213,9 +184,8 @@ class Scene:
                     img_name = "self_refinement/" + txtfile.rstrip(".txt") + "/iter_best/image.png"
                     os.system("cp " + img_name + " " + os.path.join(args.source_path, "image.png"))
                 else:
-                    sd = sdk.StitchDiffusion(
-                        sdk.my_args
-                        )
+                    # Kept loaded, so that a process generating several scenes builds the pipeline once
+                    sd = get_model('stitch_diffusion')
                     txtfile = [f for f in os.listdir(args.source_path) if f.endswith('.txt')][0]
                     txtfile = os.path.join(args.source_path, txtfile)
                     with open(txtfile) as f:
@@ -230,12 +200,17 @@ class Scene:
             img = cv.resize(img.cpu().numpy(), (2048, 1024), cv.INTER_AREA)
             img = torch.from_numpy(img).cuda()
             
-            geo_predictor = PanoGeoPredictor()
+            geo_predictor = PanoGeoPredictor(depth_batch_size=getattr(args, "depth_batch_size", 8),
+                                             view_selection=getattr(args, "view_selection", "all"),
+                                             num_views=getattr(args, "num_views", 0),
+                                             fit_patience=getattr(args, "geo_fit_patience", 0),
+                                             fit_rel_tol=getattr(args, "geo_fit_rel_tol", 1e-3),
+                                             fit_check_interval=getattr(args, "geo_fit_check_interval", 50))
             height, width, _ = img.shape
             distances, rot_w2c, fx, fy, cx, cy, pers_imgs = geo_predictor(img)
             pts = pcd_from_depths(img, distances, height, width, args.source_path)
             print('Saving data for future use...')
-            save_data(args.source_path, img, distances, rot_w2c, fx, fy, cx, cy, pers_imgs, pts)
+            save_data(args.source_path, img, distances, rot_w2c, fx, fy, cx, cy, pers_imgs, pts, metadata={"geo_fit": geo_predictor.fit_stats})
             scene_info = get_info_from_params(args.source_path, img, distances, rot_w2c, fx, fy, cx, cy, pers_imgs, pts)
 
         else:
@@ -259,9 +234,6 @@ class Scene:
         if shuffle:
             random.shuffle(scene_info.train_cameras)  # Multi-res consistent random shuffling
             random.shuffle(scene_info.test_cameras)  # Multi-res consistent random shuffling
-            random.shuffle(scene_info.perturbation_cameras_stage1)  ###
-            random.shuffle(scene_info.perturbation_cameras_stage2)  ###
-            random.shuffle(scene_info.perturbation_cameras_stage3)  ###
 
         self.cameras_extent = scene_info.nerf_normalization["radius"]
 
@@ -270,22 +242,21 @@ class Scene:
             self.train_cameras[resolution_scale] = cameraList_from_camInfos(scene_info.train_cameras, resolution_scale, args)
             print("Loading Test Cameras")
             self.test_cameras[resolution_scale] = cameraList_from_camInfos(scene_info.test_cameras, resolution_scale, args)
-            print("Loading Perturbation Cameras") ###
-            self.perturbation_cameras_stage1[resolution_scale] = cameraList_from_camInfos(scene_info.perturbation_cameras_stage1, resolution_scale, args)
-            self.perturbation_cameras_stage2[resolution_scale] = cameraList_from_camInfos(scene_info.perturbation_cameras_stage2, resolution_scale, args)
-            self.perturbation_cameras_stage3[resolution_scale] = cameraList_from_camInfos(scene_info.perturbation_cameras_stage3, resolution_scale, args)
 
         if self.loaded_iter:
-            self.gaussians.load_ply(os.path.join(self.model_path,
-                                                           "point_cloud",
-                                                           "iteration_" + str(self.loaded_iter),
-                                                           "point_cloud.ply"))
+            point_cloud_path = os.path.join(self.model_path, "point_cloud", "iteration_" + str(self.loaded_iter))
+            if os.path.exists(os.path.join(point_cloud_path, "point_cloud.ply")):
+                self.gaussians.load_ply(os.path.join(point_cloud_path, "point_cloud.ply"))
+            else:
+                self.gaussians.load_compact(os.path.join(point_cloud_path, "point_cloud.gsc"))
         else:
             self.gaussians.create_from_pcd(scene_info.point_cloud, self.cameras_extent)
 
-    def save(self, iteration):
+    def save(self, iteration, writer=None):
         point_cloud_path = os.path.join(self.model_path, "point_cloud/iteration_{}".format(iteration))
-        self.gaussians.save_ply(os.path.join(point_cloud_path, "point_cloud.ply"))
+        self.gaussians.save_ply(os.path.join(point_cloud_path, "point_cloud.ply"), writer)
+        if self.save_compact:
+            self.gaussians.save_compact(os.path.join(point_cloud_path, "point_cloud.gsc"), writer)
 
     def getTrainCameras(self, scale=1.0):
         return self.train_cameras[scale]
@@ -293,10 +264,6 @@ class Scene:
     def getTestCameras(self, scale=1.0):
         return self.test_cameras[scale]
 
-    def getPerturbationCameras(self, stage, scale=1.0): ###
-        if stage == 1:
-            return self.perturbation_cameras_stage1[scale]
-        elif stage == 2:
-            return self.perturbation_cameras_stage2[scale]
-        elif stage == 3:
-            return self.perturbation_cameras_stage3[scale]
\ No newline at end of file
+    def getPerturbationCurriculum(self, schedule=DEFAULT_PERTURBATION_SCHEDULE, magnitude=0.05, scale=1.0): ###
+        # Perturbed views are derived from the training cameras on demand
+        return PerturbationCurriculum(self.getTrainCameras(scale), schedule, magnitude)
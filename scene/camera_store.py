@@ -0,0 +1,74 @@
+import torch
+from utils.general_utils import default_device
+
+class CameraStore:
+    """
+    Serves the ground truth images and depth maps of a set of cameras on the
+    training device.
+
+    With pin=True (data_device "pinned") the host copies of all cameras are
+    packed into one contiguous pinned tensor per resolution and the cameras'
+    original_image / depth_image become views into it. prefetch(camera) then
+    starts the upload of a camera on a side CUDA stream, so that by the time
+    fetch(camera) is called for it the copy has overlapped with the previous
+    training step. Cameras that already live on the device are returned as is.
+    Perturbed cameras share the tensors of their base camera and are served
+    through it.
+    """
+    def __init__(self, cameras, pin=False, device=None):
+        self.device = torch.device(device) if device is not None else default_device()
+        if self.device.type == "cuda" and self.device.index is None:
+            # Tensors report their device with an index, "cuda" alone never compares equal to it
+            self.device = torch.device("cuda", torch.cuda.current_device())
+        self._stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+        self._pending = {}
+        self.storage = []
+        if pin and self._stream is not None:
+            self._pack(cameras, "original_image")
+            self._pack(cameras, "depth_image")
+
+    def _pack(self, cameras, attribute):
+        # Deduplicate, the same camera may be listed more than once
+        cameras = list({id(cam): cam for cam in cameras if getattr(cam, attribute, None) is not None}.values())
+        groups = {}
+        for cam in cameras:
+            tensor = getattr(cam, attribute)
+            groups.setdefault((tuple(tensor.shape), tensor.dtype), []).append(cam)
+        for (shape, dtype), group in groups.items():
+            storage = torch.empty((len(group),) + shape, dtype=dtype, pin_memory=True)
+            for idx, cam in enumerate(group):
+                storage[idx].copy_(getattr(cam, attribute))
+                setattr(cam, attribute, storage[idx])
+            self.storage.append(storage)
+
+    def _upload(self, tensor):
+        if tensor is None:
+            return None
+        return tensor.to(self.device, non_blocking=True)
+
+    def prefetch(self, camera):
+        """Starts copying camera's image and depth to the device."""
+        camera = getattr(camera, "base", camera)
+        if self._stream is None or id(camera) in self._pending or camera.original_image.device == self.device:
+            return
+        with torch.cuda.stream(self._stream):
+            tensors = (self._upload(camera.original_image), self._upload(camera.depth_image))
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        self._pending[id(camera)] = (tensors, event)
+
+    def fetch(self, camera):
+        """Returns (image, depth) of camera on the device."""
+        camera = getattr(camera, "base", camera)
+        pending = self._pending.pop(id(camera), None)
+        if pending is None:
+            return self._upload(camera.original_image), self._upload(camera.depth_image)
+
+        tensors, event = pending
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(event)
+        for tensor in tensors:
+            if tensor is not None:
+                # Allocated on the side stream, keep it alive until the main stream is done with it
+                tensor.record_stream(stream)
+        return tensors
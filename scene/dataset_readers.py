@@ -39,9 +39,6 @@ class SceneInfo(NamedTuple):
     point_cloud: BasicPointCloud
     train_cameras: list
     test_cameras: list
-    perturbation_cameras_stage1: list ###
-    perturbation_cameras_stage2: list ###
-    perturbation_cameras_stage3: list ### 
     nerf_normalization: dict
     ply_path: str
 
@@ -106,49 +103,6 @@ def readColmapCameras(cam_extrinsics, cam_intrinsics, images_folder):
         cam_infos.append(cam_info)
     sys.stdout.write('\n')
     return cam_infos
-### added a function
-def generatePerturbationCamera(cam_extrinsics, cam_intrinsics, images_folder, perturbation):
-    cam_infos = []
-    for idx, key in enumerate(cam_extrinsics):
-        sys.stdout.write('\r')
-        # the exact output you're looking for:
-        sys.stdout.write("Reading perturbation camera {}/{}".format(idx+1, len(cam_extrinsics)))
-        sys.stdout.flush()
-
-        extr = cam_extrinsics[key]
-        intr = cam_intrinsics[extr.camera_id]
-        height = intr.height
-        width = intr.width
-
-        uid = intr.id
-        R = np.transpose(qvec2rotmat(extr.qvec))
-        T = np.array(extr.tvec)
-        ###
-        T = T + np.random.uniform(-0.05 * perturbation, 0.05 * perturbation, size=(1, 3))  ### T perturbation
-        ###
-
-        if intr.model=="SIMPLE_PINHOLE":
-            focal_length_x = intr.params[0]
-            FovY = focal2fov(focal_length_x, height)
-            FovX = focal2fov(focal_length_x, width)
-        elif intr.model=="PINHOLE":
-            focal_length_x = intr.params[0]
-            focal_length_y = intr.params[1]
-            FovY = focal2fov(focal_length_y, height)
-            FovX = focal2fov(focal_length_x, width)
-        else:
-            assert False, "Colmap camera model not handled: only undistorted datasets (PINHOLE or SIMPLE_PINHOLE cameras) supported!"
-
-        image_path = os.path.join(images_folder, os.path.basename(extr.name))
-        image_name = os.path.basename(image_path).split(".")[0]
-        image = Image.open(image_path)
-
-        cam_info = CameraInfo(uid=uid, R=R, T=T, FovY=FovY, FovX=FovX, image=image,
-                              image_path=image_path, image_name=image_name, width=width, height=height)
-        cam_infos.append(cam_info)
-    sys.stdout.write('\n')
-    return cam_infos
-###
 
 def fetchPly(path):
     plydata = PlyData.read(path)
@@ -196,15 +150,6 @@ def readColmapSceneInfo(path, images, eval, llffhold=8):
     cam_infos_unsorted = readColmapCameras(cam_extrinsics=cam_extrinsics, cam_intrinsics=cam_intrinsics, images_folder=os.path.join(path, reading_dir))
     cam_infos = sorted(cam_infos_unsorted.copy(), key = lambda x : x.image_name)
 
-    ### sort perturbation camera infos
-    perturbation_cam_infos_unsorted_stage1 = generatePerturbationCamera(cam_extrinsics=cam_extrinsics, cam_intrinsics=cam_intrinsics, images_folder=os.path.join(path, reading_dir), perturbation = 1)
-    perturbation_cam_infos_stage1 = sorted(perturbation_cam_infos_unsorted_stage1.copy(), key = lambda x : x.image_name)
-    perturbation_cam_infos_unsorted_stage2 = generatePerturbationCamera(cam_extrinsics=cam_extrinsics, cam_intrinsics=cam_intrinsics, images_folder=os.path.join(path, reading_dir), perturbation = 2)
-    perturbation_cam_infos_stage2 = sorted(perturbation_cam_infos_unsorted_stage2.copy(), key = lambda x : x.image_name)
-    perturbation_cam_infos_unsorted_stage3 = generatePerturbationCamera(cam_extrinsics=cam_extrinsics, cam_intrinsics=cam_intrinsics, images_folder=os.path.join(path, reading_dir), perturbation = 4)
-    perturbation_cam_infos_stage3 = sorted(perturbation_cam_infos_unsorted_stage3.copy(), key = lambda x : x.image_name)
-
-
     if eval:
         train_cam_infos = [c for idx, c in enumerate(cam_infos) if idx % llffhold != 0]
         test_cam_infos = [c for idx, c in enumerate(cam_infos) if idx % llffhold == 0]
@@ -242,9 +187,6 @@ def readColmapSceneInfo(path, images, eval, llffhold=8):
     scene_info = SceneInfo(point_cloud=pcd,
                            train_cameras=train_cam_infos,
                            test_cameras=test_cam_infos,
-                           perturbation_cameras_stage1=perturbation_cam_infos_stage1, ###
-                           perturbation_cameras_stage2=perturbation_cam_infos_stage2, ###
-                           perturbation_cameras_stage3=perturbation_cam_infos_stage3, ###
                            nerf_normalization=nerf_normalization,
                            ply_path=ply_path)
     return scene_info
@@ -11,16 +11,37 @@
 
 import torch
 import numpy as np
-from utils.general_utils import inverse_sigmoid, get_expon_lr_func, build_rotation
+from utils.general_utils import inverse_sigmoid, get_expon_lr_func, build_rotation, default_device
 from torch import nn
 import os
 from utils.system_utils import mkdir_p
-from plyfile import PlyData, PlyElement
+from utils.ply_utils import write_vertex_ply, read_vertex_ply, column_indices
+from utils.compact_utils import write_compact, CompactReader, GAUSSIAN_SECTIONS
+from utils.morton_utils import morton_order
+from utils.capacity_utils import CapacityBuffer
 from utils.sh_utils import RGB2SH
-from simple_knn._C import distCUDA2
+try:
+    from simple_knn._C import distCUDA2
+except ImportError:
+    distCUDA2 = None
 from utils.graphics_utils import BasicPointCloud
 from utils.general_utils import strip_symmetric, build_scaling_rotation
 
+def mean_neighbour_dist2(points, chunk_size=4096):
+    """
+    Mean squared distance of every point to its 3 nearest neighbours. Uses
+    simple_knn on the GPU and a chunked brute-force search otherwise.
+    """
+    if distCUDA2 is not None and points.is_cuda:
+        return distCUDA2(points)
+    dist2 = []
+    for start in range(0, points.shape[0], chunk_size):
+        d = torch.cdist(points[start:start + chunk_size], points).pow(2)
+        k = min(4, points.shape[0])
+        # The closest point is the point itself
+        dist2.append(torch.topk(d, k, dim=1, largest=False).values[:, 1:].mean(dim=1))
+    return torch.cat(dist2)
+
 class GaussianModel:
 
     def setup_functions(self):
@@ -41,7 +62,8 @@ class GaussianModel:
         self.rotation_activation = torch.nn.functional.normalize
 
 
-    def __init__(self, sh_degree : int):
+    def __init__(self, sh_degree : int, device = None):
+        self.device = torch.device(device) if device is not None else default_device()
         self.active_sh_degree = 0
         self.max_sh_degree = sh_degree  
         self._xyz = torch.empty(0)
@@ -56,6 +78,11 @@ class GaussianModel:
         self.optimizer = None
         self.percent_dense = 0
         self.spatial_lr_scale = 0
+        # Capacity buffers backing the parameters, Adam moments and statistics
+        # when OptimizationParams.capacity_buffers is set, None otherwise
+        self._buffers = None
+        self._state_buffers = None
+        self._stat_buffers = None
         self.setup_functions()
 
     def capture(self):
@@ -76,21 +103,32 @@ class GaussianModel:
     
     def restore(self, model_args, training_args):
         (self.active_sh_degree, 
-        self._xyz, 
-        self._features_dc, 
-        self._features_rest,
-        self._scaling, 
-        self._rotation, 
-        self._opacity,
-        self.max_radii2D, 
+        xyz, 
+        features_dc, 
+        features_rest,
+        scaling, 
+        rotation, 
+        opacity,
+        max_radii2D, 
         xyz_gradient_accum, 
         denom,
         opt_dict, 
         self.spatial_lr_scale) = model_args
+        # Checkpoints written in the background hold plain host tensors
+        self._xyz = nn.Parameter(xyz.detach().to(self.device).requires_grad_(True))
+        self._features_dc = nn.Parameter(features_dc.detach().to(self.device).requires_grad_(True))
+        self._features_rest = nn.Parameter(features_rest.detach().to(self.device).requires_grad_(True))
+        self._scaling = nn.Parameter(scaling.detach().to(self.device).requires_grad_(True))
+        self._rotation = nn.Parameter(rotation.detach().to(self.device).requires_grad_(True))
+        self._opacity = nn.Parameter(opacity.detach().to(self.device).requires_grad_(True))
+        self.max_radii2D = max_radii2D.to(self.device)
         self.training_setup(training_args)
-        self.xyz_gradient_accum = xyz_gradient_accum
-        self.denom = denom
+        self.xyz_gradient_accum = xyz_gradient_accum.to(self.device)
+        self.denom = denom.to(self.device)
         self.optimizer.load_state_dict(opt_dict)
+        if self._buffers is not None:
+            # Move the restored tensors into the buffers
+            self.setup_capacity_buffers(self._buffers["xyz"].growth)
 
     @property
     def get_scaling(self):
@@ -123,20 +161,20 @@ class GaussianModel:
 
     def create_from_pcd(self, pcd : BasicPointCloud, spatial_lr_scale : float):
         self.spatial_lr_scale = spatial_lr_scale
-        fused_point_cloud = torch.tensor(np.asarray(pcd.points)).float().cuda()
-        fused_color = RGB2SH(torch.tensor(np.asarray(pcd.colors)).float().cuda())
-        features = torch.zeros((fused_color.shape[0], 3, (self.max_sh_degree + 1) ** 2)).float().cuda()
+        fused_point_cloud = torch.tensor(np.asarray(pcd.points)).float().to(self.device)
+        fused_color = RGB2SH(torch.tensor(np.asarray(pcd.colors)).float().to(self.device))
+        features = torch.zeros((fused_color.shape[0], 3, (self.max_sh_degree + 1) ** 2)).float().to(self.device)
         features[:, :3, 0 ] = fused_color
         features[:, 3:, 1:] = 0.0
 
         print("Number of points at initialisation : ", fused_point_cloud.shape[0])
 
-        dist2 = torch.clamp_min(distCUDA2(torch.from_numpy(np.asarray(pcd.points)).float().cuda()), 0.0000001)
+        dist2 = torch.clamp_min(mean_neighbour_dist2(torch.from_numpy(np.asarray(pcd.points)).float().to(self.device)), 0.0000001)
         scales = torch.log(torch.sqrt(dist2))[...,None].repeat(1, 3)
-        rots = torch.zeros((fused_point_cloud.shape[0], 4), device="cuda")
+        rots = torch.zeros((fused_point_cloud.shape[0], 4), device=self.device)
         rots[:, 0] = 1
 
-        opacities = inverse_sigmoid(0.1 * torch.ones((fused_point_cloud.shape[0], 1), dtype=torch.float, device="cuda"))
+        opacities = inverse_sigmoid(0.1 * torch.ones((fused_point_cloud.shape[0], 1), dtype=torch.float, device=self.device))
 
         self._xyz = nn.Parameter(fused_point_cloud.requires_grad_(True))
         self._features_dc = nn.Parameter(features[:,:,0:1].transpose(1, 2).contiguous().requires_grad_(True))
@@ -144,12 +182,12 @@ class GaussianModel:
         self._scaling = nn.Parameter(scales.requires_grad_(True))
         self._rotation = nn.Parameter(rots.requires_grad_(True))
         self._opacity = nn.Parameter(opacities.requires_grad_(True))
-        self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device="cuda")
+        self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device=self.device)
 
     def training_setup(self, training_args):
         self.percent_dense = training_args.percent_dense
-        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
+        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device=self.device)
+        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device=self.device)
 
         l = [
             {'params': [self._xyz], 'lr': training_args.position_lr_init * self.spatial_lr_scale, "name": "xyz"},
@@ -166,6 +204,10 @@ class GaussianModel:
                                                     lr_delay_mult=training_args.position_lr_delay_mult,
                                                     max_steps=training_args.position_lr_max_steps)
 
+        self._buffers = None
+        if getattr(training_args, "capacity_buffers", False):
+            self.setup_capacity_buffers(training_args.capacity_growth)
+
     def update_learning_rate(self, iteration):
         ''' Learning rate scheduling per step '''
         for param_group in self.optimizer.param_groups:
@@ -188,74 +230,219 @@ class GaussianModel:
             l.append('rot_{}'.format(i))
         return l
 
-    def save_ply(self, path):
-        mkdir_p(os.path.dirname(path))
+    def ply_tensors(self):
+        """
+        Detached [N, k] tensors in the attribute order of
+        construct_list_of_attributes, without the (zero) normals.
+        """
+        return (
+            self._xyz.detach(),
+            self._features_dc.detach().transpose(1, 2).flatten(start_dim=1).contiguous(),
+            self._features_rest.detach().transpose(1, 2).flatten(start_dim=1).contiguous(),
+            self._opacity.detach(),
+            self._scaling.detach(),
+            self._rotation.detach(),
+        )
+
+    @staticmethod
+    def write_ply(path, attribute_names, xyz, f_dc, f_rest, opacities, scale, rotation):
+        columns = [t.cpu().numpy() if torch.is_tensor(t) else t for t in (xyz, f_dc, f_rest, opacities, scale, rotation)]
+        normals = np.zeros_like(columns[0])
+        write_vertex_ply(path, attribute_names, [columns[0], normals] + columns[1:])
+
+    def save_ply(self, path, writer=None):
+        """
+        Writes the model to a PLY file. With an AsyncWriter the tensors are
+        snapshotted immediately and written in the background.
+        """
+        attribute_names = self.construct_list_of_attributes()
+        write_fn = lambda out_path, tensors: GaussianModel.write_ply(out_path, attribute_names, *tensors)
+        if writer is not None:
+            writer.submit(path, self.ply_tensors(), write_fn)
+            return
 
-        xyz = self._xyz.detach().cpu().numpy()
-        normals = np.zeros_like(xyz)
-        f_dc = self._features_dc.detach().transpose(1, 2).flatten(start_dim=1).contiguous().cpu().numpy()
-        f_rest = self._features_rest.detach().transpose(1, 2).flatten(start_dim=1).contiguous().cpu().numpy()
-        opacities = self._opacity.detach().cpu().numpy()
-        scale = self._scaling.detach().cpu().numpy()
-        rotation = self._rotation.detach().cpu().numpy()
+        mkdir_p(os.path.dirname(path))
+        write_fn(path, self.ply_tensors())
+
+    def save_compact(self, path, writer=None):
+        """
+        Writes the model to the compact .gsc container: half precision
+        positions, scales and rotations, 8-bit opacity and SH coefficients, no
+        normals. Positions are stored relative to the bounding box centre.
+        """
+        center = ((self._xyz.detach().min(dim=0).values + self._xyz.detach().max(dim=0).values) / 2).tolist() if self._xyz.shape[0] > 0 else [0.0, 0.0, 0.0]
+        metadata = {"sh_degree": self.max_sh_degree, "xyz_offset": center}
+        xyz, f_dc, f_rest, _, scale, rotation = self.ply_tensors()
+        tensors = (xyz - torch.tensor(center, device=xyz.device), f_dc, f_rest, self.get_opacity.detach(), scale, rotation)
+
+        def write_fn(out_path, host_tensors):
+            sections = {name: (t.numpy(), GAUSSIAN_SECTIONS[name]) for name, t in zip(GAUSSIAN_SECTIONS, host_tensors)}
+            write_compact(out_path, sections, metadata)
+
+        if writer is not None:
+            writer.submit(path, tensors, write_fn)
+            return
 
-        dtype_full = [(attribute, 'f4') for attribute in self.construct_list_of_attributes()]
+        mkdir_p(os.path.dirname(path))
+        write_fn(path, [t.cpu() for t in tensors])
+
+    def decode_compact(self, reader, row_ranges=None):
+        """
+        Decodes a CompactReader (or only its (start, count) row ranges) into
+        pre-activation (xyz, features_dc, features_rest, opacity, scaling,
+        rotation) tensors, as taken by set_parameters.
+        """
+        assert reader.metadata["sh_degree"] == self.max_sh_degree, "{} holds SH degree {}, model uses {}".format(reader.path, reader.metadata["sh_degree"], self.max_sh_degree)
+
+        def load(name):
+            data = reader.section(name) if row_ranges is None else reader.gather(name, row_ranges)
+            return torch.from_numpy(data).to(self.device)
+
+        xyz = load("xyz") + torch.tensor(reader.metadata["xyz_offset"], device=self.device)
+        num_points = xyz.shape[0]
+        features_dc = load("f_dc").reshape(num_points, 3, 1).transpose(1, 2)
+        features_extra = load("f_rest").reshape(num_points, 3, (self.max_sh_degree + 1) ** 2 - 1).transpose(1, 2)
+        # Opacity is quantized after the activation, where 8 bits are spent evenly over [0, 1]
+        opacities = inverse_sigmoid(load("opacity").clamp(1e-4, 1 - 1e-4))
+        return xyz, features_dc, features_extra, opacities, load("scaling"), load("rotation")
+
+    def load_compact(self, path, row_ranges=None):
+        """
+        Loads the model from a .gsc file, or only the (start, count) row ranges
+        in row_ranges when given.
+        """
+        self.set_parameters(*self.decode_compact(CompactReader(path), row_ranges))
+
+    def set_parameters(self, xyz, features_dc, features_rest, opacity, scaling, rotation):
+        self._xyz = nn.Parameter(xyz.to(self.device).contiguous().requires_grad_(True))
+        self._features_dc = nn.Parameter(features_dc.to(self.device).contiguous().requires_grad_(True))
+        self._features_rest = nn.Parameter(features_rest.to(self.device).contiguous().requires_grad_(True))
+        self._opacity = nn.Parameter(opacity.to(self.device).contiguous().requires_grad_(True))
+        self._scaling = nn.Parameter(scaling.to(self.device).contiguous().requires_grad_(True))
+        self._rotation = nn.Parameter(rotation.to(self.device).contiguous().requires_grad_(True))
 
-        elements = np.empty(xyz.shape[0], dtype=dtype_full)
-        attributes = np.concatenate((xyz, normals, f_dc, f_rest, opacities, scale, rotation), axis=1)
-        elements[:] = list(map(tuple, attributes))
-        el = PlyElement.describe(elements, 'vertex')
-        PlyData([el]).write(path)
+        self.active_sh_degree = self.max_sh_degree
 
     def reset_opacity(self):
         opacities_new = inverse_sigmoid(torch.min(self.get_opacity, torch.ones_like(self.get_opacity)*0.01))
         optimizable_tensors = self.replace_tensor_to_optimizer(opacities_new, "opacity")
         self._opacity = optimizable_tensors["opacity"]
 
-    def load_ply(self, path):
-        plydata = PlyData.read(path)
-
-        xyz = np.stack((np.asarray(plydata.elements[0]["x"]),
-                        np.asarray(plydata.elements[0]["y"]),
-                        np.asarray(plydata.elements[0]["z"])),  axis=1)
-        opacities = np.asarray(plydata.elements[0]["opacity"])[..., np.newaxis]
-
-        features_dc = np.zeros((xyz.shape[0], 3, 1))
-        features_dc[:, 0, 0] = np.asarray(plydata.elements[0]["f_dc_0"])
-        features_dc[:, 1, 0] = np.asarray(plydata.elements[0]["f_dc_1"])
-        features_dc[:, 2, 0] = np.asarray(plydata.elements[0]["f_dc_2"])
-
-        extra_f_names = [p.name for p in plydata.elements[0].properties if p.name.startswith("f_rest_")]
-        extra_f_names = sorted(extra_f_names, key = lambda x: int(x.split('_')[-1]))
-        assert len(extra_f_names)==3*(self.max_sh_degree + 1) ** 2 - 3
-        features_extra = np.zeros((xyz.shape[0], len(extra_f_names)))
-        for idx, attr_name in enumerate(extra_f_names):
-            features_extra[:, idx] = np.asarray(plydata.elements[0][attr_name])
-        # Reshape (P,F*SH_coeffs) to (P, F, SH_coeffs except DC)
-        features_extra = features_extra.reshape((features_extra.shape[0], 3, (self.max_sh_degree + 1) ** 2 - 1))
-
-        scale_names = [p.name for p in plydata.elements[0].properties if p.name.startswith("scale_")]
-        scale_names = sorted(scale_names, key = lambda x: int(x.split('_')[-1]))
-        scales = np.zeros((xyz.shape[0], len(scale_names)))
-        for idx, attr_name in enumerate(scale_names):
-            scales[:, idx] = np.asarray(plydata.elements[0][attr_name])
-
-        rot_names = [p.name for p in plydata.elements[0].properties if p.name.startswith("rot")]
-        rot_names = sorted(rot_names, key = lambda x: int(x.split('_')[-1]))
-        rots = np.zeros((xyz.shape[0], len(rot_names)))
-        for idx, attr_name in enumerate(rot_names):
-            rots[:, idx] = np.asarray(plydata.elements[0][attr_name])
-
-        self._xyz = nn.Parameter(torch.tensor(xyz, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._features_dc = nn.Parameter(torch.tensor(features_dc, dtype=torch.float, device="cuda").transpose(1, 2).contiguous().requires_grad_(True))
-        self._features_rest = nn.Parameter(torch.tensor(features_extra, dtype=torch.float, device="cuda").transpose(1, 2).contiguous().requires_grad_(True))
-        self._opacity = nn.Parameter(torch.tensor(opacities, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._scaling = nn.Parameter(torch.tensor(scales, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._rotation = nn.Parameter(torch.tensor(rots, dtype=torch.float, device="cuda").requires_grad_(True))
+    def load_ply(self, path, mmap=False, chunk_size=1 << 20):
+        """
+        Loads the model from a PLY file. With mmap the file is memory mapped and
+        streamed into the parameter tensors chunk_size points at a time, which
+        bounds host memory for very large scenes.
+        """
+        names, data = read_vertex_ply(path, mmap=mmap)
+        num_points = data.shape[0]
+
+        extra_f_idx = column_indices(names, "f_rest_")
+        assert len(extra_f_idx)==3*(self.max_sh_degree + 1) ** 2 - 3
+        layout = {
+            "xyz": [names.index("x"), names.index("y"), names.index("z")],
+            "f_dc": column_indices(names, "f_dc_"),
+            "f_rest": extra_f_idx,
+            "opacity": [names.index("opacity")],
+            "scaling": column_indices(names, "scale_"),
+            "rotation": column_indices(names, "rot_"),
+        }
+        tensors = {key: torch.empty((num_points, len(idx)), dtype=torch.float, device=self.device) for key, idx in layout.items()}
+        step = chunk_size if mmap else max(num_points, 1)
+        for start in range(0, num_points, step):
+            rows = np.asarray(data[start:start + step])
+            for key, idx in layout.items():
+                tensors[key][start:start + rows.shape[0]] = torch.from_numpy(np.ascontiguousarray(rows[:, idx]))
+        del data
+
+        # Reshape (P,F*SH_coeffs) to (P, SH_coeffs, F)
+        features_dc = tensors["f_dc"].reshape(num_points, 3, 1).transpose(1, 2)
+        features_extra = tensors["f_rest"].reshape(num_points, 3, (self.max_sh_degree + 1) ** 2 - 1).transpose(1, 2)
+
+        self._xyz = nn.Parameter(tensors["xyz"].requires_grad_(True))
+        self._features_dc = nn.Parameter(features_dc.contiguous().requires_grad_(True))
+        self._features_rest = nn.Parameter(features_extra.contiguous().requires_grad_(True))
+        self._opacity = nn.Parameter(tensors["opacity"].requires_grad_(True))
+        self._scaling = nn.Parameter(tensors["scaling"].requires_grad_(True))
+        self._rotation = nn.Parameter(tensors["rotation"].requires_grad_(True))
 
         self.active_sh_degree = self.max_sh_degree
 
+    _param_attributes = {"xyz": "_xyz", "f_dc": "_features_dc", "f_rest": "_features_rest",
+                         "opacity": "_opacity", "scaling": "_scaling", "rotation": "_rotation"}
+    _stat_attributes = ("xyz_gradient_accum", "denom", "max_radii2D")
+
+    def setup_capacity_buffers(self, growth=1.5):
+        """
+        Moves the parameters, their Adam moments and the densification
+        statistics into CapacityBuffers. Parameters and statistics then are
+        views of the first N rows of preallocated storage: densification
+        appends in place, growing the storage geometrically when it is full,
+        and pruning gathers the surviving rows into the buffer's second
+        storage, so neither allocates in the steady state.
+        """
+        self._buffers = {}
+        for group in self.optimizer.param_groups:
+            self._buffers[group["name"]] = CapacityBuffer(group["params"][0].detach(), growth)
+        self._stat_buffers = {name: CapacityBuffer(getattr(self, name), growth) for name in self._stat_attributes}
+        self._state_buffers = {}
+        self._sync_state_buffers()
+        self._refresh_views()
+
+    def _sync_state_buffers(self):
+        # Adam creates its moments lazily on the first step and load_state_dict
+        # replaces them, adopt any moment that is not a view of its buffer yet
+        for group in self.optimizer.param_groups:
+            stored_state = self.optimizer.state.get(group['params'][0], None)
+            if stored_state is None or "exp_avg" not in stored_state:
+                continue
+            buffers = self._state_buffers.get(group["name"])
+            if buffers is None or not all(buffers[key].owns(stored_state[key]) for key in ("exp_avg", "exp_avg_sq")):
+                growth = self._buffers[group["name"]].growth
+                self._state_buffers[group["name"]] = {key: CapacityBuffer(stored_state[key], growth, self._buffers[group["name"]].capacity)
+                                                      for key in ("exp_avg", "exp_avg_sq")}
+
+    def _refresh_views(self):
+        # Re-wraps the active rows of every buffer after a change of size
+        for group in self.optimizer.param_groups:
+            name = group["name"]
+            stored_state = self.optimizer.state.pop(group['params'][0], None)
+            group["params"][0] = nn.Parameter(self._buffers[name].view)
+            if stored_state is not None:
+                if name in self._state_buffers:
+                    stored_state["exp_avg"] = self._state_buffers[name]["exp_avg"].view
+                    stored_state["exp_avg_sq"] = self._state_buffers[name]["exp_avg_sq"].view
+                self.optimizer.state[group["params"][0]] = stored_state
+            setattr(self, self._param_attributes[name], group["params"][0])
+        for name, buffer in self._stat_buffers.items():
+            setattr(self, name, buffer.view)
+
+    def _keep_capacity_rows(self, index, keep_grad=False):
+        self._sync_state_buffers()
+        grads = {}
+        for group in self.optimizer.param_groups:
+            if keep_grad and group["params"][0].grad is not None:
+                grads[group["name"]] = group["params"][0].grad[index]
+            self._buffers[group["name"]].keep(index)
+            for buffer in self._state_buffers.get(group["name"], {}).values():
+                buffer.keep(index)
+        for buffer in self._stat_buffers.values():
+            buffer.keep(index)
+        self._refresh_views()
+        for group in self.optimizer.param_groups:
+            if group["name"] in grads:
+                group["params"][0].grad = grads[group["name"]]
+        return {group["name"]: group["params"][0] for group in self.optimizer.param_groups}
+
     def replace_tensor_to_optimizer(self, tensor, name):
+        if self._buffers is not None:
+            self._sync_state_buffers()
+            with torch.no_grad():
+                self._buffers[name].view.copy_(tensor)
+                for buffer in self._state_buffers.get(name, {}).values():
+                    buffer.view.zero_()
+            return {name: getattr(self, self._param_attributes[name])}
+
         optimizable_tensors = {}
         for group in self.optimizer.param_groups:
             if group["name"] == name:
@@ -270,22 +457,31 @@ class GaussianModel:
                 optimizable_tensors[group["name"]] = group["params"][0]
         return optimizable_tensors
 
-    def _prune_optimizer(self, mask):
+    def _prune_optimizer(self, mask, keep_grad=False):
+        """
+        Indexes every parameter and its Adam moments with mask, which may be a
+        boolean mask or an index tensor. With keep_grad the pending gradients are
+        indexed too, so that the next optimizer step is not skipped.
+        """
+        if self._buffers is not None:
+            return self._keep_capacity_rows(mask, keep_grad)
+
         optimizable_tensors = {}
         for group in self.optimizer.param_groups:
-            stored_state = self.optimizer.state.get(group['params'][0], None)
+            param = group['params'][0]
+            stored_state = self.optimizer.state.get(param, None)
             if stored_state is not None:
                 stored_state["exp_avg"] = stored_state["exp_avg"][mask]
                 stored_state["exp_avg_sq"] = stored_state["exp_avg_sq"][mask]
 
-                del self.optimizer.state[group['params'][0]]
-                group["params"][0] = nn.Parameter((group["params"][0][mask].requires_grad_(True)))
+                del self.optimizer.state[param]
+                group["params"][0] = nn.Parameter((param[mask].requires_grad_(True)))
                 self.optimizer.state[group['params'][0]] = stored_state
-
-                optimizable_tensors[group["name"]] = group["params"][0]
             else:
-                group["params"][0] = nn.Parameter(group["params"][0][mask].requires_grad_(True))
-                optimizable_tensors[group["name"]] = group["params"][0]
+                group["params"][0] = nn.Parameter(param[mask].requires_grad_(True))
+            if keep_grad and param.grad is not None:
+                group["params"][0].grad = param.grad[mask]
+            optimizable_tensors[group["name"]] = group["params"][0]
         return optimizable_tensors
 
     def prune_points(self, mask):
@@ -299,12 +495,49 @@ class GaussianModel:
         self._scaling = optimizable_tensors["scaling"]
         self._rotation = optimizable_tensors["rotation"]
 
-        self.xyz_gradient_accum = self.xyz_gradient_accum[valid_points_mask]
+        if self._buffers is None:
+            self.xyz_gradient_accum = self.xyz_gradient_accum[valid_points_mask]
 
-        self.denom = self.denom[valid_points_mask]
-        self.max_radii2D = self.max_radii2D[valid_points_mask]
+            self.denom = self.denom[valid_points_mask]
+            self.max_radii2D = self.max_radii2D[valid_points_mask]
+
+    def reorder_points(self):
+        """
+        Sorts the Gaussians along the Morton curve of their positions, together
+        with their Adam moments, pending gradients and densification statistics.
+        Densification appends new points at the end, so over time neighbours in
+        space end up far apart in memory; this restores gather locality.
+        """
+        order, _ = morton_order(self._xyz.detach())
+        optimizable_tensors = self._prune_optimizer(order, keep_grad=True)
+
+        self._xyz = optimizable_tensors["xyz"]
+        self._features_dc = optimizable_tensors["f_dc"]
+        self._features_rest = optimizable_tensors["f_rest"]
+        self._opacity = optimizable_tensors["opacity"]
+        self._scaling = optimizable_tensors["scaling"]
+        self._rotation = optimizable_tensors["rotation"]
+
+        if self._buffers is None:
+            self.xyz_gradient_accum = self.xyz_gradient_accum[order]
+            self.denom = self.denom[order]
+            self.max_radii2D = self.max_radii2D[order]
+        return order
 
     def cat_tensors_to_optimizer(self, tensors_dict):
+        if self._buffers is not None:
+            self._sync_state_buffers()
+            for group in self.optimizer.param_groups:
+                extension_tensor = tensors_dict[group["name"]]
+                self._buffers[group["name"]].append(extension_tensor.detach())
+                for buffer in self._state_buffers.get(group["name"], {}).values():
+                    buffer.append_zeros(extension_tensor.shape[0])
+            # Statistics are reset by densification_postfix, only match the size here
+            for buffer in self._stat_buffers.values():
+                buffer.append_zeros(self._buffers["xyz"].size - buffer.size)
+            self._refresh_views()
+            return {group["name"]: group["params"][0] for group in self.optimizer.param_groups}
+
         optimizable_tensors = {}
         for group in self.optimizer.param_groups:
             assert len(group["params"]) == 1
@@ -342,21 +575,26 @@ class GaussianModel:
         self._scaling = optimizable_tensors["scaling"]
         self._rotation = optimizable_tensors["rotation"]
 
-        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device="cuda")
+        if self._buffers is not None:
+            for buffer in self._stat_buffers.values():
+                buffer.view.zero_()
+            return
+
+        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device=self.device)
+        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device=self.device)
+        self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device=self.device)
 
     def densify_and_split(self, grads, grad_threshold, scene_extent, N=2):
         n_init_points = self.get_xyz.shape[0]
         # Extract points that satisfy the gradient condition
-        padded_grad = torch.zeros((n_init_points), device="cuda")
+        padded_grad = torch.zeros((n_init_points), device=self.device)
         padded_grad[:grads.shape[0]] = grads.squeeze()
         selected_pts_mask = torch.where(padded_grad >= grad_threshold, True, False)
         selected_pts_mask = torch.logical_and(selected_pts_mask,
                                               torch.max(self.get_scaling, dim=1).values > self.percent_dense*scene_extent)
 
         stds = self.get_scaling[selected_pts_mask].repeat(N,1)
-        means =torch.zeros((stds.size(0), 3),device="cuda")
+        means =torch.zeros((stds.size(0), 3),device=self.device)
         samples = torch.normal(mean=means, std=stds)
         rots = build_rotation(self._rotation[selected_pts_mask]).repeat(N,1,1)
         new_xyz = torch.bmm(rots, samples.unsqueeze(-1)).squeeze(-1) + self.get_xyz[selected_pts_mask].repeat(N, 1)
@@ -368,7 +606,7 @@ class GaussianModel:
 
         self.densification_postfix(new_xyz, new_features_dc, new_features_rest, new_opacity, new_scaling, new_rotation)
 
-        prune_filter = torch.cat((selected_pts_mask, torch.zeros(N * selected_pts_mask.sum(), device="cuda", dtype=bool)))
+        prune_filter = torch.cat((selected_pts_mask, torch.zeros(N * selected_pts_mask.sum(), device=self.device, dtype=bool)))
         self.prune_points(prune_filter)
 
     def densify_and_clone(self, grads, grad_threshold, scene_extent):
@@ -386,22 +624,82 @@ class GaussianModel:
 
         self.densification_postfix(new_xyz, new_features_dc, new_features_rest, new_opacities, new_scaling, new_rotation)
 
-    def densify_and_prune(self, max_grad, min_opacity, extent, max_screen_size):
+    def densify_and_prune(self, max_grad, min_opacity, extent, max_screen_size, N=2):
+        """
+        Clones small and splits large Gaussians with a high view-space gradient,
+        then prunes transparent (and, with max_screen_size, too large) ones.
+
+        Equivalent to densify_and_clone, densify_and_split and prune_points in
+        sequence, but all masks are computed up front and the result is built
+        with a single gather per parameter and Adam moment instead of one
+        reallocation per stage. Returns the number of cloned, split and pruned
+        Gaussians as device tensors, so that reading them is left to the caller.
+        """
         grads = self.xyz_gradient_accum / self.denom
         grads[grads.isnan()] = 0.0
+        selected = torch.norm(grads, dim=-1) >= max_grad
+        max_scaling = self.get_scaling.max(dim=1).values
+        large = max_scaling > self.percent_dense*extent
+        clone_mask = torch.logical_and(selected, ~large)
+        split_mask = torch.logical_and(selected, large)
+
+        # Clones and split children inherit the opacity of their parent. The
+        # screen space criterion never applies: densification resets max_radii2D
+        # before pruning
+        prune_parent = (self.get_opacity < min_opacity).squeeze(-1)
+        prune_child = prune_parent
+        if max_screen_size:
+            prune_child = torch.logical_or(prune_parent, max_scaling / (0.8*N) > 0.1 * extent)
+            prune_parent = torch.logical_or(prune_parent, max_scaling > 0.1 * extent)
 
-        self.densify_and_clone(grads, max_grad, extent)
-        self.densify_and_split(grads, max_grad, extent)
+        keep_idx = torch.nonzero(torch.logical_and(~split_mask, ~prune_parent)).squeeze(1)
+        clone_idx = torch.nonzero(torch.logical_and(clone_mask, ~prune_parent)).squeeze(1)
+        split_idx = torch.nonzero(torch.logical_and(split_mask, ~prune_child)).squeeze(1)
 
-        prune_mask = (self.get_opacity < min_opacity).squeeze()
-        if max_screen_size:
-            big_points_vs = self.max_radii2D > max_screen_size
-            big_points_ws = self.get_scaling.max(dim=1).values > 0.1 * extent
-            prune_mask = torch.logical_or(torch.logical_or(prune_mask, big_points_vs), big_points_ws)
-        self.prune_points(prune_mask)
+        stds = self.get_scaling[split_idx].repeat(N,1)
+        means = torch.zeros((stds.size(0), 3),device=self.device)
+        samples = torch.normal(mean=means, std=stds)
+        rots = build_rotation(self._rotation[split_idx]).repeat(N,1,1)
+        new_xyz = torch.bmm(rots, samples.unsqueeze(-1)).squeeze(-1) + self.get_xyz[split_idx].repeat(N, 1)
+        new_scaling = self.scaling_inverse_activation(self.get_scaling[split_idx].repeat(N,1) / (0.8*N))
+
+        num_candidates = self.get_xyz.shape[0] + clone_mask.sum() + (N - 1) * split_mask.sum()
+        num_kept = keep_idx.shape[0]
+        num_split_start = num_kept + clone_idx.shape[0]
+        index = torch.cat((keep_idx, clone_idx, split_idx.repeat(N)))
 
-        torch.cuda.empty_cache()
+        optimizable_tensors = self._prune_optimizer(index)
+        self._xyz = optimizable_tensors["xyz"]
+        self._features_dc = optimizable_tensors["f_dc"]
+        self._features_rest = optimizable_tensors["f_rest"]
+        self._opacity = optimizable_tensors["opacity"]
+        self._scaling = optimizable_tensors["scaling"]
+        self._rotation = optimizable_tensors["rotation"]
+
+        with torch.no_grad():
+            self._xyz[num_split_start:] = new_xyz
+            self._scaling[num_split_start:] = new_scaling
+            # New Gaussians start with fresh Adam moments
+            for group in self.optimizer.param_groups:
+                stored_state = self.optimizer.state.get(group['params'][0], None)
+                if stored_state is not None:
+                    stored_state["exp_avg"][num_kept:] = 0
+                    stored_state["exp_avg_sq"][num_kept:] = 0
+
+        if self._buffers is not None:
+            for buffer in self._stat_buffers.values():
+                buffer.view.zero_()
+        else:
+            self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device=self.device)
+            self.denom = torch.zeros((self.get_xyz.shape[0], 1), device=self.device)
+            self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device=self.device)
+            if self.device.type == "cuda":
+                torch.cuda.empty_cache()
+
+        return {"cloned": clone_mask.sum(), "split": split_mask.sum(), "pruned": num_candidates - index.shape[0]}
 
     def add_densification_stats(self, viewspace_point_tensor, update_filter):
-        self.xyz_gradient_accum[update_filter] += torch.norm(viewspace_point_tensor.grad[update_filter,:2], dim=-1, keepdim=True)
-        self.denom[update_filter] += 1
\ No newline at end of file
+        # Masked accumulation instead of boolean indexing, which would synchronise
+        mask = update_filter.unsqueeze(-1).to(self.xyz_gradient_accum.dtype)
+        self.xyz_gradient_accum += torch.norm(viewspace_point_tensor.grad[:, :2], dim=-1, keepdim=True) * mask
+        self.denom += mask
\ No newline at end of file
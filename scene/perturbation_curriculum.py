@@ -0,0 +1,115 @@
+import random
+import numpy as np
+import torch
+from utils.graphics_utils import getWorld2View2, getProjectionMatrix
+from utils.general_utils import default_device
+
+# Stages of the perturbation curriculum as "start:end:scale" entries. A stage
+# is active for start < iteration <= end (an empty end keeps it active until
+# the end of training) and translates the base cameras by up to
+# scale * magnitude along every axis.
+DEFAULT_PERTURBATION_SCHEDULE = "5400:6600:1,6600:7800:2,7800:9000:4"
+
+def parse_schedule(spec):
+    """Parses a schedule string into a list of (start, end, scale), end being None when open."""
+    stages = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        fields = entry.split(":")
+        if len(fields) != 3:
+            raise ValueError("Perturbation stage '{}' is not of the form start:end:scale".format(entry))
+        start, end, scale = fields
+        stages.append((int(start), int(end) if end else None, float(scale)))
+    return stages
+
+class PerturbedCamera:
+    """
+    A base camera moved by a translation offset, for curriculum stage stage.
+    Only the pose is its own, the ground truth image and depth are the base
+    camera's tensors.
+    """
+    def __init__(self, base, offset, stage=None):
+        self.base = base
+        self.stage = stage
+        self.uid = base.uid
+        self.colmap_id = base.colmap_id
+        self.image_name = base.image_name
+        self.R = base.R
+        self.T = base.T + offset
+        self.FoVx = base.FoVx
+        self.FoVy = base.FoVy
+        self.image_width = base.image_width
+        self.image_height = base.image_height
+        self.znear = base.znear
+        self.zfar = base.zfar
+        self.trans = base.trans
+        self.scale = base.scale
+
+        self.world_view_transform = torch.tensor(getWorld2View2(self.R, self.T, self.trans, self.scale)).transpose(0, 1).to(default_device())
+        self.projection_matrix = getProjectionMatrix(znear=self.znear, zfar=self.zfar, fovX=self.FoVx, fovY=self.FoVy).transpose(0,1).to(default_device())
+        self.full_proj_transform = (self.world_view_transform.unsqueeze(0).bmm(self.projection_matrix.unsqueeze(0))).squeeze(0)
+        self.camera_center = self.world_view_transform.inverse()[3, :3]
+
+    # Looked up on every access, so that they follow the base camera when
+    # CameraStore moves its tensors into pinned memory
+    @property
+    def original_image(self):
+        return self.base.original_image
+
+    @property
+    def depth_image(self):
+        return self.base.depth_image
+
+class PerturbationCurriculum:
+    """
+    Schedules the perturbation views of training. Perturbed cameras are built
+    on first use from the base cameras, one fixed random offset per stage and
+    camera, and hold nothing but their pose, so the memory of the curriculum
+    does not grow with the number of stages.
+    """
+    def __init__(self, base_cameras, schedule=DEFAULT_PERTURBATION_SCHEDULE, magnitude=0.05):
+        self.base_cameras = list(base_cameras)
+        self.stages = parse_schedule(schedule) if isinstance(schedule, str) else list(schedule)
+        self.magnitude = magnitude
+        self._cameras = {}
+        self._stack = []
+        self._stack_stage = None
+
+    @property
+    def num_stages(self):
+        return len(self.stages)
+
+    def stage(self, iteration):
+        """Index of the stage active at iteration, None outside of all stages."""
+        for idx, (start, end, _) in enumerate(self.stages):
+            if iteration > start and (end is None or iteration <= end):
+                return idx
+        return None
+
+    def camera(self, stage, base_index):
+        key = (stage, base_index)
+        camera = self._cameras.get(key)
+        if camera is None:
+            extent = self.magnitude * self.stages[stage][2]
+            camera = PerturbedCamera(self.base_cameras[base_index], np.random.uniform(-extent, extent, size=3), stage)
+            self._cameras[key] = camera
+        return camera
+
+    def cameras(self, stage):
+        """The perturbed cameras of all base cameras for stage."""
+        return [self.camera(stage, idx) for idx in range(len(self.base_cameras))]
+
+    def sample(self, iteration):
+        """
+        A random perturbed camera of the stage active at iteration, or None. The
+        base cameras are visited in random order, each once per pass.
+        """
+        stage = self.stage(iteration)
+        if stage is None or not self.base_cameras:
+            return None
+        if stage != self._stack_stage or not self._stack:
+            self._stack = list(range(len(self.base_cameras)))
+            self._stack_stage = stage
+        return self.camera(stage, self._stack.pop(random.randint(0, len(self._stack) - 1)))
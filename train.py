@@ -12,13 +12,13 @@ import sys
 #sys.path.append('Depth-Anything-TorchVersion')
 import os
 import torch
-from utils.feature_extractor import get_Feature_from_DinoV2
+from utils.feature_extractor import ReferenceFeatureCache
+from utils.perturbation_loss import PerturbationLoss
 from random import randint
-from utils.loss_utils import l1_loss, ssim, cosine_similarity_loss
-from gaussian_renderer import render, network_gui
-from torchmetrics.functional.regression import pearson_corrcoef
+from utils.loss_utils import l1_loss, fast_ssim, pearson_correlation
+from gaussian_renderer import render, render_batch, network_gui
 import sys
-from utils.general_utils import safe_state
+from utils.general_utils import safe_state, default_device
 import uuid
 from tqdm import tqdm
 from utils.image_utils import psnr
@@ -27,8 +27,11 @@ from arguments import ModelParams, PipelineParams, OptimizationParams
 import numpy as np ###
 import matplotlib.pyplot as plt ###
 from scene import Scene, GaussianModel
+from scene.camera_store import CameraStore
+from scene.perturbation_curriculum import DEFAULT_PERTURBATION_SCHEDULE
 ### midas ###
-from utils.depth_utils import estimate_depth
+from utils.async_writer import AsyncWriter
+from utils.debug_utils import SyncCounter, StepProfiler
 #############
 
 # ### depth anything ###
@@ -43,7 +46,7 @@ try:
 except ImportError:
     TENSORBOARD_FOUND = False
 
-def training(dataset, opt, pipe, testing_iterations, saving_iterations, checkpoint_iterations, checkpoint, debug_from, api_key, self_refinement, num_prompt, max_rounds):
+def training(dataset, opt, pipe, testing_iterations, saving_iterations, checkpoint_iterations, checkpoint, debug_from, api_key, self_refinement, num_prompt, max_rounds, sync_save=False, max_pending_saves=2, log_interval=10, count_syncs=False, profile=False, profile_interval=1000):
     first_iter = 0
     tb_writer = prepare_output_and_logger(dataset)
     gaussians = GaussianModel(dataset.sh_degree)
@@ -53,15 +56,45 @@ def training(dataset, opt, pipe, testing_iterations, saving_iterations, checkpoi
         (model_params, first_iter) = torch.load(checkpoint)
         gaussians.restore(model_params, opt)
 
-    bg_color = [1, 1, 1] if dataset.white_background else [0, 0, 0]
-    background = torch.tensor(bg_color, dtype=torch.float32, device="cuda")
+    # Point clouds and checkpoints are written on a background thread
+    writer = AsyncWriter(max_pending=max_pending_saves, enabled=not sync_save)
 
-    iter_start = torch.cuda.Event(enable_timing = True)
-    iter_end = torch.cuda.Event(enable_timing = True)
+    bg_color = [1, 1, 1] if dataset.white_background else [0, 0, 0]
+    device = default_device()
+    background = torch.tensor(bg_color, dtype=torch.float32, device=device)
+
+    # Step timing is only available on CUDA, iter_time is not logged otherwise
+    timed = device.type == "cuda"
+    iter_start = torch.cuda.Event(enable_timing = True) if timed else None
+    iter_end = torch.cuda.Event(enable_timing = True) if timed else None
+
+    # Losses are accumulated on the device and only read back every
+    # log_interval iterations, so that a training step never waits for the GPU
+    zero = torch.zeros((), device=device)
+    loss_sums = None
+    # Densification counts stay on the device until the next report as well
+    pending_counts = []
+    sync_counter = SyncCounter(count_syncs)
+    # Named timing regions of the step, see utils/debug_utils.StepProfiler
+    profiler = StepProfiler(profile, report_path=os.path.join(scene.model_path, "profile.json"), report_interval=profile_interval)
+
+    # With data_device "pinned" images are uploaded from pinned memory, one camera ahead
+    # Perturbed views share the images of the training cameras
+    camera_store = CameraStore(scene.getTrainCameras(), pin=dataset.data_device == "pinned")
+
+    # DINOv2 features of the (fixed) reference images, stored with the model
+    dino_resolution = getattr(opt, "dino_resolution", 504)
+    dino_precision = getattr(opt, "dino_precision", "fp32")
+    reference_features = ReferenceFeatureCache(os.path.join(scene.model_path, "dino_features_{}_{}.pt".format(dino_resolution, dino_precision)),
+                                               dino_resolution, dino_precision, getattr(opt, "aux_channels_last", False))
+
+    perturbation_loss = PerturbationLoss(opt, reference_features, camera_store, profiler)
+    perturbation_curriculum = scene.getPerturbationCurriculum(getattr(opt, "perturbation_schedule", DEFAULT_PERTURBATION_SCHEDULE),
+                                                              getattr(opt, "perturbation_magnitude", 0.05))
 
     viewpoint_stack = None
-    perturbation_viewpoint_stack = None
-    ema_loss_for_log = 0.0
+    next_viewpoint_cam = None
+    ema_loss_for_log = torch.zeros((), device=device)
     progress_bar = tqdm(range(first_iter, opt.iterations), desc="Training progress")
     first_iter += 1
     for iteration in range(first_iter, opt.iterations + 1):   
@@ -80,7 +113,9 @@ def training(dataset, opt, pipe, testing_iterations, saving_iterations, checkpoi
             except Exception as e:
                 network_gui.conn = None
 
-        iter_start.record()
+        if timed:
+            iter_start.record()
+        sync_counter.begin()
 
         gaussians.update_learning_rate(iteration)
 
@@ -89,106 +124,132 @@ def training(dataset, opt, pipe, testing_iterations, saving_iterations, checkpoi
             gaussians.oneupSHdegree()
         
 
-        # Pick a random Camera
-        if not viewpoint_stack:
-            viewpoint_stack = scene.getTrainCameras().copy()
-        viewpoint_cam = viewpoint_stack.pop(randint(0, len(viewpoint_stack)-1))
+        # Pick a random Camera, and the one of the next iteration to prefetch it
+        for _ in range(2 if next_viewpoint_cam is None else 1):
+            if not viewpoint_stack:
+                viewpoint_stack = scene.getTrainCameras().copy()
+            viewpoint_cam, next_viewpoint_cam = next_viewpoint_cam, viewpoint_stack.pop(randint(0, len(viewpoint_stack)-1))
+        camera_store.prefetch(next_viewpoint_cam)
 
 
         # Render
         if (iteration - 1) == debug_from:
             pipe.debug = True
 
-        bg = torch.rand((3), device="cuda") if opt.random_background else background
+        bg = torch.rand((3), device=device) if opt.random_background else background
 
-        render_pkg = render(viewpoint_cam, gaussians, pipe, bg)
+        with profiler.region("render"):
+            render_pkg = render(viewpoint_cam, gaussians, pipe, bg)
         image, viewspace_point_tensor, visibility_filter, radii = render_pkg["render"], render_pkg["viewspace_points"], render_pkg["visibility_filter"], render_pkg["radii"]
         rendered_depth = render_pkg["depth"] ###
-        gt_depth = torch.tensor(viewpoint_cam.depth_image).cuda() ###
-        gt_image = viewpoint_cam.original_image.cuda()
-        Ll1 = l1_loss(image, gt_image)
+        gt_image, gt_depth = camera_store.fetch(viewpoint_cam) ###
+        with profiler.region("image_loss"):
+            Ll1 = l1_loss(image, gt_image)
+            loss_ssim = fast_ssim(image, gt_image)
 
         depth_weight = 0.05 #0.005  
-        loss_depth = depth_weight * (1 - pearson_corrcoef(rendered_depth.reshape(-1, 1)[:, 0], - gt_depth.reshape(-1, 1)[:, 0]))
+        with profiler.region("depth_loss"):
+            loss_depth = depth_weight * (1 - pearson_correlation(rendered_depth, - gt_depth))
         
-        loss =  (1.0 - opt.lambda_dssim) * Ll1 + opt.lambda_dssim * (1.0 - ssim(image, gt_image)) + depth_weight * loss_depth
-        loss_feature = torch.tensor(0).cuda() 
-        loss_perturbation_depth = torch.tensor(0).cuda() 
-
-        if iteration > 5400:
-            if iteration > 5400 and iteration <= 6600:
-                if not perturbation_viewpoint_stack:
-                    perturbation_viewpoint_stack = scene.getPerturbationCameras(stage=1).copy()
-                perturbation_viewpoint_cam = perturbation_viewpoint_stack.pop(randint(0, len(perturbation_viewpoint_stack)-1))
-            elif iteration > 6600 and iteration <= 7800:
-                if not perturbation_viewpoint_stack:
-                    perturbation_viewpoint_stack = scene.getPerturbationCameras(stage=2).copy()
-                perturbation_viewpoint_cam = perturbation_viewpoint_stack.pop(randint(0, len(perturbation_viewpoint_stack)-1))
-            elif iteration <= 9000:
-                if not perturbation_viewpoint_stack:
-                    perturbation_viewpoint_stack = scene.getPerturbationCameras(stage=3).copy()
-                perturbation_viewpoint_cam = perturbation_viewpoint_stack.pop(randint(0, len(perturbation_viewpoint_stack)-1))
-
-            perturbation_render_pkg = render(perturbation_viewpoint_cam, gaussians, pipe, bg)
-            perturbation_image, perturbation_rendered_depth= perturbation_render_pkg["render"], perturbation_render_pkg["depth"]
-            ### perturbation depth loss
-            pred_depth = estimate_depth(perturbation_image)
-            loss_perturbation_depth =   (1 - pearson_corrcoef(rendered_depth.reshape(-1, 1)[:, 0], - gt_depth.reshape(-1, 1)[:, 0]))
-
-            if torch.isnan(loss_perturbation_depth).sum() == 0:
-                loss += depth_weight * loss_perturbation_depth
-            
-            
-            ### feature loss
-            pred_feature = get_Feature_from_DinoV2(perturbation_image)# (1, 768)
-            ref_image = perturbation_viewpoint_cam.original_image.cuda()
-            ref_feature = get_Feature_from_DinoV2(ref_image)
-            loss_feature = cosine_similarity_loss(pred_feature, ref_feature)
-            
-            feature_loss_weight = 0.05
-            loss += feature_loss_weight * loss_feature 
-
-        loss.backward()
-
-        iter_end.record()
+        loss =  (1.0 - opt.lambda_dssim) * Ll1 + opt.lambda_dssim * (1.0 - loss_ssim) + depth_weight * loss_depth
+        loss_feature = zero
+        loss_perturbation_depth = zero
+
+        perturbation_viewpoint_cam = perturbation_curriculum.sample(iteration)
+        if perturbation_viewpoint_cam is not None:
+            with profiler.region("perturbation_render"):
+                perturbation_render_pkg = render(perturbation_viewpoint_cam, gaussians, pipe, bg)
+            loss_perturbation, loss_perturbation_depth, loss_feature = perturbation_loss(iteration, perturbation_viewpoint_cam, perturbation_render_pkg, rendered_depth, gt_depth)
+            loss += loss_perturbation
+
+        with profiler.region("backward"):
+            loss.backward()
+
+        if timed:
+            iter_end.record()
 
         with torch.no_grad():
             # Progress bar
 
-            ema_loss_for_log = 0.4 * loss.item() + 0.6 * ema_loss_for_log
-            if iteration % 10 == 0:
-                progress_bar.set_postfix({"Loss": f"{ema_loss_for_log:.{7}f}"})
-                progress_bar.update(10)
+            ema_loss_for_log = 0.4 * loss.detach() + 0.6 * ema_loss_for_log
+            log_now = iteration % log_interval == 0
+            if log_now:
+                postfix = {"Loss": f"{ema_loss_for_log.item():.{7}f}"}
+                if sync_counter.enabled:
+                    postfix["Syncs/it"] = f"{sync_counter.mean(log_interval):.1f}"
+                progress_bar.set_postfix(postfix)
+                progress_bar.update(log_interval)
             if iteration == opt.iterations:
                 progress_bar.close()
 
             # Log and save
-            training_report(tb_writer, iteration, Ll1, loss_feature, loss_depth, loss, l1_loss, loss_perturbation_depth, iter_start.elapsed_time(iter_end), testing_iterations, scene, render, (pipe, background)) ###
+            losses = torch.stack([Ll1, loss_feature, loss_depth, loss_perturbation_depth, loss]).detach()
+            loss_sums = losses if loss_sums is None else loss_sums + losses
+            training_report(tb_writer, iteration, loss_sums / log_interval if log_now else None, iter_start.elapsed_time(iter_end) if log_now and timed else None,
+                            sync_counter.mean(log_interval) if sync_counter.enabled else None, testing_iterations, scene, render_batch, (pipe, background)) ###
+            if log_now:
+                loss_sums = None
+                if tb_writer:
+                    for count_iteration, counts in pending_counts:
+                        for name, count in counts.items():
+                            tb_writer.add_scalar('densification/' + name, count.item(), count_iteration)
+                pending_counts = []
             if (iteration in saving_iterations):
                 print("\n[ITER {}] Saving Gaussians".format(iteration))
-                scene.save(iteration)
+                with profiler.region("save"):
+                    scene.save(iteration, writer)
+                    reference_features.save(writer)
 
             # Densification
-            if iteration < opt.densify_until_iter:
-                # Keep track of max radii in image-space for pruning
-                gaussians.max_radii2D[visibility_filter] = torch.max(gaussians.max_radii2D[visibility_filter], radii[visibility_filter])
-                gaussians.add_densification_stats(viewspace_point_tensor, visibility_filter)
-
-                if iteration > opt.densify_from_iter and iteration % opt.densification_interval == 0:
-                    size_threshold = 20 if iteration > opt.opacity_reset_interval else None
-                    gaussians.densify_and_prune(opt.densify_grad_threshold, 0.005, scene.cameras_extent, size_threshold)
+            with profiler.region("densification"):
+                if iteration < opt.densify_until_iter:
+                    # Keep track of max radii in image-space for pruning
+                    # Masked updates instead of boolean indexing, which would synchronise
+                    gaussians.max_radii2D.copy_(torch.where(visibility_filter, torch.max(gaussians.max_radii2D, radii), gaussians.max_radii2D))
+                    gaussians.add_densification_stats(viewspace_point_tensor, visibility_filter)
+
+                    if iteration > opt.densify_from_iter and iteration % opt.densification_interval == 0:
+                        size_threshold = 20 if iteration > opt.opacity_reset_interval else None
+                        counts = gaussians.densify_and_prune(opt.densify_grad_threshold, 0.005, scene.cameras_extent, size_threshold)
+                        if tb_writer:
+                            pending_counts.append((iteration, counts))
                 
-                if iteration % opt.opacity_reset_interval == 0 or (dataset.white_background and iteration == opt.densify_from_iter):
-                    gaussians.reset_opacity()
+                    if iteration % opt.opacity_reset_interval == 0 or (dataset.white_background and iteration == opt.densify_from_iter):
+                        gaussians.reset_opacity()
+
+                # Keep Gaussians that are close in space close in memory
+                reorder_interval = getattr(opt, "reorder_interval", 0)
+                if reorder_interval > 0 and iteration % reorder_interval == 0 and iteration <= opt.densify_until_iter:
+                    gaussians.reorder_points()
 
             # Optimizer step
             if iteration < opt.iterations:
-                gaussians.optimizer.step()
-                gaussians.optimizer.zero_grad(set_to_none = True)
+                with profiler.region("optimizer_step"):
+                    gaussians.optimizer.step()
+                    gaussians.optimizer.zero_grad(set_to_none = True)
 
             if (iteration in checkpoint_iterations):
                 print("\n[ITER {}] Saving Checkpoint".format(iteration))
-                torch.save((gaussians.capture(), iteration), scene.model_path + "/chkpnt" + str(iteration) + ".pth")
+                with profiler.region("save"):
+                    writer.submit(scene.model_path + "/chkpnt" + str(iteration) + ".pth", (gaussians.capture(), iteration),
+                                  lambda path, data: torch.save(data, path))
+                    # Keep the features computed so far should the run not finish
+                    reference_features.save(writer)
+
+        sync_counter.end()
+        profiler.step(iteration)
+        if profiler.enabled and tb_writer and iteration % profile_interval == 0:
+            for name, stats in profiler.reports[-1]["regions"].items():
+                tb_writer.add_scalar('profile/' + name, stats["mean_ms"], iteration)
+
+    reference_features.save(writer)
+    writer.close()
+    if profiler.enabled:
+        if opt.iterations % profile_interval != 0:
+            profiler.report(opt.iterations)
+        profiler.export_chrome_trace(os.path.join(scene.model_path, "profile_trace.json"))
+    if tb_writer:
+        tb_writer.close()
 
 def prepare_output_and_logger(args):    
     if not args.model_path:
@@ -212,14 +273,23 @@ def prepare_output_and_logger(args):
         print("Tensorboard not available: not logging progress")
     return tb_writer
 
-def training_report(tb_writer, iteration, Ll1, loss_feature, loss_depth, loss, l1_loss, loss_perturbation_depth, elapsed, testing_iterations, scene : Scene, renderFunc, renderArgs):
-    if tb_writer:
-        tb_writer.add_scalar('train_loss_patches/l1_loss', Ll1.item(), iteration)
-        tb_writer.add_scalar('train_loss_patches/feature_loss', loss_feature.item(), iteration) ###
-        tb_writer.add_scalar('train_loss_patches/depth_loss', loss_depth.item(), iteration) ###
-        tb_writer.add_scalar('train_loss_patches/loss_perturbation_depth', loss_perturbation_depth.item(), iteration)
-        tb_writer.add_scalar('train_loss_patches/total_loss', loss.item(), iteration)
-        tb_writer.add_scalar('iter_time', elapsed, iteration)
+# Cameras per render_batch call when evaluating
+REPORT_BATCH_SIZE = 8
+
+def training_report(tb_writer, iteration, mean_losses, elapsed, syncs_per_iter, testing_iterations, scene : Scene, renderFunc, renderArgs):
+    # mean_losses holds the (l1, feature, depth, perturbation depth, total)
+    # losses averaged on the device since the last report, None in between
+    if tb_writer and mean_losses is not None:
+        l1, feature, depth, perturbation_depth, total = mean_losses.tolist()
+        tb_writer.add_scalar('train_loss_patches/l1_loss', l1, iteration)
+        tb_writer.add_scalar('train_loss_patches/feature_loss', feature, iteration) ###
+        tb_writer.add_scalar('train_loss_patches/depth_loss', depth, iteration) ###
+        tb_writer.add_scalar('train_loss_patches/loss_perturbation_depth', perturbation_depth, iteration)
+        tb_writer.add_scalar('train_loss_patches/total_loss', total, iteration)
+        if elapsed is not None:
+            tb_writer.add_scalar('iter_time', elapsed, iteration)
+        if syncs_per_iter is not None:
+            tb_writer.add_scalar('syncs_per_iter', syncs_per_iter, iteration)
 
     # Report test and samples of training set
     if iteration in testing_iterations:
@@ -231,15 +301,21 @@ def training_report(tb_writer, iteration, Ll1, loss_feature, loss_depth, loss, l
             if config['cameras'] and len(config['cameras']) > 0:
                 l1_test = 0.0
                 psnr_test = 0.0
-                for idx, viewpoint in enumerate(config['cameras']):
-                    image = torch.clamp(renderFunc(viewpoint, scene.gaussians, *renderArgs)["render"], 0.0, 1.0)
-                    gt_image = torch.clamp(viewpoint.original_image.to("cuda"), 0.0, 1.0)
-                    if tb_writer and (idx < 5):
-                        tb_writer.add_images(config['name'] + "_view_{}/render".format(viewpoint.image_name), image[None], global_step=iteration)
-                        if iteration == testing_iterations[0]:
-                            tb_writer.add_images(config['name'] + "_view_{}/ground_truth".format(viewpoint.image_name), gt_image[None], global_step=iteration)
-                    l1_test += l1_loss(image, gt_image).mean().double()
-                    psnr_test += psnr(image, gt_image).mean().double()
+                # Batched, but in bounded chunks: the memory of the reference
+                # rasterizer grows with the number of cameras per call
+                for start in range(0, len(config['cameras']), REPORT_BATCH_SIZE):
+                    cameras = config['cameras'][start:start + REPORT_BATCH_SIZE]
+                    images = torch.clamp(renderFunc(cameras, scene.gaussians, *renderArgs)["render"], 0.0, 1.0)
+                    for idx, viewpoint in enumerate(cameras, start):
+                        image = images[idx - start]
+                        gt_image = torch.clamp(viewpoint.original_image.to(image.device), 0.0, 1.0)
+                        if tb_writer and (idx < 5):
+                            tb_writer.add_images(config['name'] + "_view_{}/render".format(viewpoint.image_name), image[None], global_step=iteration)
+                            if iteration == testing_iterations[0]:
+                                tb_writer.add_images(config['name'] + "_view_{}/ground_truth".format(viewpoint.image_name), gt_image[None], global_step=iteration)
+                        l1_test += l1_loss(image, gt_image).mean().double()
+                        psnr_test += psnr(image, gt_image).mean().double()
+                    del images
                 psnr_test /= len(config['cameras'])
                 l1_test /= len(config['cameras'])          
                 print("\n[ITER {}] Evaluating {}: L1 {} PSNR {}".format(iteration, config['name'], l1_test, psnr_test))
@@ -252,8 +328,8 @@ def training_report(tb_writer, iteration, Ll1, loss_feature, loss_depth, loss, l
             tb_writer.add_scalar('total_points', scene.gaussians.get_xyz.shape[0], iteration)
         torch.cuda.empty_cache()
 
-if __name__ == "__main__":
-    # Set up command line argument parser
+def build_parser():
+    # Training command line, shared with the scene farm
     parser = ArgumentParser(description="Training script parameters")
     lp = ModelParams(parser)
     op = OptimizationParams(parser)
@@ -267,10 +343,21 @@ if __name__ == "__main__":
     parser.add_argument("--quiet", action="store_true")
     parser.add_argument("--checkpoint_iterations", nargs="+", type=int, default=[])
     parser.add_argument("--start_checkpoint", type=str, default = None)
+    parser.add_argument("--sync_save", action="store_true", default=False)
+    parser.add_argument("--max_pending_saves", type=int, default = 2)
+    parser.add_argument("--log_interval", type=int, default = 10)
+    parser.add_argument("--count_syncs", action="store_true", default=False)
+    parser.add_argument("--profile", action="store_true", default=False)
+    parser.add_argument("--profile_interval", type=int, default = 1000)
     parser.add_argument("--api_key", type=str, default=None)
     parser.add_argument("--self_refinement", action='store_true', default=False)
     parser.add_argument("--num_prompt", type=int, default = 3)
     parser.add_argument("--max_rounds", type=int, default = 3)
+    return parser, lp, op, pp
+
+if __name__ == "__main__":
+    # Set up command line argument parser
+    parser, lp, op, pp = build_parser()
     args = parser.parse_args(sys.argv[1:])
     args.save_iterations.append(args.iterations)
     
@@ -282,7 +369,7 @@ if __name__ == "__main__":
     # Start GUI server, configure and run training
     network_gui.init(args.ip, args.port)
     torch.autograd.set_detect_anomaly(args.detect_anomaly)
-    training(lp.extract(args), op.extract(args), pp.extract(args), args.test_iterations, args.save_iterations, args.checkpoint_iterations, args.start_checkpoint, args.debug_from, args.api_key, args.self_refinement, args.num_prompt, args.max_rounds)
+    training(lp.extract(args), op.extract(args), pp.extract(args), args.test_iterations, args.save_iterations, args.checkpoint_iterations, args.start_checkpoint, args.debug_from, args.api_key, args.self_refinement, args.num_prompt, args.max_rounds, args.sync_save, args.max_pending_saves, args.log_interval, args.count_syncs, args.profile, args.profile_interval)
 
     # All done
     print("\nTraining complete.")
@@ -0,0 +1,110 @@
+import os
+import queue
+import threading
+import traceback
+import torch
+
+from utils.system_utils import mkdir_p
+
+def snapshot_to_host(obj):
+    """
+    Copies every tensor of a (nested) tuple/list/dict to host memory. CUDA tensors
+    are copied asynchronously into pinned buffers, so the call returns as soon as
+    the copies are enqueued; the copies run in stream order, i.e. they see the
+    values as of this call even if the training loop modifies them in place
+    afterwards. Call wait on the returned event before reading the result.
+    """
+    if torch.is_tensor(obj):
+        tensor = obj.detach()
+        if tensor.is_cuda:
+            host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+            host.copy_(tensor, non_blocking=True)
+            return host
+        return tensor.clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_host(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_host(v) for v in obj)
+    return obj
+
+class AsyncWriter:
+    """
+    Serializes snapshots of the model on a background thread, off the training
+    loop's critical path. At most max_pending snapshots are held in memory at
+    once; submit blocks when that many are still being written. Files are first
+    written under a temporary name and renamed when complete, so readers never
+    see a partial checkpoint or PLY.
+
+    With enabled=False every submit runs synchronously, which keeps the old
+    behaviour available for debugging.
+    """
+    def __init__(self, max_pending=2, enabled=True):
+        self.enabled = enabled
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._queue = queue.Queue()
+        self._errors = []
+        self._thread = None
+        if enabled:
+            self._thread = threading.Thread(target=self._run, name="AsyncWriter", daemon=True)
+            self._thread.start()
+
+    def submit(self, path, data, write_fn):
+        """
+        Schedules write_fn(tmp_path, host_data) where host_data is a host copy of
+        data taken now, then atomically renames tmp_path to path.
+        """
+        self._raise_errors()
+        if self.enabled:
+            self._slots.acquire()
+        host_data = snapshot_to_host(data)
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        if self.enabled:
+            self._queue.put((path, host_data, event, write_fn))
+        else:
+            self._write(path, host_data, event, write_fn)
+
+    def flush(self):
+        """Blocks until every submitted snapshot is on disk."""
+        if self.enabled:
+            self._queue.join()
+        self._raise_errors()
+
+    def close(self):
+        self.flush()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self.enabled = False
+
+    def _write(self, path, host_data, event, write_fn):
+        if event is not None:
+            event.synchronize()
+        mkdir_p(os.path.dirname(path))
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        write_fn(tmp_path, host_data)
+        os.replace(tmp_path, path)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            path, host_data, event, write_fn = item
+            try:
+                self._write(path, host_data, event, write_fn)
+            except Exception:
+                self._errors.append("Failed to write {}:\n{}".format(path, traceback.format_exc()))
+            finally:
+                del host_data
+                self._slots.release()
+                self._queue.task_done()
+
+    def _raise_errors(self):
+        if self._errors:
+            errors, self._errors = self._errors, []
+            raise RuntimeError("\n".join(errors))
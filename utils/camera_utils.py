@@ -9,12 +9,14 @@
 # For inquiries contact  george.drettakis@inria.fr
 #
 
+import os
 from scene.cameras import Camera
 import numpy as np
-from utils.general_utils import PILtoTorch
+from utils.general_utils import PILtoTorch, default_device
 from utils.graphics_utils import fov2focal
 ### midas ###
-from utils.depth_utils import estimate_depth
+from utils.depth_utils import estimate_depth, ckpt_path as depth_ckpt_path
+from utils.depth_cache import cached_estimate_depth
 #############
 
 # ### depth anything ###
@@ -52,7 +54,13 @@ def loadCam(args, id, cam_info, resolution_scale):
     resized_image_rgb = PILtoTorch(cam_info.image, resolution)
 
     gt_image = resized_image_rgb[:3, ...]
-    depth = estimate_depth(gt_image.cuda()).cpu().numpy() ### midas
+    if getattr(args, "no_depth_cache", False):
+        depth = estimate_depth(gt_image.to(default_device())).cpu().numpy() ### midas
+    else:
+        # Configs written before the cache existed do not carry its directory
+        cache_dir = getattr(args, "depth_cache_dir", None) or os.path.join("cache", "depth")
+        depth = cached_estimate_depth(gt_image, cache_dir,
+                                      lambda img: estimate_depth(img.to(default_device())), depth_ckpt_path)
     # depth = depth_anything(gt_image.cuda(), 'vits', model = model).cpu().numpy()
     loaded_mask = None
 
@@ -0,0 +1,66 @@
+import torch
+
+class CapacityBuffer:
+    """
+    The first `size` rows of a preallocated [capacity, ...] tensor. Appending
+    grows the allocation geometrically, like a vector, so that repeated
+    densification keeps reusing one allocation instead of creating new tensors
+    every step. A second storage of the same capacity is kept as scratch:
+    keep() gathers the selected rows into it and swaps the two, so that pruning
+    and reordering allocate nothing either, at the cost of twice the capacity
+    in standing memory.
+    """
+    def __init__(self, tensor, growth=1.5, capacity=None):
+        self.growth = max(growth, 1.0)
+        self.size = tensor.shape[0]
+        if capacity is None:
+            capacity = int(self.size * self.growth)
+        self.storage = torch.empty((max(capacity, self.size),) + tuple(tensor.shape[1:]), dtype=tensor.dtype, device=tensor.device)
+        self.storage[:self.size] = tensor
+        self._scratch = torch.empty_like(self.storage)
+
+    @property
+    def view(self):
+        return self.storage[:self.size]
+
+    @property
+    def capacity(self):
+        return self.storage.shape[0]
+
+    def owns(self, tensor):
+        """Whether tensor is the current active view of this buffer."""
+        return tensor.data_ptr() == self.storage.data_ptr() and tensor.shape[0] == self.size
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, int(self.capacity * self.growth) + 1)
+        storage = torch.empty((capacity,) + tuple(self.storage.shape[1:]), dtype=self.storage.dtype, device=self.storage.device)
+        storage[:self.size] = self.view
+        self.storage = storage
+        self._scratch = torch.empty_like(storage)
+
+    def append(self, values):
+        count = values.shape[0]
+        self.reserve(self.size + count)
+        self.storage[self.size:self.size + count] = values
+        self.size += count
+
+    def append_zeros(self, count):
+        self.reserve(self.size + count)
+        self.storage[self.size:self.size + count] = 0
+        self.size += count
+
+    def keep(self, index):
+        """
+        Keeps the rows selected by a boolean mask or an index tensor, in that
+        order, at the front of the buffer. Indices may repeat, the buffer grows
+        if needed.
+        """
+        if index.dtype == torch.bool:
+            index = torch.nonzero(index).squeeze(1)
+        count = index.shape[0]
+        self.reserve(count)
+        torch.index_select(self.view, 0, index, out=self._scratch[:count])
+        self.storage, self._scratch = self._scratch, self.storage
+        self.size = count
@@ -0,0 +1,126 @@
+import json
+import struct
+import numpy as np
+
+# Compact Gaussian scene container (.gsc):
+#
+#   8 bytes   magic "GSCMPCT1"
+#   4 bytes   little-endian uint32 length of the JSON header
+#   ...       JSON header, padded with spaces to a multiple of ALIGNMENT
+#   ...       raw little-endian sections, each starting at a multiple of ALIGNMENT
+#
+# The header lists every section with its dtype, shape and offset relative to
+# the end of the header. float16 sections are stored as is; uint8 sections are
+# linearly quantized per channel and carry the per-channel "min" and "max" used
+# to dequantize them. Sections are memory mapped on read, so opening a file
+# costs nothing until a section is decoded.
+
+MAGIC = b"GSCMPCT1"
+VERSION = 1
+ALIGNMENT = 64
+
+# Sections of a Gaussian scene and their encodings. xyz is stored relative to
+# metadata["xyz_offset"], opacity after the sigmoid activation.
+GAUSSIAN_SECTIONS = {"xyz": "f16", "f_dc": "u8", "f_rest": "u8", "opacity": "u8", "scaling": "f16", "rotation": "f16"}
+
+def _align(size):
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def quantize_u8(array):
+    """
+    Linearly quantizes an [N, C] array to uint8 with a per-channel [min, max]
+    range. Returns (codes, min, max).
+    """
+    array = np.asarray(array, dtype=np.float32)
+    lo = array.min(axis=0) if array.shape[0] > 0 else np.zeros(array.shape[1], np.float32)
+    hi = array.max(axis=0) if array.shape[0] > 0 else np.zeros(array.shape[1], np.float32)
+    scale = np.where(hi > lo, hi - lo, 1.0).astype(np.float32)
+    codes = np.rint((array - lo) / scale * 255.0)
+    return np.clip(codes, 0, 255).astype(np.uint8), lo, hi
+
+def dequantize_u8(codes, lo, hi):
+    lo = np.asarray(lo, dtype=np.float32)
+    hi = np.asarray(hi, dtype=np.float32)
+    return lo + np.asarray(codes, dtype=np.float32) * ((hi - lo) / 255.0)
+
+def write_compact(path, sections, metadata=None):
+    """
+    Writes a .gsc file. sections maps a name to (array, encoding) with encoding
+    "f16" (half precision) or "u8" (per-channel 8-bit quantization); arrays are
+    [N, C]. metadata is stored verbatim in the header.
+    """
+    entries = {}
+    payloads = []
+    offset = 0
+    for name, (array, encoding) in sections.items():
+        array = np.asarray(array, dtype=np.float32)
+        array = array.reshape(array.shape[0], -1)
+        entry = {"shape": list(array.shape), "offset": offset}
+        if encoding == "f16":
+            data = array.astype('<f2')
+            entry["dtype"] = "float16"
+        elif encoding == "u8":
+            data, lo, hi = quantize_u8(array)
+            entry["dtype"] = "uint8"
+            entry["min"] = lo.tolist()
+            entry["max"] = hi.tolist()
+        else:
+            raise ValueError("Unknown encoding '{}' for section '{}'".format(encoding, name))
+        entries[name] = entry
+        payloads.append(np.ascontiguousarray(data))
+        offset = _align(offset + data.nbytes)
+
+    header = {"version": VERSION, "sections": entries, "metadata": metadata or {}}
+    header_bytes = json.dumps(header).encode('utf-8')
+    # Pad so that the sections start aligned in the file
+    prefix_size = len(MAGIC) + 4
+    header_bytes += b" " * (_align(prefix_size + len(header_bytes)) - prefix_size - len(header_bytes))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        start = f.tell()
+        for (name, entry), data in zip(entries.items(), payloads):
+            f.write(b"\0" * (start + entry["offset"] - f.tell()))
+            data.tofile(f)
+
+class CompactReader:
+    """
+    Read-only view of a .gsc file. raw(name) returns the memory-mapped section
+    as stored, section(name) decodes it to float32.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a compact Gaussian scene".format(path))
+            header_size = struct.unpack('<I', f.read(4))[0]
+            self.header = json.loads(f.read(header_size).decode('utf-8'))
+            self.data_offset = f.tell()
+        if self.header["version"] > VERSION:
+            raise ValueError("{} has version {}, this reader supports up to {}".format(path, self.header["version"], VERSION))
+        self.sections = self.header["sections"]
+        self.metadata = self.header["metadata"]
+
+    def __contains__(self, name):
+        return name in self.sections
+
+    def raw(self, name):
+        entry = self.sections[name]
+        dtype = '<f2' if entry["dtype"] == "float16" else np.uint8
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=self.data_offset + entry["offset"], shape=tuple(entry["shape"]))
+
+    def section(self, name, rows=slice(None)):
+        entry = self.sections[name]
+        data = self.raw(name)[rows]
+        if entry["dtype"] == "uint8":
+            return dequantize_u8(data, entry["min"], entry["max"])
+        return np.asarray(data, dtype=np.float32)
+
+    def gather(self, name, row_ranges):
+        """Decodes and concatenates the rows [start, start + count) of each (start, count) range."""
+        parts = [self.section(name, slice(start, start + count)) for start, count in row_ranges]
+        if not parts:
+            return np.zeros((0, self.sections[name]["shape"][1]), dtype=np.float32)
+        return np.concatenate(parts, axis=0)
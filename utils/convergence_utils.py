@@ -0,0 +1,68 @@
+class ConvergenceMonitor:
+    """
+    Detects when a loss minimised step by step stops improving.
+
+    Losses are summed on their device and only read back every check_interval
+    steps, so watching them costs one sync per check instead of one per step.
+    At every check the mean loss of the window is folded into an EMA; a check
+    whose EMA is not at least rel_tol (relative) below the best EMA so far
+    counts as a miss, and patience misses in a row after min_steps stop the
+    run. patience=0 never stops, the monitor then only reports the loss.
+    """
+    def __init__(self, patience=0, rel_tol=1e-3, check_interval=50, min_steps=0, ema_decay=0.6):
+        self.patience = patience
+        self.rel_tol = rel_tol
+        self.check_interval = max(1, check_interval)
+        self.min_steps = min_steps
+        self.ema_decay = ema_decay
+        self.ema_loss = None
+        self.best_loss = None
+        self.misses = 0
+        self.stopped_at = None
+        self.last_step = 0
+        self._sum = None
+        self._count = 0
+
+    def update(self, step, loss):
+        """Records the loss of step, returns True once the loss has converged."""
+        loss = loss.detach()
+        self._sum = loss if self._sum is None else self._sum + loss
+        self._count += 1
+        self.last_step = step
+        if step % self.check_interval != 0:
+            return False
+        return self.check(step)
+
+    def _fold(self):
+        # Folds the pending window into the EMA, the only place that syncs
+        if self._count == 0:
+            return
+        mean = self._sum.item() / self._count
+        self._sum, self._count = None, 0
+        self.ema_loss = mean if self.ema_loss is None else self.ema_decay * self.ema_loss + (1. - self.ema_decay) * mean
+
+    def check(self, step):
+        if self._count == 0:
+            return self.stopped_at is not None
+        self._fold()
+
+        if self.best_loss is None or self.ema_loss < self.best_loss - self.rel_tol * abs(self.best_loss):
+            self.best_loss = self.ema_loss
+            self.misses = 0
+        else:
+            self.misses += 1
+
+        if self.patience > 0 and self.misses >= self.patience and step >= self.min_steps:
+            self.stopped_at = step
+            return True
+        return False
+
+    def summary(self, max_steps):
+        """What to record of the run: the steps taken, of max_steps, and the final loss."""
+        self._fold()
+        return {
+            "steps": self.stopped_at or self.last_step,
+            "max_steps": max_steps,
+            "stopped_early": self.stopped_at is not None,
+            "loss": self.ema_loss,
+        }
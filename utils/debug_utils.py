@@ -1,4 +1,10 @@
+import json
+import time
 import inspect
+import warnings
+from collections import deque
+from contextlib import contextmanager, nullcontext
+import torch
 
 def printarr(*arrs, float_width=6):
     """
@@ -136,4 +142,168 @@ def printarr(*arrs, float_width=6):
             print("")
 
     finally:
-        del frame
\ No newline at end of file
+        del frame
+
+
+class SyncCounter:
+    """
+    Counts the host synchronisations issued between begin() and end() using
+    torch.cuda.set_sync_debug_mode, which warns on every synchronising CUDA
+    call (item(), nonzero(), boolean indexing, device to host copies, ...).
+    Disabled counters and CPU-only runs cost nothing.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled and torch.cuda.is_available()
+        self.counts = []
+        self._catcher = None
+        self._records = None
+
+    def begin(self):
+        if not self.enabled:
+            return
+        self._catcher = warnings.catch_warnings(record=True)
+        self._records = self._catcher.__enter__()
+        warnings.simplefilter("always")
+        torch.cuda.set_sync_debug_mode("warn")
+
+    def end(self):
+        if not self.enabled or self._catcher is None:
+            return 0
+        torch.cuda.set_sync_debug_mode("default")
+        count = sum(1 for w in self._records if "synchroniz" in str(w.message))
+        self._catcher.__exit__(None, None, None)
+        self._catcher = None
+        self.counts.append(count)
+        return count
+
+    def mean(self, last=None):
+        counts = self.counts[-last:] if last else self.counts
+        return sum(counts) / max(len(counts), 1)
+
+
+class StepProfiler:
+    """
+    Named timing regions of the training step. On a CUDA device every region
+    records a pair of CUDA events, so it measures the GPU time between its
+    start and end without synchronising; the events are read back once they
+    have completed, a few iterations later. On CPU regions are timed with
+    perf_counter.
+
+    Every report_interval iterations the durations since the last report are
+    aggregated per region (count, mean, percentiles and a histogram over
+    log-spaced buckets) and appended to report_path as JSON. The regions of the
+    last trace_steps iterations are kept for export_chrome_trace.
+    Disabled profilers cost nothing.
+    """
+    # Bucket upper bounds in milliseconds, from 10 us to about 10 s
+    BUCKETS = [0.01 * 2 ** (k / 2) for k in range(41)]
+
+    def __init__(self, enabled=True, device=None, report_path=None, report_interval=1000, trace_steps=50):
+        self.enabled = enabled
+        self.device = torch.device(device) if device is not None else torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.use_events = self.device.type == "cuda"
+        self.report_path = report_path
+        self.report_interval = report_interval
+        self.reports = []
+        self.durations = {}
+        self.trace = deque(maxlen=trace_steps)
+        self._regions = []
+        self._pending = deque()
+        self._t0 = time.perf_counter()
+        self._base = None
+        if enabled and self.use_events:
+            self._base = torch.cuda.Event(enable_timing=True)
+            self._base.record()
+
+    @contextmanager
+    def _timed(self, name):
+        if self.use_events:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self._regions.append((name, start, end))
+        else:
+            start = time.perf_counter()
+            yield
+            self._regions.append((name, (start - self._t0) * 1000, (time.perf_counter() - self._t0) * 1000))
+
+    def region(self, name):
+        """Context manager timing the code inside it as region name."""
+        if not self.enabled:
+            return nullcontext()
+        return self._timed(name)
+
+    def _resolve(self, iteration, regions):
+        spans = []
+        for name, start, end in regions:
+            if self.use_events:
+                start, end = self._base.elapsed_time(start), self._base.elapsed_time(end)
+            spans.append((name, start, end))
+            self.durations.setdefault(name, []).append(end - start)
+        self.trace.append((iteration, spans))
+
+    def step(self, iteration):
+        """Closes the regions of iteration; reports if it is a report iteration."""
+        if not self.enabled:
+            return
+        self._pending.append((iteration, self._regions))
+        self._regions = []
+        # Only read back events that have completed, so nothing waits for the GPU
+        while self._pending and (not self.use_events or not self._pending[0][1] or self._pending[0][1][-1][2].query()):
+            self._resolve(*self._pending.popleft())
+        if self.report_interval > 0 and iteration % self.report_interval == 0:
+            self.report(iteration)
+
+    def flush(self):
+        if self.use_events and self._pending:
+            torch.cuda.synchronize(self.device)
+        while self._pending:
+            self._resolve(*self._pending.popleft())
+
+    @classmethod
+    def summarize(cls, durations):
+        values = sorted(durations)
+        counts = [0] * (len(cls.BUCKETS) + 1)
+        for value in values:
+            counts[next((k for k, bound in enumerate(cls.BUCKETS) if value <= bound), len(cls.BUCKETS))] += 1
+        percentile = lambda q: values[min(int(q * len(values)), len(values) - 1)]
+        return {
+            "count": len(values),
+            "total_ms": sum(values),
+            "mean_ms": sum(values) / len(values),
+            "p50_ms": percentile(0.5),
+            "p90_ms": percentile(0.9),
+            "p99_ms": percentile(0.99),
+            "max_ms": values[-1],
+            # counts[k] holds the durations up to bucket_ms[k], the last one everything above
+            "histogram": {"bucket_ms": cls.BUCKETS, "counts": counts},
+        }
+
+    def report(self, iteration):
+        """Aggregates the regions since the last report; returns the report."""
+        if not self.enabled:
+            return None
+        self.flush()
+        report = {"iteration": iteration, "device": str(self.device),
+                  "regions": {name: self.summarize(values) for name, values in self.durations.items() if values}}
+        self.durations = {}
+        self.reports.append(report)
+        if self.report_path is not None:
+            with open(self.report_path, 'w') as f:
+                json.dump(self.reports, f, indent=1)
+        return report
+
+    def export_chrome_trace(self, path):
+        """Writes the kept iterations in the Chrome trace format (chrome://tracing, Perfetto)."""
+        if not self.enabled:
+            return
+        self.flush()
+        events = []
+        for iteration, spans in self.trace:
+            for name, start, end in spans:
+                events.append({"name": name, "ph": "X", "ts": start * 1000, "dur": (end - start) * 1000,
+                               "pid": 0, "tid": self.device.type, "args": {"iteration": iteration}})
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
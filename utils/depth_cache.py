@@ -0,0 +1,97 @@
+import os
+import hashlib
+import numpy as np
+import torch
+
+from utils.system_utils import mkdir_p
+
+# In-process memo so that the train/test/perturbation camera lists of one scene,
+# which all share the same perspective images, only hit the disk once per image.
+_memory_cache = {}
+_checkpoint_hashes = {}
+
+def hash_file(path, block_size=1 << 20):
+    """
+    Content hash of a (potentially large) checkpoint file. The digest is stored
+    next to the checkpoint together with its size and mtime so that subsequent
+    runs do not have to stream the whole file again.
+    """
+    path = os.path.abspath(path)
+    if path in _checkpoint_hashes:
+        return _checkpoint_hashes[path]
+
+    stat = os.stat(path)
+    stamp = "{} {}".format(stat.st_size, int(stat.st_mtime))
+    sidecar = path + ".sha1"
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            lines = f.read().splitlines()
+        if len(lines) == 2 and lines[0] == stamp:
+            _checkpoint_hashes[path] = lines[1]
+            return lines[1]
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    try:
+        with open(sidecar, 'w') as f:
+            f.write(stamp + "\n" + digest)
+    except OSError:
+        pass
+    _checkpoint_hashes[path] = digest
+    return digest
+
+def hash_image(image):
+    """
+    Content hash of a [C, H, W] image tensor (or array), shape included.
+    """
+    if torch.is_tensor(image):
+        image = image.detach().cpu().numpy()
+    image = np.ascontiguousarray(image, dtype=np.float32)
+    sha = hashlib.sha1()
+    sha.update(str(image.shape).encode())
+    sha.update(image.tobytes())
+    return sha.hexdigest()
+
+def depth_cache_key(image, ckpt_path):
+    h, w = image.shape[-2:]
+    key = "{}-{}-{}x{}".format(hash_image(image), hash_file(ckpt_path), w, h)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def cached_estimate_depth(image, cache_dir, estimate_fn, ckpt_path):
+    """
+    Returns the monocular depth of a [3, H, W] image as a numpy array, reading it
+    from the content-addressed cache in cache_dir if present and running
+    estimate_fn (and storing its result) otherwise.
+    """
+    key = depth_cache_key(image, ckpt_path)
+    if key in _memory_cache:
+        return _memory_cache[key]
+
+    cache_path = os.path.join(cache_dir, key[:2], key + ".npy")
+    if os.path.exists(cache_path):
+        try:
+            depth = np.load(cache_path)
+            _memory_cache[key] = depth
+            return depth
+        except (OSError, ValueError):
+            # Truncated or corrupt entry, recompute it below
+            pass
+
+    depth = estimate_fn(image).detach().cpu().numpy()
+
+    mkdir_p(os.path.dirname(cache_path))
+    # Write to a unique temporary name and rename, so concurrent runs sharing
+    # the cache never observe a partially written file
+    tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, depth)
+    os.replace(tmp_path, cache_path)
+
+    _memory_cache[key] = depth
+    return depth
+
+def clear_memory_cache():
+    _memory_cache.clear()
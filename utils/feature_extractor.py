@@ -1,30 +1,97 @@
 #from transformers import AutoImageProcessor, Dinov2Model
+import os
 import torch
-from datasets import load_dataset
 from torchvision.transforms import Compose
 from torchvision import transforms
 
+from utils.model_registry import get_model
+from utils.precision_utils import PRECISIONS, autocast, set_channels_last, run_inference
+from utils.depth_cache import hash_image
+from utils.system_utils import mkdir_p
 
-model =  torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14', force_reload=True).cuda()
 
-def get_Feature_from_DinoV2(tensor, model = model):
-    transform = Compose([
-        transforms.Resize(504, interpolation=transforms.InterpolationMode.BICUBIC),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ])
+# DINOv2 uses 14 pixel patches, input resolutions should be multiples of 14
+DINOV2_PRECISIONS = PRECISIONS
 
+_transforms = {}
 
+def _get_transform(resolution):
+    if resolution not in _transforms:
+        _transforms[resolution] = Compose([
+            transforms.Resize(resolution, interpolation=transforms.InterpolationMode.BICUBIC),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+        ])
+    return _transforms[resolution]
 
-    trans_img = transform(tensor).unsqueeze(0)
-    # feature = model.get_intermediate_layers(trans_img)
-    feature = model(trans_img)
+def get_Feature_from_DinoV2(tensor, model = None, resolution = 504, precision = "fp32", channels_last = False):
+    if model is None:
+        # DINOv2 is only loaded on the first call (see utils/model_registry.py)
+        model = get_model('dinov2').to(tensor.device)
+    set_channels_last(model, channels_last)
 
-    # print(trans_img)
-    # print(trans_img.shape)
-    # print(feature)
-    # print(feature[0].shape)
-    return feature
+    trans_img = _get_transform(resolution)(tensor).unsqueeze(0)
+    if channels_last:
+        trans_img = trans_img.contiguous(memory_format=torch.channels_last)
+    # feature = model.get_intermediate_layers(trans_img)
+    with autocast(tensor.device, precision):
+        feature = model(trans_img)
 
+    return feature.float()
 
+class ReferenceFeatureCache:
+    """
+    DINOv2 features of ground truth images, which do not change during
+    training. They are computed once per image, keyed by the image content,
+    and persisted to path (one file per resolution and precision) so later
+    runs on the same scene skip them entirely.
+    """
+    def __init__(self, path, resolution=504, precision="fp32", channels_last=False):
+        self.path = path
+        self.resolution = resolution
+        self.precision = precision
+        self.channels_last = channels_last
+        self.features = {}
+        self._camera_keys = {}
+        self._dirty = False
+        if path is not None and os.path.exists(path):
+            self.features = torch.load(path, map_location="cpu")
 
+    def get(self, camera, image_fn):
+        """
+        Features of camera's ground truth image. image_fn() returns that image
+        on the device; it is only called the first time a camera is seen, after
+        that the features are found by camera alone. Perturbed cameras share
+        the features of their base camera.
+        """
+        camera = getattr(camera, "base", camera)
+        key = self._camera_keys.get(id(camera))
+        feature = self.features.get(key) if key is not None else None
+        if feature is None:
+            image = image_fn()
+            key = hash_image(image)
+            self._camera_keys[id(camera)] = key
+            feature = self.features.get(key)
+            if feature is None:
+                feature = run_inference(get_Feature_from_DinoV2, image, resolution=self.resolution, precision=self.precision,
+                                        channels_last=self.channels_last)
+                self._dirty = True
+            # Kept on the device from now on, loaded features included
+            feature = feature.to(image.device)
+            self.features[key] = feature
+        return feature
 
+    def save(self, writer=None):
+        """
+        Writes the features if new ones were computed since the last save; with
+        an AsyncWriter the file is written on its background thread.
+        """
+        if self.path is None or not self._dirty:
+            return
+        self._dirty = False
+        if writer is not None:
+            writer.submit(self.path, dict(self.features), lambda path, data: torch.save(data, path))
+            return
+        mkdir_p(os.path.dirname(self.path))
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        torch.save({key: feature.cpu() for key, feature in self.features.items()}, tmp_path)
+        os.replace(tmp_path, self.path)
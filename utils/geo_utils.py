@@ -7,13 +7,11 @@ from kornia.morphology import erosion, dilation
 
 from trimesh.creation import icosphere as IcoSphere
 
+from utils.general_utils import default_device
 
-def _apply_rot(pts, rot_mat):
-    assert rot_mat.shape == (3, 3)
-    return torch.matmul(rot_mat, pts[..., None])[..., 0]
 
-def _verts_to_dirs(pt_a, pt_b, pt_c, gen_res, ratio):
-    # make pt_a the sole point
+def _orient_face(pt_a, pt_b, pt_c):
+    # make pt_a the sole point, and pt_b -> pt_c point to the right
     def same_z(a, b):
         return np.abs(a[2] - b[2]) < 1e-4
 
@@ -28,140 +26,128 @@ def _verts_to_dirs(pt_a, pt_b, pt_c, gen_res, ratio):
 
     if np.cross(pt_c, pt_b)[2] < 0.:
         pt_b, pt_c = pt_c, pt_b
+    return pt_a, pt_b, pt_c
 
-    pt_a = torch.from_numpy(pt_a).cuda()
-    pt_b = torch.from_numpy(pt_b).cuda()
-    pt_c = torch.from_numpy(pt_c).cuda()
-
+def _verts_to_dirs(pt_a, pt_b, pt_c, gen_res, ratio):
+    '''
+    Perspective views through all faces at once.
+    :param pt_a, pt_b, pt_c: [F, 3] oriented face vertices
+    :return: dirs [F, gen_res, gen_res, 3], pers_ratios [F, gen_res, gen_res, 1], to_vecs, down_vecs, right_vecs [F, 3]
+    '''
     pt_m = (pt_b + pt_c) * .5
     down_vec = pt_a - pt_m
-    if down_vec[2] > 0.:
-        down_vec = -down_vec
+    down_vec = torch.where(down_vec[:, 2:3] > 0., -down_vec, down_vec)
 
     pt_center = (pt_a + pt_b + pt_c) / 3.
     right_vec = pt_c - pt_b
 
-    right_len = torch.linalg.norm(right_vec, 2, -1).item()
-    down_len = torch.linalg.norm(down_vec, 2, -1).item()
-    half_len = torch.linalg.norm(pt_center - pt_b, 2, -1).item() * ratio
+    right_len = torch.linalg.norm(right_vec, 2, -1, True)
+    down_len = torch.linalg.norm(down_vec, 2, -1, True)
+    half_len = torch.linalg.norm(pt_center - pt_b, 2, -1, True) * ratio
     right_vec = right_vec / right_len * half_len
     down_vec = down_vec / down_len * half_len
     pt_base = pt_center - right_vec - down_vec
-    right_vec *= 2
-    down_vec *= 2
+    right_vec = right_vec * 2
+    down_vec = down_vec * 2
 
     ii, jj = torch.meshgrid(torch.linspace(.5 / gen_res, 1. - .5 / gen_res, gen_res),
                             torch.linspace(.5 / gen_res, 1. - .5 / gen_res, gen_res),
                             indexing='ij')
-    ii = ii.cuda()
-    jj = jj.cuda()
     to_vec = pt_base + right_vec * .5 + down_vec * .5
 
-    dirs = pt_base[None, None, :] + \
-           down_vec[None, None, :] * ii[:, :, None] + \
-           right_vec[None, None, :] * jj[:, :, None]
+    dirs = pt_base[:, None, None, :] + \
+           down_vec[:, None, None, :] * ii[None, :, :, None] + \
+           right_vec[:, None, None, :] * jj[None, :, :, None]
 
-    pers_ratios = torch.linalg.norm(dirs, 2, -1, True) / torch.linalg.norm(to_vec, 2, -1, True)[None, None]
+    pers_ratios = torch.linalg.norm(dirs, 2, -1, True) / torch.linalg.norm(to_vec, 2, -1, True)[:, None, None]
 
     dirs = dirs / torch.linalg.norm(dirs, 2, -1, True)
     return dirs, pers_ratios, to_vec, down_vec * .5, right_vec * .5
 
+# Canonical (unrotated) view grids per (gen_res, ratio, device); they only
+# depend on the icosahedron, so they are built once. The cached tensors are
+# shared between callers and must not be modified in place.
+_pers_directions = {}
+
+def _canonical_pers_directions(gen_res, ratio, device):
+    key = (gen_res, float(ratio), torch.device(device))
+    if key not in _pers_directions:
+        cpu_key = (gen_res, float(ratio), torch.device('cpu'))
+        if cpu_key not in _pers_directions:
+            ico_sphere = IcoSphere(subdivisions=0)
+            vertices, faces = ico_sphere.vertices, ico_sphere.faces
+            ang = np.arctan(.525731112119133606 / .850650808352039932)
+            rot_vec = np.array([ang, 0., 0.])
+            rot = Rotation.from_rotvec(rot_vec)
+            vertices = rot.apply(vertices)
+            vertices = vertices.astype(np.float32)
+
+            oriented = [_orient_face(vertices[face[0]].copy(), vertices[face[1]].copy(), vertices[face[2]].copy()) for face in faces]
+            pt_a, pt_b, pt_c = [torch.from_numpy(np.stack(pts)) for pts in zip(*oriented)]
+            _pers_directions[cpu_key] = _verts_to_dirs(pt_a, pt_b, pt_c, gen_res=gen_res, ratio=ratio)
+        _pers_directions[key] = tuple(t.to(device) for t in _pers_directions[cpu_key])
+    return _pers_directions[key]
+
+def _yaw_matrices(angles):
+    rot_vecs = np.zeros((len(angles), 3))
+    rot_vecs[:, 2] = angles
+    return torch.from_numpy(Rotation.from_rotvec(rot_vecs).as_matrix().astype(np.float32))
 
 @torch.no_grad()
-def panorama_to_pers_directions(gen_res=512, ratio=1.):
+def panorama_to_pers_directions(gen_res=512, ratio=1., ex_rot=None, device=None):
     '''
-    :param img: [H, W, C]
+    Split too may perspective cameras that covers the whole sphere
     :param gen_res:
-    :return:
+    :param ex_rot: None, or 'rand' for a random rotation about the z axis
+    :return: dirs [20, gen_res, gen_res, 3], ratios [20, gen_res, gen_res, 1], to_vecs, down_vecs, right_vecs [20, 3]
+    '''
+    if ex_rot is None:
+        return _canonical_pers_directions(gen_res, ratio, device or default_device())
+
+    if isinstance(ex_rot, str) and ex_rot == 'rand':
+        return random_yaw_pers_directions(1, gen_res=gen_res, ratio=ratio, device=device)
+
+    raise NotImplementedError
+
+@torch.no_grad()
+def random_yaw_pers_directions(n_rot, gen_res=512, ratio=1., device=None):
+    '''
+    The 20 icosahedron views under n_rot random rotations about the z axis,
+    rotation by rotation: the same as n_rot calls of
+    panorama_to_pers_directions(ex_rot='rand') concatenated, including the
+    random angles drawn, but with one batched rotation.
+    :return: dirs [n_rot * 20, gen_res, gen_res, 3], ratios [n_rot * 20, gen_res, gen_res, 1], to_vecs, down_vecs, right_vecs [n_rot * 20, 3]
     '''
-    ico_sphere = IcoSphere(subdivisions=0)
-    vertices, faces = ico_sphere.vertices, ico_sphere.faces
-    ang = np.arctan(.525731112119133606 / .850650808352039932)
-    rot_vec = np.array([ang, 0., 0.])
-    rot = Rotation.from_rotvec(rot_vec)
-    vertices = rot.apply(vertices)
-    vertices = vertices.astype(np.float32)
-
-    # Generate coords for each face
-    all_dirs = []
-    all_ratios = []
-    to_vecs = []
-    down_vecs = []
-    right_vecs = []
-
-    for i in range(len(faces)):
-        face = faces[i]
-        pt_a, pt_b, pt_c = vertices[face[0]].copy(), vertices[face[1]].copy(), vertices[face[2]].copy()
-
-        dirs, ratios, to_vec, down_vec, right_vec = _verts_to_dirs(pt_a, pt_b, pt_c, gen_res=gen_res, ratio=ratio)
-        all_dirs.append(dirs)
-        all_ratios.append(ratios)
-        to_vecs.append(to_vec)
-        down_vecs.append(down_vec)
-        right_vecs.append(right_vec)
-
-    return torch.stack(all_dirs, dim=0),\
-           torch.stack(all_ratios, dim=0),\
-           torch.stack(to_vecs, dim=0),\
-           torch.stack(down_vecs, dim=0),\
-           torch.stack(right_vecs, dim=0)
+    return yaw_pers_directions(random_yaw_angles(n_rot), gen_res=gen_res, ratio=ratio, device=device)
+
+def random_yaw_angles(n_rot):
+    return np.random.rand(n_rot) * 2. * np.pi
 
 @torch.no_grad()
-def panorama_to_pers_directions(gen_res=512, ratio=1., ex_rot=None):
+def yaw_pers_directions(angles, gen_res=512, ratio=1., device=None, views=None):
     '''
-    Split too may perspective cameras that covers the whole sphere
-    :param img: [H, W, C]
-    :param gen_res:
-    :return:
+    The 20 icosahedron views rotated about the z axis by every angle, indexed
+    rotation by rotation (view v is face v % 20 under angles[v // 20]).
+    :param views: None for all len(angles) * 20 views, or the indices of the views to build
+    :return: dirs [V, gen_res, gen_res, 3], ratios [V, gen_res, gen_res, 1], to_vecs, down_vecs, right_vecs [V, 3]
     '''
-    ico_sphere = IcoSphere(subdivisions=0)
-    vertices, faces = ico_sphere.vertices, ico_sphere.faces
-    ang = np.arctan(.525731112119133606 / .850650808352039932)
-    rot_vec = np.array([ang, 0., 0.])
-    rot = Rotation.from_rotvec(rot_vec)
-    vertices = rot.apply(vertices)
-    vertices = vertices.astype(np.float32)
-
-    # Generate coords for each face
-    all_dirs = []
-    all_ratios = []
-    to_vecs = []
-    down_vecs = []
-    right_vecs = []
-
-    for i in range(len(faces)):
-        face = faces[i]
-        pt_a, pt_b, pt_c = vertices[face[0]].copy(), vertices[face[1]].copy(), vertices[face[2]].copy()
-
-        dirs, ratios, to_vec, down_vec, right_vec = _verts_to_dirs(pt_a, pt_b, pt_c, gen_res=gen_res, ratio=ratio)
-        all_dirs.append(dirs)
-        all_ratios.append(ratios)
-        to_vecs.append(to_vec)
-        down_vecs.append(down_vec)
-        right_vecs.append(right_vec)
-
-    all_dirs = torch.stack(all_dirs, dim=0)
-    all_ratios = torch.stack(all_ratios, dim=0)
-    to_vecs = torch.stack(to_vecs, dim=0)
-    down_vecs = torch.stack(down_vecs, dim=0)
-    right_vecs = torch.stack(right_vecs, dim=0)
+    all_dirs, all_ratios, to_vecs, down_vecs, right_vecs = _canonical_pers_directions(gen_res, ratio, device or default_device())
+    rots = _yaw_matrices(angles).to(all_dirs.device)
+    n_faces = len(to_vecs)
 
-    if ex_rot is None:
-        return all_dirs, all_ratios, to_vecs, down_vecs, right_vecs
+    if views is None:
+        def rotate(pts):
+            return torch.einsum('rij,f...j->rf...i', rots, pts).flatten(0, 1)
 
-    if isinstance(ex_rot, str) and ex_rot == 'rand':
-        ang = np.random.rand() * 2. * np.pi
-        rot_vec = np.array([0., 0., ang])
-        rot = Rotation.from_rotvec(rot_vec).as_matrix().astype(np.float32)
-        rot = torch.from_numpy(rot).to(all_dirs.device)
-        all_dirs = _apply_rot(all_dirs, rot)
-        to_vecs = _apply_rot(to_vecs, rot)
-        down_vecs = _apply_rot(down_vecs, rot)
-        right_vecs = _apply_rot(right_vecs, rot)
-        return all_dirs, all_ratios, to_vecs, down_vecs, right_vecs
+        return rotate(all_dirs), all_ratios.repeat(len(rots), 1, 1, 1), rotate(to_vecs), rotate(down_vecs), rotate(right_vecs)
 
-    raise NotImplementedError
+    views = torch.as_tensor(views, dtype=torch.long, device=all_dirs.device)
+    view_rots, faces = rots[views // n_faces], views % n_faces
+
+    def rotate(pts):
+        return torch.einsum('vij,v...j->v...i', view_rots, pts[faces])
 
+    return rotate(all_dirs), all_ratios[faces], rotate(to_vecs), rotate(down_vecs), rotate(right_vecs)
 
 
 @torch.no_grad()
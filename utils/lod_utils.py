@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import torch
+
+from utils.general_utils import build_rotation, rotation_matrix_to_quaternion
+from utils.morton_utils import morton_order, points_bbox, cell_ids, cell_bounds
+from utils.compact_utils import write_compact, CompactReader, GAUSSIAN_SECTIONS
+from utils.system_utils import mkdir_p
+
+# Level-of-detail export of a GaussianModel. Gaussians are sorted along the
+# Morton curve and split into chunks, one per non-empty octree cell of depth
+# chunk_depth. Level 0 holds the original Gaussians; every further level merges
+# the Gaussians sharing an octree cell one depth coarser than the previous one.
+# Since merging never crosses a chunk cell, all levels have the same chunks and
+# a loader can pick the level of every chunk independently.
+#
+#   <out_dir>/lod.json       bounding box, chunk depth and per level chunk table
+#   <out_dir>/level_<k>.gsc  compact container, rows ordered by chunk
+
+LOD_VERSION = 1
+
+def merge_gaussians(xyz, scales, rotations, opacities, f_dc, f_rest, groups, num_groups):
+    """
+    Merges activated Gaussians ([N, 3] positions and scales, [N, 4] rotations,
+    [N, 1] opacities, flattened SH) by group index into num_groups Gaussians
+    that match the opacity- and size-weighted first and second moments.
+    """
+    def group_sum(values):
+        out = torch.zeros((num_groups,) + values.shape[1:], dtype=values.dtype, device=values.device)
+        return out.index_add_(0, groups, values)
+
+    area = scales.prod(dim=1).pow(2.0 / 3.0)
+    weights = opacities[:, 0] * area + 1e-12
+    total = group_sum(weights)
+
+    mean = group_sum(weights[:, None] * xyz) / total[:, None]
+    R = build_rotation(rotations)
+    cov = R @ torch.diag_embed(scales ** 2) @ R.transpose(1, 2)
+    offset = xyz - mean[groups]
+    cov = cov + offset[:, :, None] * offset[:, None, :]
+    cov = group_sum(weights[:, None, None] * cov) / total[:, None, None]
+
+    eigenvalues, eigenvectors = torch.linalg.eigh(cov)
+    # eigh may return a reflection, flip one axis to get a proper rotation
+    reflected = torch.linalg.det(eigenvectors) < 0
+    eigenvectors[reflected, :, 2] *= -1
+    merged_scales = eigenvalues.clamp(min=1e-12).sqrt()
+    merged_rotations = rotation_matrix_to_quaternion(eigenvectors)
+
+    # Children compositing over each other can not be more opaque than their
+    # union, and not cover more than their total area
+    transmittance = torch.exp(group_sum(torch.log1p(-opacities.clamp(max=0.999))))
+    coverage = group_sum(opacities * area[:, None]) / merged_scales.prod(dim=1, keepdim=True).pow(2.0 / 3.0)
+    merged_opacities = torch.min(1 - transmittance, coverage).clamp(1e-4, 0.999)
+
+    merged_f_dc = group_sum(weights[:, None] * f_dc) / total[:, None]
+    merged_f_rest = group_sum(weights[:, None] * f_rest) / total[:, None]
+    return mean, merged_scales, merged_rotations, merged_opacities, merged_f_dc, merged_f_rest
+
+def _write_level(path, level, sh_degree):
+    center = ((level["xyz"].min(dim=0).values + level["xyz"].max(dim=0).values) / 2) if level["xyz"].shape[0] > 0 else torch.zeros(3)
+    values = {
+        "xyz": level["xyz"] - center.to(level["xyz"].device),
+        "f_dc": level["f_dc"],
+        "f_rest": level["f_rest"],
+        "opacity": level["opacity"],
+        "scaling": torch.log(level["scaling"]),
+        "rotation": level["rotation"],
+    }
+    sections = {name: (values[name].cpu().numpy(), encoding) for name, encoding in GAUSSIAN_SECTIONS.items()}
+    write_compact(path, sections, {"sh_degree": sh_degree, "xyz_offset": center.tolist()})
+
+def _chunk_table(level, chunk_depth, bbox_min, bbox_max):
+    cells, counts = torch.unique_consecutive(cell_ids(level["codes"], chunk_depth), return_counts=True)
+    starts = torch.cumsum(counts, dim=0) - counts
+    groups = torch.repeat_interleave(torch.arange(cells.shape[0], device=cells.device), counts)
+    # Pad the cell bounds by the largest 3 sigma extent of the Gaussians in the chunk
+    pad = torch.zeros(cells.shape[0], device=cells.device).scatter_reduce(
+        0, groups, 3 * level["scaling"].max(dim=1).values, reduce="amax", include_self=True)
+    lower, upper = cell_bounds(cells, chunk_depth, bbox_min, bbox_max)
+    lower = lower - pad[:, None]
+    upper = upper + pad[:, None]
+    return [[int(c), int(s), int(n)] + lo + hi for c, s, n, lo, hi in
+            zip(cells.tolist(), starts.tolist(), counts.tolist(), lower.tolist(), upper.tolist())]
+
+@torch.no_grad()
+def export_lod(gaussians, out_dir, num_levels=3, chunk_depth=4, merge_depth=10):
+    """
+    Writes gaussians as a chunked level-of-detail hierarchy to out_dir. Level
+    k > 0 merges the Gaussians of each octree cell of depth
+    merge_depth - (k - 1), but never coarser than chunk_depth.
+    """
+    mkdir_p(out_dir)
+    xyz = gaussians.get_xyz
+    bbox_min, bbox_max = points_bbox(xyz)
+    order, codes = morton_order(xyz, bbox_min, bbox_max)
+    level = {
+        "xyz": xyz[order],
+        "f_dc": gaussians._features_dc[order].transpose(1, 2).flatten(start_dim=1),
+        "f_rest": gaussians._features_rest[order].transpose(1, 2).flatten(start_dim=1),
+        "opacity": gaussians.get_opacity[order],
+        "scaling": gaussians.get_scaling[order],
+        "rotation": gaussians.get_rotation[order],
+        "codes": codes,
+    }
+
+    levels = []
+    for k in range(num_levels):
+        depth = None
+        if k > 0:
+            depth = max(chunk_depth, merge_depth - (k - 1))
+            keys, groups, counts = torch.unique_consecutive(cell_ids(level["codes"], depth), return_inverse=True, return_counts=True)
+            merged = merge_gaussians(level["xyz"], level["scaling"], level["rotation"], level["opacity"],
+                                     level["f_dc"], level["f_rest"], groups, keys.shape[0])
+            first = torch.cumsum(counts, dim=0) - counts
+            # The first child's code keeps the merged Gaussians sorted and in the same chunk
+            merged_codes = level["codes"][first]
+            level = dict(zip(("xyz", "scaling", "rotation", "opacity", "f_dc", "f_rest"), merged))
+            level["codes"] = merged_codes
+
+        file_name = "level_{}.gsc".format(k)
+        _write_level(os.path.join(out_dir, file_name), level, gaussians.max_sh_degree)
+        levels.append({
+            "file": file_name,
+            "num_points": int(level["xyz"].shape[0]),
+            "merge_depth": depth,
+            "chunks": _chunk_table(level, chunk_depth, bbox_min, bbox_max),
+        })
+        print("LOD level {}: {} Gaussians in {} chunks".format(k, levels[-1]["num_points"], len(levels[-1]["chunks"])))
+
+    with open(os.path.join(out_dir, "lod.json"), 'w') as f:
+        json.dump({
+            "version": LOD_VERSION,
+            "sh_degree": gaussians.max_sh_degree,
+            "bbox_min": bbox_min.tolist(),
+            "bbox_max": bbox_max.tolist(),
+            "chunk_depth": chunk_depth,
+            "levels": levels,
+        }, f)
+
+def frustum_intersects(lower, upper, full_proj_transform):
+    """
+    Conservative frustum test of [C, 3] axis aligned boxes against a camera's
+    (row-vector) full projection matrix: a box is rejected only when all its
+    corners lie outside the same clipping plane.
+    """
+    corners = torch.stack([torch.stack([
+        (upper if i & 1 else lower)[:, 0],
+        (upper if i & 2 else lower)[:, 1],
+        (upper if i & 4 else lower)[:, 2]], dim=-1) for i in range(8)], dim=1)
+    corners = torch.cat([corners, torch.ones_like(corners[..., :1])], dim=-1)
+    clip = corners @ full_proj_transform.to(corners.device, corners.dtype)
+    x, y, z, w = clip.unbind(dim=-1)
+    outside = torch.stack([x < -w, x > w, y < -w, y > w, z < 0, z > w], dim=-1).all(dim=1)
+    return ~outside.any(dim=-1)
+
+class LODScene:
+    """
+    Loader for an export_lod directory that only reads the chunks intersecting
+    a camera's frustum, at a level chosen from their distance to the camera.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "lod.json")) as f:
+            self.meta = json.load(f)
+        self.bbox_min = torch.tensor(self.meta["bbox_min"])
+        self.bbox_max = torch.tensor(self.meta["bbox_max"])
+        self.readers = [CompactReader(os.path.join(path, level["file"])) for level in self.meta["levels"]]
+        self.tables = [torch.tensor(level["chunks"], dtype=torch.float64).reshape(-1, 9) for level in self.meta["levels"]]
+
+    @property
+    def num_levels(self):
+        return len(self.readers)
+
+    def select(self, camera, lod_distances=None):
+        """
+        Returns, per level, the (start, count) row ranges of the chunks to load
+        for camera. Chunks whose centre is closer than lod_distances[0] are
+        loaded at level 0, closer than lod_distances[1] at level 1 and so on;
+        without lod_distances everything is loaded at level 0.
+        """
+        lod_distances = list(lod_distances or [])[:self.num_levels - 1]
+        cells = self.tables[0][:, 0].long()
+        lower, upper = cell_bounds(cells, self.meta["chunk_depth"], self.bbox_min.double(), self.bbox_max.double())
+        distance = ((lower + upper) / 2 - camera.camera_center.detach().cpu().double()).norm(dim=-1)
+        chunk_level = torch.bucketize(distance, torch.tensor(lod_distances, dtype=torch.float64), right=True)
+
+        selection = []
+        for k, table in enumerate(self.tables):
+            # Every level has the same chunk cells in the same order
+            visible = frustum_intersects(table[:, 3:6], table[:, 6:9], camera.full_proj_transform.detach().cpu().double())
+            chosen = table[visible & (chunk_level == k)]
+            selection.append([(int(start), int(count)) for start, count in chosen[:, 1:3].tolist()])
+        return selection
+
+    def load(self, gaussians, camera, lod_distances=None):
+        """Fills gaussians with the chunks selected for camera."""
+        parts = [gaussians.decode_compact(reader, row_ranges)
+                 for reader, row_ranges in zip(self.readers, self.select(camera, lod_distances)) if row_ranges]
+        if not parts:
+            parts = [gaussians.decode_compact(self.readers[0], [])]
+        gaussians.set_parameters(*[torch.cat(tensors, dim=0) for tensors in zip(*parts)])
+
+if __name__ == '__main__':
+    # Exports a trained point cloud as a chunked LOD hierarchy
+    from argparse import ArgumentParser
+    from scene.gaussian_model import GaussianModel
+
+    parser = ArgumentParser(description="Level-of-detail export")
+    parser.add_argument("--ply", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--sh_degree", type=int, default=3)
+    parser.add_argument("--num_levels", type=int, default=3)
+    parser.add_argument("--chunk_depth", type=int, default=4)
+    parser.add_argument("--merge_depth", type=int, default=10)
+    args = parser.parse_args(sys.argv[1:])
+
+    gaussians = GaussianModel(args.sh_degree)
+    gaussians.load_ply(args.ply)
+    export_lod(gaussians, args.output, args.num_levels, args.chunk_depth, args.merge_depth)
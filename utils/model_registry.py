@@ -0,0 +1,91 @@
+import os
+import gc
+import torch
+
+# Auxiliary networks (monocular depth, DINOv2, the panorama diffusion pipeline) are loaded on first use instead of
+# at import time, so that render-only and export jobs never pay for them.
+# Weights are looked up in WEIGHTS_DIR, which can be overridden with the
+# DREAMSCENE360_WEIGHTS environment variable.
+WEIGHTS_DIR = os.environ.get("DREAMSCENE360_WEIGHTS", "pre_checkpoints")
+
+_loaders = {}
+_models = {}
+
+def weights_path(*names):
+    return os.path.join(WEIGHTS_DIR, *names)
+
+def register_model(name, loader):
+    _loaders[name] = loader
+
+def get_model(name):
+    if name not in _models:
+        if name not in _loaders:
+            raise KeyError("Unknown model '{}', registered models: {}".format(name, sorted(_loaders)))
+        model = _loaders[name]()
+        if isinstance(model, torch.nn.Module):
+            # Auxiliary networks are never trained here, gradients only flow through them to their input
+            model.eval()
+            model.requires_grad_(False)
+        _models[name] = model
+    return _models[name]
+
+def is_loaded(name):
+    return name in _models
+
+def unload_model(name=None):
+    """
+    Drops a loaded model (or all of them when name is None) and releases the
+    memory it held. The next get_model call loads it again.
+    """
+    names = list(_models) if name is None else [name]
+    for n in names:
+        _models.pop(n, None)
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def load_omnidata_depth():
+    from geo_predictors.omnidata.modules.midas.dpt_depth import DPTDepthModel
+
+    ckpt_path = weights_path('omnidata_dpt_depth_v2.ckpt')
+    # The ImageNet backbone weights are overwritten by the checkpoint, do not download them
+    model = DPTDepthModel(backbone='vitb_rn50_384', num_channels=1, use_pretrained=False)
+    checkpoint = torch.load(ckpt_path, map_location=torch.device('cpu'))
+    if 'state_dict' in checkpoint:
+        state_dict = {}
+        for k, v in checkpoint['state_dict'].items():
+            state_dict[k[6:]] = v
+    else:
+        state_dict = checkpoint
+
+    model.load_state_dict(state_dict)
+    return model
+
+def load_dinov2():
+    """
+    Loads DINOv2 ViT-B/14, preferring local files so that it works offline:
+    a clone of the facebookresearch/dinov2 repository in <weights>/dinov2 and the
+    pretrained weights in <weights>/dinov2_vitb14_pretrain.pth. Missing pieces
+    fall back to the torch hub cache, which only needs the network once.
+    """
+    local_repo = weights_path('dinov2')
+    local_weights = weights_path('dinov2_vitb14_pretrain.pth')
+    has_weights = os.path.exists(local_weights)
+
+    if os.path.isdir(local_repo):
+        model = torch.hub.load(local_repo, 'dinov2_vitb14', source='local', pretrained=not has_weights)
+    else:
+        model = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14', pretrained=not has_weights)
+
+    if has_weights:
+        model.load_state_dict(torch.load(local_weights, map_location=torch.device('cpu')))
+    return model
+
+def load_stitch_diffusion():
+    import importlib
+    sdk = importlib.import_module('stitch_diffusion.kohya_trainer.StitchDiffusionPipeline')
+    return sdk.StitchDiffusion(sdk.my_args)
+
+register_model('omnidata_depth', load_omnidata_depth)
+register_model('dinov2', load_dinov2)
+register_model('stitch_diffusion', load_stitch_diffusion)
@@ -0,0 +1,103 @@
+import torch
+
+# Morton (Z-order) codes interleave the bits of quantized x, y and z, so that
+# sorting by code groups points of the same octree cell together at every
+# depth: the cell of depth d that contains a point is code >> 3 * (MORTON_BITS - d).
+
+MORTON_BITS = 21
+
+def _spread_bits(v):
+    """Inserts two zero bits between each of the lower 21 bits of an int64 tensor."""
+    v = v & 0x1fffff
+    v = (v | (v << 32)) & 0x1f00000000ffff
+    v = (v | (v << 16)) & 0x1f0000ff0000ff
+    v = (v | (v << 8)) & 0x100f00f00f00f00f
+    v = (v | (v << 4)) & 0x10c30c30c30c30c3
+    v = (v | (v << 2)) & 0x1249249249249249
+    return v
+
+def points_bbox(points):
+    """Axis aligned bounding box of [N, 3] points as ([3], [3]) tensors."""
+    return points.min(dim=0).values, points.max(dim=0).values
+
+def morton_encode(points, bbox_min=None, bbox_max=None):
+    """
+    63-bit Morton codes of [N, 3] points, quantized on a 2^21 grid over the
+    given bounding box (the points' own bounding box by default).
+    """
+    if bbox_min is None or bbox_max is None:
+        bbox_min, bbox_max = points_bbox(points)
+    extent = (bbox_max - bbox_min).clamp(min=1e-12)
+    grid = ((points - bbox_min) / extent * (1 << MORTON_BITS)).long().clamp(0, (1 << MORTON_BITS) - 1)
+    return _spread_bits(grid[:, 0]) | (_spread_bits(grid[:, 1]) << 1) | (_spread_bits(grid[:, 2]) << 2)
+
+def morton_order(points, bbox_min=None, bbox_max=None):
+    """Returns (permutation, sorted codes) that sorts the points along the Z-order curve."""
+    codes = morton_encode(points, bbox_min, bbox_max)
+    codes, order = torch.sort(codes)
+    return order, codes
+
+def cell_ids(codes, depth):
+    """Octree cell of depth `depth` (0 = root) that contains each code."""
+    return codes >> (3 * (MORTON_BITS - depth))
+
+def cell_bounds(cells, depth, bbox_min, bbox_max):
+    """Axis aligned bounds ([C, 3], [C, 3]) of octree cells of the given depth."""
+    coords = []
+    for axis in range(3):
+        c = torch.zeros_like(cells)
+        for bit in range(depth):
+            c |= ((cells >> (3 * bit + axis)) & 1) << bit
+        coords.append(c)
+    coords = torch.stack(coords, dim=-1).to(bbox_min.dtype)
+    size = (bbox_max - bbox_min) / (1 << depth)
+    lower = bbox_min + coords * size
+    return lower, lower + size
+
+if __name__ == '__main__':
+    # Measures gather/scatter locality of spatially coherent index sets (such as
+    # the Gaussians visible in one view or tile) before and after Morton sorting
+    import sys
+    import time
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Morton order locality benchmark")
+    parser.add_argument("--num_points", type=int, default=2_000_000)
+    parser.add_argument("--num_queries", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=59, help="Floats per Gaussian (59 for SH degree 3)")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args(sys.argv[1:])
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    # Clustered points in random memory order, as left behind by densification
+    centers = torch.rand(256, 3, device=device)
+    points = centers[torch.randint(0, 256, (args.num_points,), device=device)] + 0.02 * torch.randn(args.num_points, 3, device=device)
+    data = torch.randn(args.num_points, args.channels, device=device)
+    boxes = torch.rand(args.num_queries, 3, device=device) * 0.9
+
+    def synchronize():
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    def run(label, points, data):
+        queries = [torch.nonzero(((points >= lo) & (points < lo + 0.1)).all(dim=1)).squeeze(1) for lo in boxes]
+        gaps = torch.cat([q.diff() for q in queries if q.numel() > 1]).float()
+        out = torch.zeros_like(data)
+        synchronize()
+        start = time.perf_counter()
+        for q in queries:
+            data[q]
+        synchronize()
+        gather = time.perf_counter() - start
+        start = time.perf_counter()
+        for q in queries:
+            out.index_add_(0, q, data[:q.numel()])
+        synchronize()
+        scatter = time.perf_counter() - start
+        print("{:<10s} gather {:7.2f} ms  scatter {:7.2f} ms  median index gap {:8.1f}".format(
+            label, gather * 1000, scatter * 1000, gaps.median().item()))
+
+    run("random", points, data)
+    order, _ = morton_order(points)
+    run("morton", points[order], data[order])
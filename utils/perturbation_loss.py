@@ -0,0 +1,94 @@
+import torch
+from contextlib import nullcontext
+
+from utils.depth_utils import estimate_depth
+from utils.feature_extractor import get_Feature_from_DinoV2
+from utils.loss_utils import pearson_correlation, cosine_similarity_loss
+
+PERTURBATION_DEPTH_TARGETS = ("main", "mono", "none")
+
+class PerturbationLoss:
+    """
+    Losses of the rendered perturbation views.
+
+    The depth term is selected by opt.perturbation_depth_target:
+      "main"  the Pearson depth loss of the main view counted once more, which
+              is what training always did, and needs no depth network;
+      "mono"  Pearson loss between the depth rendered from the perturbation view
+              and the monocular depth of that render. The depth network only
+              runs on every opt.perturbation_depth_interval-th visit of a
+              camera, the visits in between reuse its cached target. The
+              cache holds one target per camera of the current curriculum
+              stage and is dropped when the stage changes;
+      "none"  no depth term.
+    The feature term compares DINOv2 features of the render with the cached
+    features of the camera's reference image. With a StepProfiler the depth
+    network and DINOv2 are timed as regions "perturbation_depth" and "dino".
+    """
+    def __init__(self, opt, reference_features, camera_store, profiler=None):
+        self.depth_target = getattr(opt, "perturbation_depth_target", "main")
+        assert self.depth_target in PERTURBATION_DEPTH_TARGETS, "Unknown perturbation depth target '{}'".format(self.depth_target)
+        self.depth_interval = max(1, getattr(opt, "perturbation_depth_interval", 1))
+        self.depth_weight = getattr(opt, "perturbation_depth_weight", 0.05)
+        self.feature_weight = getattr(opt, "feature_loss_weight", 0.05)
+        self.depth_precision = getattr(opt, "depth_precision", "fp32")
+        self.channels_last = getattr(opt, "aux_channels_last", False)
+        self.reference_features = reference_features
+        self.camera_store = camera_store
+        self.profiler = profiler
+        self._depth_targets = {}
+        self._depth_stage = None
+
+    def _region(self, name):
+        return self.profiler.region(name) if self.profiler is not None else nullcontext()
+
+    def _estimate_depth(self, image):
+        return estimate_depth(image.detach(), precision=self.depth_precision, channels_last=self.channels_last)
+
+    def _mono_depth_target(self, camera, image):
+        if self.depth_interval <= 1:
+            return self._estimate_depth(image)
+        # Cameras are drawn once per pass over all base cameras, so the
+        # interval counts visits of a camera rather than iterations
+        stage = getattr(camera, "stage", None)
+        if stage != self._depth_stage:
+            self._depth_targets.clear()
+            self._depth_stage = stage
+        key = id(getattr(camera, "base", camera))
+        cached = self._depth_targets.get(key)
+        if cached is None or cached[0] >= self.depth_interval:
+            cached = [0, self._estimate_depth(image)]
+            self._depth_targets[key] = cached
+        cached[0] += 1
+        return cached[1]
+
+    def __call__(self, iteration, camera, render_pkg, rendered_depth, gt_depth):
+        """
+        Returns (weighted total, depth loss, feature loss) for a perturbation
+        camera and its render_pkg; rendered_depth and gt_depth belong to the
+        main view of the step.
+        """
+        image = render_pkg["render"]
+        zero = torch.zeros((), device=image.device)
+        total = zero
+
+        loss_depth = zero
+        if self.depth_target == "main":
+            loss_depth = 1 - pearson_correlation(rendered_depth, - gt_depth)
+        elif self.depth_target == "mono":
+            with self._region("perturbation_depth"):
+                target = self._mono_depth_target(camera, image)
+                loss_depth = 1 - pearson_correlation(render_pkg["depth"], - target)
+        total = total + self.depth_weight * loss_depth
+
+        loss_feature = zero
+        if self.feature_weight > 0:
+            with self._region("dino"):
+                pred_feature = get_Feature_from_DinoV2(image, resolution=self.reference_features.resolution,
+                                                       precision=self.reference_features.precision, channels_last=self.channels_last)
+                # The ground truth image is only uploaded when its features are not cached yet
+                reference = self.reference_features.get(camera, lambda: self.camera_store.fetch(camera)[0])
+                loss_feature = cosine_similarity_loss(pred_feature, reference)
+            total = total + self.feature_weight * loss_feature
+
+        return total, loss_depth, loss_feature
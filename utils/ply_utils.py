@@ -0,0 +1,141 @@
+import os
+import sys
+import numpy as np
+
+# Gaussian PLY files are a single 'vertex' element of float32 properties, i.e.
+# the payload is exactly a row-major [N, K] float32 array. Reading and writing
+# it as such avoids plyfile's per-vertex Python tuples, which dominate the I/O
+# time of multi-million Gaussian scenes.
+
+_PLY_FLOAT_TYPES = ('float', 'float32')
+
+def write_vertex_ply(path, attribute_names, columns):
+    """
+    Writes a binary little-endian PLY with one float32 property per attribute
+    name. columns is a sequence of [N] or [N, k] arrays whose widths add up to
+    len(attribute_names); they are packed into one contiguous buffer.
+    """
+    num_points = columns[0].shape[0]
+    data = np.empty((num_points, len(attribute_names)), dtype='<f4')
+    start = 0
+    for column in columns:
+        column = np.asarray(column).reshape(num_points, -1)
+        data[:, start:start + column.shape[1]] = column
+        start += column.shape[1]
+    assert start == len(attribute_names), "Got {} columns for {} attributes".format(start, len(attribute_names))
+
+    header = ["ply", "format binary_little_endian 1.0", "element vertex {}".format(num_points)]
+    header += ["property float {}".format(name) for name in attribute_names]
+    header.append("end_header")
+    with open(path, 'wb') as f:
+        f.write(("\n".join(header) + "\n").encode('ascii'))
+        data.tofile(f)
+
+def _read_header(path):
+    """
+    Returns (header_size, format, elements) where elements is a list of
+    (name, count, [(property_type, property_name), ...]).
+    """
+    elements = []
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError("{} is not a PLY file".format(path))
+        fmt = None
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError("{} has no end_header".format(path))
+            tokens = line.decode('ascii').split()
+            if not tokens or tokens[0] in ('comment', 'obj_info'):
+                continue
+            if tokens[0] == 'end_header':
+                break
+            if tokens[0] == 'format':
+                fmt = tokens[1]
+            elif tokens[0] == 'element':
+                elements.append((tokens[1], int(tokens[2]), []))
+            elif tokens[0] == 'property':
+                elements[-1][2].append((tokens[1], tokens[-1]))
+        return f.tell(), fmt, elements
+
+def read_vertex_ply(path, mmap=False):
+    """
+    Reads the 'vertex' element of a PLY as (attribute_names, [N, K] float32
+    array). Files in the layout written by write_vertex_ply are read with a
+    single np.fromfile, or mapped without reading when mmap is set; anything
+    else goes through plyfile.
+    """
+    header_size, fmt, elements = _read_header(path)
+    if (fmt == 'binary_little_endian' and elements and elements[0][0] == 'vertex'
+            and all(t in _PLY_FLOAT_TYPES for t, _ in elements[0][2])):
+        _, num_points, properties = elements[0]
+        names = [name for _, name in properties]
+        shape = (num_points, len(names))
+        if mmap:
+            data = np.memmap(path, dtype='<f4', mode='r', offset=header_size, shape=shape)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(header_size)
+                data = np.fromfile(f, dtype='<f4', count=shape[0] * shape[1]).reshape(shape)
+        return names, data
+
+    from plyfile import PlyData
+    from numpy.lib import recfunctions
+
+    vertices = PlyData.read(path)['vertex'].data
+    names = list(vertices.dtype.names)
+    return names, recfunctions.structured_to_unstructured(vertices, dtype=np.float32)
+
+def column_indices(names, prefix):
+    """Indices of the attributes named <prefix><i>, ordered by i."""
+    matches = [(int(name[len(prefix):]), idx) for idx, name in enumerate(names)
+               if name.startswith(prefix) and name[len(prefix):].isdigit()]
+    return [idx for _, idx in sorted(matches)]
+
+if __name__ == '__main__':
+    # Compares the structured-buffer PLY I/O with the per-vertex plyfile path
+    import time
+    import tempfile
+    from argparse import ArgumentParser
+    from plyfile import PlyData, PlyElement
+
+    parser = ArgumentParser(description="PLY I/O benchmark")
+    parser.add_argument("--num_points", nargs="+", type=int, default=[1_000_000, 5_000_000])
+    parser.add_argument("--skip_plyfile", action="store_true", help="Skip the (slow) per-vertex plyfile baseline")
+    args = parser.parse_args(sys.argv[1:])
+
+    names = ['x', 'y', 'z', 'nx', 'ny', 'nz'] + ['f_dc_{}'.format(i) for i in range(3)] \
+        + ['f_rest_{}'.format(i) for i in range(45)] + ['opacity'] \
+        + ['scale_{}'.format(i) for i in range(3)] + ['rot_{}'.format(i) for i in range(4)]
+
+    def timed(label, fn):
+        start = time.perf_counter()
+        result = fn()
+        print("  {:<28s} {:8.2f} s".format(label, time.perf_counter() - start))
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_points in args.num_points:
+            print("{} points, {:.0f} MB".format(num_points, num_points * len(names) * 4 / 2**20))
+            attributes = np.random.rand(num_points, len(names)).astype(np.float32)
+            path = os.path.join(tmp_dir, "bench.ply")
+
+            if not args.skip_plyfile:
+                def plyfile_write():
+                    elements = np.empty(num_points, dtype=[(name, 'f4') for name in names])
+                    elements[:] = list(map(tuple, attributes))
+                    PlyData([PlyElement.describe(elements, 'vertex')]).write(path)
+                timed("plyfile write", plyfile_write)
+
+                def plyfile_read():
+                    vertex = PlyData.read(path).elements[0]
+                    return np.stack([np.asarray(vertex[name]) for name in names], axis=1)
+                reference = timed("plyfile read", plyfile_read)
+                assert np.array_equal(reference, attributes)
+
+            timed("buffer write", lambda: write_vertex_ply(path, names, [attributes]))
+            _, data = timed("buffer read", lambda: read_vertex_ply(path))
+            assert np.array_equal(data, attributes)
+            _, data = timed("mmap read (open)", lambda: read_vertex_ply(path, mmap=True))
+            timed("mmap read (touch)", lambda: np.ascontiguousarray(data[:, column_indices(names, 'f_rest_')]))
+            del data
@@ -0,0 +1,115 @@
+import torch
+
+# Execution options of the frozen auxiliary networks (monocular depth, DINOv2).
+# Reduced precision runs under autocast, so weights stay in fp32 and only the
+# matmuls and convolutions drop to fp16/bf16; outputs are returned in fp32.
+
+PRECISIONS = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+def autocast(device, precision="fp32"):
+    """Autocast context for precision on device, a no-op for fp32."""
+    dtype = PRECISIONS[precision]
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=dtype != torch.float32)
+
+def set_channels_last(model, enabled=True):
+    """
+    Switches the convolution weights of model to the channels-last layout.
+    Models that convert their input themselves (a channels_last attribute, as
+    the DPT depth model has) are told to do so as well. Layers without 4D
+    weights, like the transformer blocks of DINOv2, are not affected.
+    """
+    if getattr(model, "_channels_last", False) == enabled:
+        return model
+    model.to(memory_format=torch.channels_last if enabled else torch.contiguous_format)
+    if hasattr(model, "channels_last"):
+        model.channels_last = enabled
+    model._channels_last = enabled
+    return model
+
+def run_inference(fn, *args, **kwargs):
+    """
+    Runs fn under torch.inference_mode. The result is cloned outside of it, so
+    that it can still be used as a constant target in a graph that is
+    differentiated later, which raw inference tensors can not.
+    """
+    with torch.inference_mode():
+        out = fn(*args, **kwargs)
+    return out.clone()
+
+def precision_drift(fn, inputs, precision, device=None):
+    """
+    Runs fn(x, precision) and fn(x, "fp32") on every element of inputs and
+    returns the mean and max absolute difference of the outputs, with the
+    mean absolute fp32 output for scale.
+    """
+    diffs = []
+    scale = 0.0
+    for x in inputs:
+        x = x.to(device) if device is not None else x
+        with torch.no_grad():
+            reference = fn(x, "fp32").float()
+            reduced = fn(x, precision).float()
+        diffs.append((reduced - reference).abs().flatten())
+        scale += reference.abs().mean().item() / len(inputs)
+    diffs = torch.cat(diffs)
+    return {"mean_abs": diffs.mean().item(), "max_abs": diffs.max().item(), "fp32_mean_abs": scale}
+
+if __name__ == '__main__':
+    # Quantifies how much reduced precision in the auxiliary networks changes
+    # the perturbation losses of training: every image is compared with a
+    # slightly shifted and noisy copy of itself, which stands in for a render.
+    import sys
+    from argparse import ArgumentParser
+    import torch.nn.functional as F
+    from utils.utils import read_image
+    from utils.general_utils import default_device
+    from utils.depth_utils import estimate_depth
+    from utils.feature_extractor import get_Feature_from_DinoV2
+    from utils.loss_utils import pearson_correlation, cosine_similarity_loss
+
+    parser = ArgumentParser(description="Loss drift of reduced precision auxiliary networks against fp32")
+    parser.add_argument("images", nargs="*", help="RGB images, random ones are used if none are given")
+    parser.add_argument("--precision", type=str, default="bf16", choices=["fp16", "bf16"])
+    parser.add_argument("--channels_last", action="store_true")
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--dino_resolution", type=int, default=504)
+    args = parser.parse_args(sys.argv[1:])
+
+    device = default_device()
+    torch.manual_seed(0)
+    if args.images:
+        images = [read_image(path, to_torch=True, squeeze=True)[..., :3].permute(2, 0, 1).float() for path in args.images]
+    else:
+        print("No images given, using random ones; real images give more meaningful numbers")
+        images = [F.interpolate(torch.rand(1, 3, 32, 32), size=(args.size, args.size), mode='bilinear')[0] for _ in range(4)]
+    images = [F.interpolate(image[None], size=(args.size, args.size), mode='bilinear')[0].to(device) for image in images]
+
+    def losses(image, noise, precision):
+        render = (torch.roll(image, shifts=4, dims=2) + noise).clamp(0, 1).requires_grad_(True)
+        target_depth = estimate_depth(image, precision=precision, channels_last=args.channels_last)
+        render_depth = estimate_depth(render.detach(), precision=precision, channels_last=args.channels_last)
+        loss_depth = 1 - pearson_correlation(render_depth, target_depth)
+        reference = run_inference(get_Feature_from_DinoV2, image, resolution=args.dino_resolution, precision=precision,
+                                  channels_last=args.channels_last)
+        loss_feature = cosine_similarity_loss(get_Feature_from_DinoV2(render, resolution=args.dino_resolution, precision=precision,
+                                                                      channels_last=args.channels_last), reference)
+        grad, = torch.autograd.grad(loss_feature, render)
+        return loss_depth.item(), loss_feature.item(), grad
+
+    rows = []
+    for image in images:
+        # Same render for both precisions
+        noise = 0.02 * torch.randn(image.shape).to(device)
+        depth_32, feature_32, grad_32 = losses(image, noise, "fp32")
+        depth_r, feature_r, grad_r = losses(image, noise, args.precision)
+        rows.append((abs(depth_r - depth_32), abs(feature_r - feature_32), F.cosine_similarity(grad_r.flatten(), grad_32.flatten(), dim=0).item(),
+                     depth_32, feature_32))
+
+    drift = torch.tensor(rows)
+    print("{} vs fp32 over {} images{}".format(args.precision, len(images), ", channels last" if args.channels_last else ""))
+    print("  depth loss   |drift| mean {:.2e} max {:.2e} (fp32 loss mean {:.4f})".format(drift[:, 0].mean(), drift[:, 0].max(), drift[:, 3].mean()))
+    print("  feature loss |drift| mean {:.2e} max {:.2e} (fp32 loss mean {:.4f})".format(drift[:, 1].mean(), drift[:, 1].max(), drift[:, 4].mean()))
+    print("  feature loss gradient cosine similarity to fp32: min {:.4f}".format(drift[:, 2].min()))
+    depth_drift = precision_drift(lambda x, precision: estimate_depth(x, precision=precision, channels_last=args.channels_last),
+                                  images, args.precision)
+    print("  depth map    |diff| mean {:.2e} max {:.2e} (fp32 mean {:.4f})".format(depth_drift["mean_abs"], depth_drift["max_abs"], depth_drift["fp32_mean_abs"]))
@@ -3,11 +3,12 @@ import matplotlib.pyplot as plt
 from scipy.spatial.transform import Rotation
 import shutil
 import os
+import json
 import trimesh
 import torch
 
 
-def save_data(source_path, pano_img, distances, R, fx, fy, cx, cy, pers_imgs, pts):
+def save_data(source_path, pano_img, distances, R, fx, fy, cx, cy, pers_imgs, pts, metadata=None):
     image_folder = os.path.join(source_path, 'images')
     #depth_folder = os.path.join(source_path, 'depths')
     pose_folder = os.path.join(source_path, 'sparse/0')
@@ -81,5 +82,10 @@ def save_data(source_path, pano_img, distances, R, fx, fy, cx, cy, pers_imgs, pt
     pcd_path = os.path.join(pose_folder, 'points3D.ply')
     pcd.export(pcd_path)
 
+    # How the scene was lifted, e.g. the steps the distance field fit took
+    if metadata is not None:
+        with open(os.path.join(pose_folder, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f, indent=2)
+
     print('Saved perspective images to ', image_folder)
     print('Saved camera poses to ', pose_folder)
\ No newline at end of file